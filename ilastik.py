@@ -19,6 +19,43 @@
 
 # Standard
 import sys
+
+# Import-time profiling must be installed before anything else is imported.
+if '--profile_imports' in sys.argv:
+    import time
+    import atexit
+    import __builtin__
+
+    _import_times = {} # module name : [cumulative seconds, exclusive seconds]
+    _import_stack = []
+    _ordinary_import = __builtin__.__import__
+    def _timed_import(name, *args, **kwargs):
+        if name in sys.modules:
+            return _ordinary_import(name, *args, **kwargs)
+        _import_stack.append(0.0)
+        start = time.time()
+        try:
+            return _ordinary_import(name, *args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            nested = _import_stack.pop()
+            if _import_stack:
+                _import_stack[-1] += elapsed
+            times = _import_times.setdefault(name, [0.0, 0.0])
+            times[0] += elapsed
+            times[1] += elapsed - nested
+    __builtin__.__import__ = _timed_import
+
+    def _print_import_profile(count=40):
+        __builtin__.__import__ = _ordinary_import
+        total = sum(t[1] for t in _import_times.values())
+        sys.stderr.write("Import profile: {} modules, {:.3f}s total\n".format(len(_import_times), total))
+        sys.stderr.write("{:>10} {:>10}  module\n".format("self [s]", "cumul [s]"))
+        ranked = sorted(_import_times.items(), key=lambda (name, t): t[1], reverse=True)
+        for name, (cumulative, exclusive) in ranked[:count]:
+            sys.stderr.write("{:>10.3f} {:>10.3f}  {}\n".format(exclusive, cumulative, name))
+    atexit.register(_print_import_profile)
+
 import argparse
 
 from ilastik.config import cfg as ilastik_config
@@ -36,6 +73,7 @@ parser.add_argument('--workflow', help='When used with --new_project, specifies
 parser.add_argument('--debug', help='Start ilastik in debug mode.', action='store_true', default=False)
 parser.add_argument('--fullscreen', help='Show Window in fullscreen mode.', action='store_true', default=False)
 parser.add_argument('--headless', help="Don't start the ilastik gui.", action='store_true', default=False)
+parser.add_argument('--profile_imports', help='Print a report of the time spent importing each module on exit.', action='store_true', default=False)
 
 # Special command-line control over default tmp dir
 ilastik.monkey_patches.extend_arg_parser(parser)
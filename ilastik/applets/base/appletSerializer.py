@@ -23,12 +23,18 @@ from ilastik.config import cfg as ilastik_config
 from ilastik.utility.simpleSignal import SimpleSignal
 from ilastik.utility.maybe import maybe
 import os
+import shutil
+import hashlib
 import tempfile
+import threading
+import collections
 import vigra
 import h5py
 import numpy
 import warnings
+from functools import partial
 
+from lazyflow.request import Request, RequestPool
 from lazyflow.roi import TinyVector, roiToSlice, sliceToRoi
 from lazyflow.utility import timeLogged
 
@@ -82,6 +88,46 @@ def stringToSlicing(strSlicing):
 
     return slicing
 
+def groupChecksum(group):
+    """Return a checksum of the names, attributes and data of everything
+    in the given group (the name of the group itself is not included).
+
+    """
+    checksum = hashlib.sha1()
+    def update(name, item):
+        checksum.update(name)
+        values = [ item.attrs[key] for key in sorted(item.attrs.keys()) ]
+        if isinstance(item, h5py.Dataset):
+            values.append( item[()] )
+        for value in values:
+            value = numpy.asarray(value)
+            checksum.update(str(value.dtype))
+            if value.dtype == object:
+                checksum.update(repr(value.tolist()))
+            else:
+                checksum.update(value.tostring())
+
+    update('', group)
+    names = []
+    group.visit(names.append)
+    for name in sorted(names):
+        update(name, group[name])
+    return checksum.hexdigest()
+
+def classifierTempDir():
+    """Create a temporary directory for passing classifiers to and from
+    vigra. Uses shared memory where available, since the default temp
+    directory may be on a (slow) network filesystem.
+
+    """
+    shm = '/dev/shm'
+    if os.path.isdir(shm) and os.access(shm, os.W_OK):
+        try:
+            return tempfile.mkdtemp(dir=shm, prefix='ilastik-classifier-')
+        except OSError:
+            pass
+    return tempfile.mkdtemp()
+
 
 class SerialSlot(object):
     """Implements the logic for serializing a slot."""
@@ -358,7 +404,28 @@ class SerialListSlot(SerialSlot):
 
 
 class SerialBlockSlot(SerialSlot):
-    """A slot which only saves nonzero blocks."""
+    """A slot which only saves nonzero blocks.
+
+    The blocks of each lane are stored in one chunked, compressed dataset
+    ('data', the flattened blocks one after another) with a sparse block
+    index ('blockIndex', one row of [start..., stop..., offset] per block).
+    Projects with the old layout (one dataset per block, with a 'blockSlice'
+    attribute) can still be read.
+
+    The dirty regions of each lane are tracked, so saving again only
+    rewrites the blocks that changed.  Changed blocks are appended to
+    'data' (the old data is never overwritten), and a new block index is
+    committed once everything is written.  If the save is interrupted,
+    the previous index (and data) stays valid.  A lane with mostly unused
+    data is written from scratch into a sibling group ('<lane>.new'),
+    which only replaces the old lane once it is complete.
+
+    """
+    #: Number of blocks that are requested in parallel (and held in memory) while saving
+    BatchSize = 64
+    #: Chunk size (in elements) of the data dataset
+    ChunkSize = 2**16
+
     def __init__(self, slot, inslot, blockslot, name=None, subname=None,
                  default=None, depends=None, selfdepends=True, shrink_to_bb=False):
         """
@@ -367,6 +434,8 @@ class SerialBlockSlot(SerialSlot):
                              its nonzero bounding box before feeding saving it.
 
         """
+        self._dirtyRois = {} # lane index -> list of (start, stop)
+        self._fullSave = True
         super(SerialBlockSlot, self).__init__(
             slot, inslot, name, subname, default, depends, selfdepends
         )
@@ -374,6 +443,40 @@ class SerialBlockSlot(SerialSlot):
         self._bind(slot)
         self._shrink_to_bb = shrink_to_bb
 
+    def setDirty(self, slot=None, roi=None, *args, **kwargs):
+        super(SerialBlockSlot, self).setDirty()
+        if self.ignoreDirty:
+            return
+        lanes = [ i for i, subslot in enumerate(self.slot) if subslot is slot ]
+        if len(lanes) == 1 and hasattr(roi, 'start'):
+            self._dirtyRois.setdefault(lanes[0], []).append( (tuple(roi.start), tuple(roi.stop)) )
+        else:
+            # Lanes were added or removed, or a value changed: save everything
+            self._fullSave = True
+
+    def serialize(self, group):
+        if not self.shouldSerialize(group):
+            return
+        if self.slot.ready() and self._canUpdate(group):
+            self._update(group[self.name])
+        else:
+            deleteIfPresent(group, self.name)
+            if self.slot.ready():
+                self._serialize(group, self.name, self.slot)
+        self.dirty = False
+        self._dirtyRois = {}
+        self._fullSave = False
+
+    def _canUpdate(self, group):
+        """Whether the group holds our last save in the current layout, so only the dirty blocks need to be written."""
+        if self._fullSave or self.name not in group:
+            return False
+        mygroup = group[self.name]
+        laneNames = [ self.subname.format(index) for index in range(len(self.slot)) ]
+        if sorted( name for name, _ in _committedLanes(mygroup) ) != sorted(laneNames):
+            return False
+        return all( _hasBlockIndex(mygroup[laneName]) for laneName in laneNames )
+
     @timeLogged(logger, logging.DEBUG)
     def _serialize(self, group, name, slot):
         logger.debug("Serializing BlockSlot: {}".format( self.name ))
@@ -382,39 +485,202 @@ class SerialBlockSlot(SerialSlot):
         for index in range(num):
             subname = self.subname.format(index)
             subgroup = mygroup.create_group(subname)
-            nonZeroBlocks = self.blockslot[index].value
-            for blockIndex, slicing in enumerate(nonZeroBlocks):
-                block = self.slot[index][slicing].wait()
-                blockName = 'block{:04d}'.format(blockIndex)
+            self._serializeLane(subgroup, index)
+
+    def _serializeLane(self, subgroup, index):
+        nonZeroBlocks = self.blockslot[index].value
+        subgroup.create_dataset('data', shape=(0,), maxshape=(None,),
+                                dtype=self.slot[index].meta.dtype,
+                                chunks=(self.ChunkSize,), compression=1)
+        blockIndex = self._appendBlocks(subgroup['data'], index, nonZeroBlocks)
+        _commitBlockIndex(subgroup, blockIndex)
+
+    def _rewriteLane(self, mygroup, index):
+        """Write the lane from scratch into a sibling group, and replace the old lane only once the new one is complete."""
+        laneName = self.subname.format(index)
+        newName = laneName + '.new'
+        deleteIfPresent(mygroup, newName)
+        self._serializeLane(mygroup.create_group(newName), index)
+        mygroup.file.flush()
+        mygroup[newName].attrs['complete'] = True
+        mygroup.file.flush()
+        del mygroup[laneName]
+        mygroup.move(newName, laneName)
+        del mygroup[laneName].attrs['complete']
 
+    @timeLogged(logger, logging.DEBUG)
+    def _update(self, mygroup):
+        logger.debug("Updating BlockSlot: {}".format( self.name ))
+        for index, rois in self._dirtyRois.items():
+            if index >= len(self.slot):
+                continue
+            subgroup = mygroup[self.subname.format(index)]
+            shape = self.slot[index].meta.shape
+            dirtyStarts = numpy.array( [ roi[0] for roi in rois ], dtype=numpy.int64 ).reshape(-1, len(shape))
+            dirtyStops = numpy.array( [ roi[1] for roi in rois ], dtype=numpy.int64 ).reshape(-1, len(shape))
+
+            # Rewrite the nonzero blocks that intersect a dirty region...
+            nonZeroBlocks = self.blockslot[index].value
+            blockRois = numpy.array( [ sliceToRoi(slicing, shape) for slicing in nonZeroBlocks ], dtype=numpy.int64 ).reshape(-1, 2, len(shape))
+            isDirty = _intersects(blockRois[:, 0], blockRois[:, 1], dirtyStarts, dirtyStops)
+            dirtyBlocks = [ slicing for slicing, dirty in zip(nonZeroBlocks, isDirty) if dirty ]
+
+            # ...and drop the stored blocks within them or within the dirty regions (i.e. erased blocks).
+            ndim = len(shape)
+            blockIndex = _readBlockIndex(subgroup)
+            keep = ~_intersects(blockIndex[:, :ndim], blockIndex[:, ndim:2*ndim],
+                                numpy.vstack( (dirtyStarts, blockRois[isDirty, 0]) ),
+                                numpy.vstack( (dirtyStops, blockRois[isDirty, 1]) ))
+            blockIndex = blockIndex[keep]
+
+            data = subgroup['data']
+            liveSize = numpy.prod(blockIndex[:, ndim:2*ndim] - blockIndex[:, :ndim], axis=1).sum() \
+                       + numpy.prod(blockRois[isDirty, 1] - blockRois[isDirty, 0], axis=1).sum()
+            if data.shape[0] > 2*liveSize:
+                # Mostly unused data: write the lane from scratch
+                self._rewriteLane(mygroup, index)
+                continue
+
+            newRows = self._appendBlocks(data, index, dirtyBlocks)
+            _commitBlockIndex(subgroup, numpy.vstack( (blockIndex, newRows) ))
+
+    def _appendBlocks(self, data, index, slicings):
+        """Append the given blocks of the lane to the data dataset, and return their block index rows."""
+        shape = self.slot[index].meta.shape
+        blockIndex = numpy.zeros( (len(slicings), 2*len(shape)+1), dtype=numpy.int64 )
+        offset = data.shape[0]
+        for batchStart in range(0, len(slicings), self.BatchSize):
+            batch = slicings[batchStart:batchStart+self.BatchSize]
+            blocks = self._fetchBlocks(self.slot[index], batch)
+            for i, (slicing, block) in enumerate(zip(batch, blocks)):
                 if self._shrink_to_bb:
-                    nonzero_coords = numpy.nonzero(block)
-                    if len(nonzero_coords[0]) > 0:
-                        block_start = sliceToRoi( slicing, (0,)*len(slicing) )[0]
-                        block_bounding_box_start = numpy.array( map( numpy.min, nonzero_coords ) )
-                        block_bounding_box_stop = 1 + numpy.array( map( numpy.max, nonzero_coords ) )
-                        block_slicing = roiToSlice( block_bounding_box_start, block_bounding_box_stop )
-                        bounding_box_roi = numpy.array([block_bounding_box_start, block_bounding_box_stop])
-                        bounding_box_roi += block_start
-                        
-                        # Overwrite the vars that are written to the file
-                        slicing = roiToSlice(*bounding_box_roi)
-                        block = block[block_slicing]
-
-                subgroup.create_dataset(blockName, data=block)
-                subgroup[blockName].attrs['blockSlice'] = slicingToString(slicing)
+                    slicing, block = self._shrinkToBoundingBox(slicing, block)
+                start, stop = sliceToRoi(slicing, shape)
+                blockIndex[batchStart+i] = list(start) + list(stop) + [offset]
+
+                data.resize( (offset + block.size,) )
+                data[offset:] = block.reshape(-1)
+                offset += block.size
+        return blockIndex
+
+    def _fetchBlocks(self, slot, slicings):
+        """Request the given blocks of the slot in parallel."""
+        blocks = [None] * len(slicings)
+        def fetch(i):
+            blocks[i] = slot[slicings[i]].wait()
+
+        pool = RequestPool()
+        for i in range(len(slicings)):
+            pool.add( Request( partial(fetch, i) ) )
+        pool.wait()
+        pool.clean()
+        return blocks
+
+    def _shrinkToBoundingBox(self, slicing, block):
+        nonzero_coords = numpy.nonzero(block)
+        if len(nonzero_coords[0]) > 0:
+            block_start = sliceToRoi( slicing, (0,)*len(slicing) )[0]
+            block_bounding_box_start = numpy.array( map( numpy.min, nonzero_coords ) )
+            block_bounding_box_stop = 1 + numpy.array( map( numpy.max, nonzero_coords ) )
+            block_slicing = roiToSlice( block_bounding_box_start, block_bounding_box_stop )
+            bounding_box_roi = numpy.array([block_bounding_box_start, block_bounding_box_stop])
+            bounding_box_roi += block_start
+            
+            # Overwrite the vars that are written to the file
+            slicing = roiToSlice(*bounding_box_roi)
+            block = block[block_slicing]
+        return slicing, block
 
     @timeLogged(logger, logging.DEBUG)
     def _deserialize(self, mygroup, slot):
         logger.debug("Deserializing BlockSlot: {}".format( self.name ))
-        num = len(mygroup)
+        lanes = _committedLanes(mygroup)
+        num = len(lanes)
         if len(self.inslot) < num:
             self.inslot.resize(num)
-        for index, t in enumerate(sorted(mygroup.items())):
+        for index, t in enumerate(lanes):
             groupName, labelGroup = t
-            for blockData in labelGroup.values():
-                slicing = stringToSlicing(blockData.attrs['blockSlice'])
-                self.inslot[index][slicing] = blockData[...]
+            if 'data' in labelGroup:
+                blockIndex = _readBlockIndex(labelGroup)
+                data = labelGroup['data']
+                ndim = (blockIndex.shape[1] - 1) // 2
+                for row in blockIndex:
+                    start, stop, offset = row[:ndim], row[ndim:2*ndim], row[-1]
+                    blockShape = stop - start
+                    block = data[offset:offset+numpy.prod(blockShape)].reshape(blockShape)
+                    self.inslot[index][roiToSlice(start, stop)] = block
+            else:
+                # Old layout: one dataset per block
+                for blockData in labelGroup.values():
+                    slicing = stringToSlicing(blockData.attrs['blockSlice'])
+                    self.inslot[index][slicing] = blockData[...]
+
+        # The file is in sync with the slot now
+        self._dirtyRois = {}
+        self._fullSave = False
+
+def _intersects(starts, stops, otherStarts, otherStops):
+    """For each roi (given as arrays of starts and stops), whether it intersects any of the other rois."""
+    result = numpy.zeros( (len(starts),), dtype=bool )
+    for otherStart, otherStop in zip(otherStarts, otherStops):
+        result |= numpy.all( (starts < otherStop) & (stops > otherStart), axis=1 )
+    return result
+
+def _committedLanes(mygroup):
+    """The (name, group) pairs of the committed lanes, sorted by name.  A
+    lane that was completely rewritten by an interrupted save ('<lane>.new')
+    replaces the old one; an incomplete rewrite is discarded."""
+    lanes = {}
+    writable = mygroup.file.mode != 'r'
+    for name in list(mygroup.keys()):
+        if not name.endswith('.new'):
+            lanes.setdefault(name, mygroup[name])
+            continue
+        laneName = name[:-len('.new')]
+        if mygroup[name].attrs.get('complete', False):
+            if writable:
+                deleteIfPresent(mygroup, laneName)
+                mygroup.move(name, laneName)
+                del mygroup[laneName].attrs['complete']
+                lanes[laneName] = mygroup[laneName]
+            else:
+                lanes[laneName] = mygroup[name]
+        elif writable:
+            del mygroup[name]
+    return sorted(lanes.items())
+
+def _hasBlockIndex(laneGroup):
+    """Whether the lane has a committed block index."""
+    return 'blockIndex' in laneGroup or \
+           ( 'blockIndex.new' in laneGroup and laneGroup['blockIndex.new'].attrs.get('complete', False) )
+
+def _readBlockIndex(laneGroup):
+    """Read the committed block index of a lane.  A new index that was
+    completely written by an interrupted save is committed, too."""
+    if 'blockIndex.new' in laneGroup and laneGroup['blockIndex.new'].attrs.get('complete', False):
+        blockIndex = laneGroup['blockIndex.new'][:]
+        if laneGroup.file.mode != 'r':
+            deleteIfPresent(laneGroup, 'blockIndex')
+            laneGroup.move('blockIndex.new', 'blockIndex')
+        return blockIndex
+    if 'blockIndex' in laneGroup:
+        return laneGroup['blockIndex'][:]
+    # The first save of this lane was interrupted: nothing was committed
+    return numpy.zeros( (0, 1), dtype=numpy.int64 )
+
+def _commitBlockIndex(laneGroup, blockIndex):
+    """Replace the block index of a lane.  The new index only becomes
+    valid once it is written completely, so an interrupted save leaves
+    the old one intact."""
+    deleteIfPresent(laneGroup, 'blockIndex.new')
+    ds = laneGroup.create_dataset('blockIndex.new', data=blockIndex)
+    ds.attrs['Format'] = "block start, block stop, offset into data"
+    laneGroup.file.flush()
+    ds.attrs['complete'] = True
+    laneGroup.file.flush()
+    deleteIfPresent(laneGroup, 'blockIndex')
+    laneGroup.move('blockIndex.new', 'blockIndex')
+    del laneGroup['blockIndex'].attrs['complete']
 
 class SerialHdf5BlockSlot(SerialBlockSlot):
 
@@ -446,7 +712,18 @@ class SerialHdf5BlockSlot(SerialBlockSlot):
                 self.inslot[index][roiToSlice( *blockRoi )] = blockDataset
 
 class SerialClassifierSlot(SerialSlot):
-    """For saving a random forest classifier."""
+    """For saving a random forest classifier.
+
+    Deserialized forests are kept in a small process-wide cache, keyed by
+    the checksum of their project group, so loading the same classifier
+    again (e.g. in every lane or every job of a batch run) is free.
+
+    """
+    #: Number of classifiers in the cache
+    ForestCacheSize = 4
+    _forestCache = collections.OrderedDict() # group checksum -> list of forests
+    _forestCacheLock = threading.Lock()
+
     def __init__(self, slot, cache, inslot=None, name=None, subname=None,
                  default=None, depends=None, selfdepends=True):
         super(SerialClassifierSlot, self).__init__(
@@ -477,19 +754,22 @@ class SerialClassifierSlot(SerialSlot):
 
         # Due to non-shared hdf5 dlls, vigra can't write directly to
         # our open hdf5 group. Instead, we'll use vigra to write the
-        # classifier to a temporary file.
-        tmpDir = tempfile.mkdtemp()
-        cachePath = os.path.join(tmpDir, 'tmp_classifier_cache.h5').replace('\\', '/')
-        for i, forest in enumerate(classifier_forests):
-            targetname = '{0}/{1}'.format(name, self.subname.format(i))
-            forest.writeHDF5(cachePath, targetname)
-
-        # Open the temp file and copy to our project group
-        with h5py.File(cachePath, 'r') as cacheFile:
-            group.copy(cacheFile[name], name)
+        # classifier to a temporary file (in memory, if possible).
+        tmpDir = classifierTempDir()
+        try:
+            cachePath = os.path.join(tmpDir, 'tmp_classifier_cache.h5').replace('\\', '/')
+            for i, forest in enumerate(classifier_forests):
+                targetname = '{0}/{1}'.format(name, self.subname.format(i))
+                forest.writeHDF5(cachePath, targetname)
+
+            # Open the temp file and copy to our project group
+            with h5py.File(cachePath, 'r') as cacheFile:
+                group.copy(cacheFile[name], name)
+        finally:
+            shutil.rmtree(tmpDir)
 
-        os.remove(cachePath)
-        os.rmdir(tmpDir)
+        # Reloading this project in the same process doesn't need to parse the forests again.
+        self._cacheForests(groupChecksum(group[name]), list(classifier_forests))
 
     def deserialize(self, group):
         """
@@ -499,21 +779,25 @@ class SerialClassifierSlot(SerialSlot):
         self.dirty = False
 
     def _deserialize(self, classifierGroup, slot):
-        # Due to non-shared hdf5 dlls, vigra can't read directly
-        # from our open hdf5 group. Instead, we'll copy the
-        # classfier data to a temporary file and give it to vigra.
-        tmpDir = tempfile.mkdtemp()
-        cachePath = os.path.join(tmpDir, 'tmp_classifier_cache.h5').replace('\\', '/')
-        with h5py.File(cachePath, 'w') as cacheFile:
-            cacheFile.copy(classifierGroup, self.name)
-
-        forests = []
-        for name, forestGroup in sorted(classifierGroup.items()):
-            targetname = '{0}/{1}'.format(self.name, name)
-            forests.append(vigra.learning.RandomForest(cachePath, targetname))
-
-        os.remove(cachePath)
-        os.rmdir(tmpDir)
+        checksum = groupChecksum(classifierGroup)
+        forests = self._getCachedForests(checksum)
+        if forests is None:
+            # Due to non-shared hdf5 dlls, vigra can't read directly
+            # from our open hdf5 group. Instead, we'll copy the
+            # classfier data to a temporary file and give it to vigra.
+            tmpDir = classifierTempDir()
+            try:
+                cachePath = os.path.join(tmpDir, 'tmp_classifier_cache.h5').replace('\\', '/')
+                with h5py.File(cachePath, 'w') as cacheFile:
+                    cacheFile.copy(classifierGroup, self.name)
+
+                forests = []
+                for name, forestGroup in sorted(classifierGroup.items()):
+                    targetname = '{0}/{1}'.format(self.name, name)
+                    forests.append(vigra.learning.RandomForest(cachePath, targetname))
+            finally:
+                shutil.rmtree(tmpDir)
+            self._cacheForests(checksum, forests)
 
         # Now force the classifier into our classifier cache. The
         # downstream operators (e.g. the prediction operator) can
@@ -524,6 +808,23 @@ class SerialClassifierSlot(SerialSlot):
         # retrained.)
         self.cache.forceValue(numpy.array(forests))
 
+    @classmethod
+    def _getCachedForests(cls, checksum):
+        with cls._forestCacheLock:
+            forests = cls._forestCache.pop(checksum, None)
+            if forests is None:
+                return None
+            cls._forestCache[checksum] = forests # Most recently used
+            return list(forests)
+
+    @classmethod
+    def _cacheForests(cls, checksum, forests):
+        with cls._forestCacheLock:
+            cls._forestCache.pop(checksum, None)
+            cls._forestCache[checksum] = forests
+            while len(cls._forestCache) > cls.ForestCacheSize:
+                cls._forestCache.popitem(last=False)
+
 class SerialCountingSlot(SerialSlot):
     """For saving a random forest classifier."""
     def __init__(self, slot, cache, inslot=None, name=None, subname=None,
@@ -664,6 +965,12 @@ class AppletSerializer(object):
     # override if necessary
     version = "0.1"
 
+    #: For each load profile, the names of the serial slots (i.e. their groups) that are needed.
+    #: The other slots are skipped when a project is opened with that profile, and loaded by
+    #: loadDeferred() when they are needed after all.  If the profile is not listed, everything is
+    #: loaded.  (Currently, the headless batch prediction uses the 'prediction' profile.)
+    loadProfiles = {}
+
     class IncompatibleProjectVersionError(Exception):
         pass
 
@@ -709,6 +1016,9 @@ class AppletSerializer(object):
         self.operator = operator
         self.caresOfHeadless = False # should _deserializeFromHdf5 should be called with headless-argument?
         self._ignoreDirty = False
+        self.loadProfile = None # Set by the project manager
+        self._deferredSlots = []
+        self._deferredGroup = None
 
     def isDirty(self):
         """Returns true if the current state of this item (in memory)
@@ -743,6 +1053,8 @@ class AppletSerializer(object):
         project.
 
         """
+        self._deferredSlots = []
+        self._deferredGroup = None
         for ss in self.serialSlots:
             ss.unload()
 
@@ -828,9 +1140,18 @@ class AppletSerializer(object):
         try:
             if topGroup is not None:
                 inc = self.progressIncrement()
+                neededSlotNames = self.loadProfiles.get(self.loadProfile, None)
+                self._deferredSlots = []
+                self._deferredGroup = topGroup
                 for ss in self.serialSlots:
-                    ss.deserialize(topGroup)
+                    if neededSlotNames is not None and ss.name not in neededSlotNames and ss.name in topGroup:
+                        self._deferredSlots.append(ss)
+                    else:
+                        ss.deserialize(topGroup)
                     self.progressSignal.emit(inc)
+                if self._deferredSlots:
+                    logger.debug( "Deferred loading of {} for load profile '{}'".format(
+                        [ ss.name for ss in self._deferredSlots ], self.loadProfile ) )
 
                 # Call the subclass to do remaining work
                 if self.caresOfHeadless:
@@ -842,6 +1163,29 @@ class AppletSerializer(object):
         finally:
             self.progressSignal.emit(100)
     
+    def loadDeferred(self):
+        """Load the slots that were skipped because of the load profile.
+
+        The slots after them are loaded again (unless they were changed
+        in the meantime), because they may depend on the skipped ones.
+        For instance, loading the labels invalidates the classifier.
+        The project file must still be open.
+
+        """
+        if not self._deferredSlots:
+            return
+        deferred, self._deferredSlots = self._deferredSlots, []
+        first = min( self.serialSlots.index(ss) for ss in deferred )
+
+        ignoreDirty = self.ignoreDirty
+        self.ignoreDirty = True
+        try:
+            for ss in self.serialSlots[first:]:
+                if ss in deferred or not ss.dirty:
+                    ss.deserialize(self._deferredGroup)
+        finally:
+            self.ignoreDirty = ignoreDirty
+
     def repairFile(self,path,filt = None):
         """get new path to lost file"""
         
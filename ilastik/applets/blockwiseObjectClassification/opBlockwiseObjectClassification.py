@@ -20,10 +20,11 @@ import collections
 
 # Third-party
 import numpy
+import psutil
 
 # lazyflow
 from lazyflow.graph import Operator, InputSlot, OutputSlot
-from lazyflow.request import RequestLock
+from lazyflow.request import Request, RequestPool, RequestLock
 from lazyflow.roi import getIntersectingBlocks, getBlockBounds, getIntersection, roiToSlice
 from lazyflow.operators import OpSubRegion
 from lazyflow.stype import Opaque
@@ -31,7 +32,8 @@ from lazyflow.rtype import List
 
 # ilastik
 from ilastik.utility import bind
-from ilastik.applets.objectExtraction.opObjectExtraction import OpObjectExtraction
+from ilastik.utility.opBlockwiseConnectedComponents import OpBlockwiseConnectedComponents
+from ilastik.applets.objectExtraction.opObjectExtraction import OpObjectExtraction, OpCachedRegionFeatures, OpAdaptTimeListRoi, default_features_key, coordinate_axes
 from ilastik.applets.objectClassification.opObjectClassification import OpObjectPredict, OpRelabelSegmentation, OpMaxLabel
 from ilastik.applets.base.applet import DatasetConstraintError
 
@@ -203,6 +205,15 @@ class OpSingleBlockObjectPrediction( Operator ):
 class OpBlockwiseObjectClassification( Operator ):
     """
     Handles prediction ONLY.  Training must be provided externally and loaded via the serializer.
+
+    By default, each block is predicted by its own pipeline, which sees only the block and its halo.
+    Objects that are larger than the halo are truncated, and may be classified differently in
+    neighboring blocks.
+
+    If StitchObjects is True, the objects are instead labeled globally (blockwise, with labels
+    merged across block faces), their features are accumulated across all blocks they touch,
+    and each object is classified exactly once.  The blocks only determine the tiling of the
+    computation, so small blocks can be used without changing the result.
     """
     RawImage = InputSlot()
     BinaryImage = InputSlot()
@@ -211,14 +222,23 @@ class OpBlockwiseObjectClassification( Operator ):
     SelectedFeatures = InputSlot(rtype=List, stype=Opaque)
     BlockShape3dDict = InputSlot( value={'x' : 512, 'y' : 512, 'z' : 512} ) # A dict of SPATIAL block dims
     HaloPadding3dDict = InputSlot( value={'x' : 64, 'y' : 64, 'z' : 64} ) # A dict of spatial block dims
+    InflightMemoryMb = InputSlot( value=0 ) # Memory for blocks that are computed in parallel (0: half of the available RAM)
+    PipelineMemoryMb = InputSlot( value=0 ) # Memory for the block pipelines that are kept alive (0: a quarter of the total RAM)
+    StitchObjects = InputSlot( value=False ) # Classify objects that span several blocks as a whole (see above)
 
     PredictionImage = OutputSlot()
     BlockwiseRegionFeatures = OutputSlot()
     
     def __init__(self, *args, **kwargs):
         super( self.__class__, self ).__init__(*args, **kwargs)
-        self._blockPipelines = {} # indexed by blockstart
+        self._blockPipelines = collections.OrderedDict() # indexed by blockstart, least recently used first
+        self._pipelineUsers = collections.defaultdict(int) # Number of requests that are using each pipeline
+        self._processedBlocks = set()
+        self._maxPipelines = None
         self._lock = RequestLock()
+        self.pipelineStats = { 'created' : 0, 'evicted' : 0, 'reused' : 0 }
+
+        self._opStitchedPredictionImage = None # Created on demand (see _createStitchedPipeline)
         
     def setupOutputs(self):
         # Check for preconditions.
@@ -247,6 +267,20 @@ class OpBlockwiseObjectClassification( Operator ):
         self.BlockwiseRegionFeatures.meta.shape = tuple(region_feature_output_shape)
         self.BlockwiseRegionFeatures.meta.dtype = object
         self.BlockwiseRegionFeatures.meta.axistags = self.PredictionImage.meta.axistags
+
+        # Limit the number of block pipelines we keep alive
+        pipeline_memory_mb = self.PipelineMemoryMb.value
+        if not pipeline_memory_mb:
+            pipeline_memory_mb = psutil.virtual_memory().total / 4e6
+        self._maxPipelines = int( max( 1, pipeline_memory_mb // self._estimateBlockMemoryMb() ) )
+
+        if self.StitchObjects.value:
+            if self._opStitchedPredictionImage is None:
+                self._createStitchedPipeline()
+            else:
+                self._opStitchedFeatures.TileShape.setValue( [ self._block_shape_dict[k] for k in 'xyz' ] )
+        elif self._opStitchedPredictionImage is not None:
+            self._deleteStitchedPipeline()
         
     def execute(self, slot, subindex, roi, destination):
         if slot == self.PredictionImage:
@@ -257,19 +291,41 @@ class OpBlockwiseObjectClassification( Operator ):
             assert False, "Unknown output slot: {}".format( slot.name )
 
     def _executePredictionImage(self, roi, destination):
+        if self.StitchObjects.value:
+            return self._opStitchedPredictionImage.Output( roi.start, roi.stop ).writeInto( destination ).wait()
+
         # Determine intersecting blocks
         block_shape = self._getFullShape( self.BlockShape3dDict.value )
         block_starts = getIntersectingBlocks( block_shape, (roi.start, roi.stop) )
         block_starts = map( tuple, block_starts )
 
-        # Ensure that block pipelines exist (create first if necessary)
-        for block_start in block_starts:
-            self._ensurePipelineExists(block_start)
+        # Retrieve the blocks in parallel, but with a bounded number of blocks in flight:
+        #  each block pulls its own halo-padded raw and binary volume.
+        # Each worker takes the next block from the queue until all blocks are done.
+        block_queue = collections.deque( block_starts )
+        def process_blocks():
+            while True:
+                try:
+                    block_start = block_queue.popleft()
+                except IndexError:
+                    return
+                self._copyBlockPrediction( block_start, roi, destination )
+
+        num_workers = min( len(block_starts), self._getMaxInflightBlocks() )
+        logger.debug( "Computing {} blocks with {} in flight".format( len(block_starts), num_workers ) )
+        pool = RequestPool()
+        for _ in range( num_workers ):
+            pool.add( Request( process_blocks ) )
+        pool.wait()
 
-        # Retrieve result from each block, and write into the appropriate region of the destination
-        # TODO: Parallelize this loop
-        for block_start in block_starts:
-            opBlockPipeline = self._blockPipelines[block_start]
+        return destination
+
+    def _copyBlockPrediction(self, block_start, roi, destination):
+        """
+        Write the part of the given block that intersects the roi into the appropriate region of the destination.
+        """
+        opBlockPipeline = self._acquirePipeline( block_start )
+        try:
             block_roi = opBlockPipeline.block_roi
             block_intersection = getIntersection( block_roi, (roi.start, roi.stop) )
             block_relative_intersection = numpy.subtract(block_intersection, block_roi[0])
@@ -279,8 +335,40 @@ class OpBlockwiseObjectClassification( Operator ):
             req = opBlockPipeline.PredictionImage( *block_relative_intersection )
             req.writeInto( destination[destination_slice] )
             req.wait()
+        finally:
+            self._releasePipeline( block_start )
 
-        return destination
+    def _getMaxInflightBlocks(self):
+        """
+        Number of blocks that may be computed at the same time:
+        Limited by the number of worker threads and by the memory that a block pipeline needs.
+        """
+        num_threads = max( 1, Request.global_thread_pool.num_workers )
+
+        memory_mb = self.InflightMemoryMb.value
+        if not memory_mb:
+            memory_mb = psutil.virtual_memory().available / 2e6
+
+        block_mb = self._estimateBlockMemoryMb()
+        return int( max( 1, min( num_threads, memory_mb // block_mb ) ) )
+
+    def _estimateBlockMemoryMb(self):
+        """
+        Rough estimate of the memory needed to compute one block: the halo-padded raw
+        and binary volumes plus the label image and the prediction image of the block pipeline.
+        """
+        block_shape = numpy.array( self._getFullShape( self._block_shape_dict ) )
+        halo_padding = numpy.array( self._getFullShape( self._halo_padding_dict ) )
+        halo_shape = numpy.minimum( block_shape + 2*halo_padding, self.RawImage.meta.shape )
+        c_index = self.RawImage.meta.getAxisKeys().index('c')
+        halo_shape[c_index] = 1
+        halo_pixels = numpy.prod( halo_shape )
+
+        raw_bytes = numpy.dtype( self.RawImage.meta.dtype ).itemsize * self.RawImage.meta.shape[c_index]
+        binary_bytes = numpy.dtype( self.BinaryImage.meta.dtype ).itemsize
+        label_bytes = 4 # Connected components (uint32)
+        prediction_bytes = 1
+        return max( 1.0, halo_pixels * ( raw_bytes + binary_bytes + label_bytes + prediction_bytes ) / 1e6 )
 
     def _executeBlockwiseRegionFeatures(self, roi, destination):
         """
@@ -290,7 +378,8 @@ class OpBlockwiseObjectClassification( Operator ):
                    (1,20,30,40,5) should be requested via roi [(1,2,3,4,5),(2,3,4,5,6)]
         
         Note: It is assumed that you will request these features for debug purposes, AFTER requesting the prediction image.
-              Therefore, it is considered an error to request features that are not already computed.
+              Therefore, it is considered an error to request features for blocks that haven't been processed yet.
+              (If the pipeline of a processed block has been evicted in the meantime, its features are recomputed.)
         """
         axiskeys = self.RawImage.meta.getAxisKeys()
         # Find the corresponding block start coordinates
@@ -300,7 +389,13 @@ class OpBlockwiseObjectClassification( Operator ):
         block_starts = map( tuple, block_starts )
         
         for block_start in block_starts:
-            assert block_start in self._blockPipelines, "Not allowed to request region features for blocks that haven't yet been processed." # See note above
+            if self.StitchObjects.value:
+                destination_start = numpy.array(block_start) / block_shape - roi.start
+                destination_stop = destination_start + numpy.array( [1]*len(axiskeys) )
+                destination[ roiToSlice( destination_start, destination_stop ) ] = self._getOwnedRegionFeatures( block_start, block_shape )
+                continue
+
+            assert block_start in self._processedBlocks, "Not allowed to request region features for blocks that haven't yet been processed." # See note above
 
             # Discard spatial axes to get (t,c) index for region slot roi
             tagged_block_start = zip( axiskeys, block_start )
@@ -311,41 +406,147 @@ class OpBlockwiseObjectClassification( Operator ):
             destination_start = numpy.array(block_start) / block_shape - roi.start
             destination_stop = destination_start + numpy.array( [1]*len(axiskeys) )
 
-            opBlockPipeline = self._blockPipelines[block_start]
-            req = opBlockPipeline.BlockwiseRegionFeatures( *block_roi_tc )
-            req.writeInto( destination[ roiToSlice( destination_start, destination_stop ) ] )
-            req.wait()
+            opBlockPipeline = self._acquirePipeline( block_start )
+            try:
+                req = opBlockPipeline.BlockwiseRegionFeatures( *block_roi_tc )
+                req.writeInto( destination[ roiToSlice( destination_start, destination_stop ) ] )
+                req.wait()
+            finally:
+                self._releasePipeline( block_start )
         
         return destination
 
-    def _ensurePipelineExists(self, block_start):
-        if block_start in self._blockPipelines:
-            return
+    def _createStitchedPipeline(self):
+        # BinaryImage --> opGlobalLabels ---------------------------------------------------------
+        #                               \                                                         \
+        # RawImage -----------------------> opStitchedFeatures --> opStitchedFeaturesList --> opStitchedPredict --> opStitchedPredictionImage
+        #                               /
+        # SelectedFeatures -------------
+        logger.debug( "Creating stitched pipeline" )
+        self._opGlobalLabels = OpBlockwiseConnectedComponents( parent=self )
+        self._opGlobalLabels.Input.connect( self.BinaryImage )
+        self._opGlobalLabels.BlockShape.connect( self.BlockShape3dDict )
+
+        # Features are accumulated over tiles of the block shape (if the selected features allow it)
+        self._opStitchedFeatures = OpCachedRegionFeatures( parent=self )
+        self._opStitchedFeatures.RawImage.connect( self.RawImage )
+        self._opStitchedFeatures.LabelImage.connect( self._opGlobalLabels.Output )
+        self._opStitchedFeatures.Features.connect( self.SelectedFeatures )
+        self._opStitchedFeatures.TileShape.setValue( [ self._block_shape_dict[k] for k in 'xyz' ] )
+
+        self._opStitchedFeaturesList = OpAdaptTimeListRoi( parent=self )
+        self._opStitchedFeaturesList.Input.connect( self._opStitchedFeatures.Output )
+
+        self._opStitchedPredict = OpObjectPredict( parent=self )
+        self._opStitchedPredict.Features.connect( self._opStitchedFeaturesList.Output )
+        self._opStitchedPredict.SelectedFeatures.connect( self.SelectedFeatures )
+        self._opStitchedPredict.Classifier.connect( self.Classifier )
+        self._opStitchedPredict.LabelsCount.connect( self.LabelsCount )
+
+        self._opStitchedPredictionImage = OpRelabelSegmentation( parent=self )
+        self._opStitchedPredictionImage.Image.connect( self._opGlobalLabels.Output )
+        self._opStitchedPredictionImage.Features.connect( self._opStitchedFeaturesList.Output )
+        self._opStitchedPredictionImage.ObjectMap.connect( self._opStitchedPredict.Predictions )
+        self._opStitchedPredictionImage.Output.notifyDirty( self._handleDirtyStitchedPrediction )
+
+    def _deleteStitchedPipeline(self):
+        logger.debug( "Deleting stitched pipeline" )
+        for op in [ self._opStitchedPredictionImage, self._opStitchedPredict, self._opStitchedFeaturesList,
+                    self._opStitchedFeatures, self._opGlobalLabels ]:
+            op.cleanUp()
+        self._opStitchedPredictionImage = None
+
+    def _getOwnedRegionFeatures(self, block_start, block_shape):
+        """
+        In stitched mode, return the region features of the objects that are owned by the given block.
+        Each object is owned by exactly one block: the block that contains its minimum coordinate.
+        (Row 0 is the background, as usual.)
+        """
+        axiskeys = self.RawImage.meta.getAxisKeys()
+        t = block_start[ axiskeys.index('t') ] if 't' in axiskeys else 0
+        features = self._opStitchedFeaturesList.Output( [t] ).wait()[t]
+
+        mincoords = numpy.asarray( features[default_features_key]['Coord<Minimum>'] ).astype( numpy.int64 )
+        coord_keys = coordinate_axes( self._opGlobalLabels.Output.meta.getTaggedShape() )
+        assert len( coord_keys ) == mincoords.shape[1], \
+            "Coordinates for axes {} don't match features with {} columns".format( coord_keys, mincoords.shape[1] )
+        owned = numpy.ones( (mincoords.shape[0],), dtype=bool )
+        for i, k in enumerate( coord_keys ):
+            axis = axiskeys.index(k)
+            owned &= ( mincoords[:, i] // block_shape[axis] ) * block_shape[axis] == block_start[axis]
+        owned[0] = True
+
+        owned_features = {}
+        for plugin_name, plugin_features in features.items():
+            owned_features[plugin_name] = dict( ( name, numpy.asarray(values)[owned] )
+                                                for name, values in plugin_features.items() )
+        return owned_features
+
+    def _acquirePipeline(self, block_start):
+        """
+        Return the pipeline for the given block (create it first if necessary).
+        The pipeline won't be evicted until the caller calls _releasePipeline().
+        """
         with self._lock:
-            if block_start in self._blockPipelines:
-                return
+            opBlockPipeline = self._blockPipelines.pop( block_start, None )
+            if opBlockPipeline is None:
+                opBlockPipeline = self._createPipeline( block_start )
+                self.pipelineStats['created'] += 1
+            else:
+                self.pipelineStats['reused'] += 1
 
-            logger.debug( "Creating pipeline for block: {}".format( block_start ) )
+            # Mark as most recently used
+            self._blockPipelines[block_start] = opBlockPipeline
+            self._pipelineUsers[block_start] += 1
+            self._processedBlocks.add( block_start )
+            self._evictPipelines()
+            return opBlockPipeline
 
-            block_shape = self._getFullShape( self._block_shape_dict )
-            halo_padding = self._getFullShape( self._halo_padding_dict )
+    def _releasePipeline(self, block_start):
+        with self._lock:
+            self._pipelineUsers[block_start] -= 1
+            if self._pipelineUsers[block_start] == 0:
+                del self._pipelineUsers[block_start]
+            self._evictPipelines()
 
-            input_shape = self.RawImage.meta.shape
-            block_stop = getBlockBounds( input_shape, block_shape, block_start )[1]
-            block_roi = (block_start, block_stop)
+    def _evictPipelines(self):
+        """
+        Clean up the least recently used pipelines until we are within our budget.
+        Pipelines that are currently in use are skipped.
+        Must be called with self._lock held.
+        """
+        if self._maxPipelines is None or len(self._blockPipelines) <= self._maxPipelines:
+            return
+        for block_start in list( self._blockPipelines.keys() ):
+            if len(self._blockPipelines) <= self._maxPipelines:
+                break
+            if block_start in self._pipelineUsers:
+                continue
+            logger.debug( "Evicting pipeline for block: {}".format( block_start ) )
+            self._blockPipelines.pop( block_start ).cleanUp()
+            self.pipelineStats['evicted'] += 1
+
+    def _createPipeline(self, block_start):
+        logger.debug( "Creating pipeline for block: {}".format( block_start ) )
 
-            # Instantiate pipeline
-            opBlockPipeline = OpSingleBlockObjectPrediction( block_roi, halo_padding, parent=self )
-            opBlockPipeline.RawImage.connect( self.RawImage )
-            opBlockPipeline.BinaryImage.connect( self.BinaryImage )
-            opBlockPipeline.Classifier.connect( self.Classifier )
-            opBlockPipeline.LabelsCount.connect( self.LabelsCount )
-            opBlockPipeline.SelectedFeatures.connect( self.SelectedFeatures )
+        block_shape = self._getFullShape( self._block_shape_dict )
+        halo_padding = self._getFullShape( self._halo_padding_dict )
 
-            # Forward dirtyness
-            opBlockPipeline.PredictionImage.notifyDirty( bind(self._handleDirtyBlock, block_start ) )
-            
-            self._blockPipelines[block_start] = opBlockPipeline
+        input_shape = self.RawImage.meta.shape
+        block_stop = getBlockBounds( input_shape, block_shape, block_start )[1]
+        block_roi = (block_start, block_stop)
+
+        # Instantiate pipeline
+        opBlockPipeline = OpSingleBlockObjectPrediction( block_roi, halo_padding, parent=self )
+        opBlockPipeline.RawImage.connect( self.RawImage )
+        opBlockPipeline.BinaryImage.connect( self.BinaryImage )
+        opBlockPipeline.Classifier.connect( self.Classifier )
+        opBlockPipeline.LabelsCount.connect( self.LabelsCount )
+        opBlockPipeline.SelectedFeatures.connect( self.SelectedFeatures )
+
+        # Forward dirtyness
+        opBlockPipeline.PredictionImage.notifyDirty( bind(self._handleDirtyBlock, block_start ) )
+        return opBlockPipeline
 
     
     def _getFullShape(self, spatialShapeDict):
@@ -370,7 +571,8 @@ class OpBlockwiseObjectClassification( Operator ):
     def _deleteAllPipelines(self):
         logger.debug("Deleting all pipelines.")
         oldBlockPipelines = self._blockPipelines
-        self._blockPipelines = {}
+        self._blockPipelines = collections.OrderedDict()
+        self._processedBlocks = set()
         with self._lock:
             for opBlockPipeline in oldBlockPipelines.values():
                 opBlockPipeline.cleanUp()
@@ -380,8 +582,40 @@ class OpBlockwiseObjectClassification( Operator ):
         if slot == self.BlockShape3dDict or slot == self.HaloPadding3dDict:
             self._deleteAllPipelines()
             self.PredictionImage.setDirty( slice(None) )
+        elif slot == self.StitchObjects:
+            self.PredictionImage.setDirty( slice(None) )
+        elif slot in (self.InflightMemoryMb, self.PipelineMemoryMb):
+            pass
+        elif self.pipelineStats['evicted'] > 0:
+            # Evicted pipelines can't forward the dirty notifications for their blocks anymore.
+            if slot == self.RawImage or slot == self.BinaryImage:
+                self._setDirtyBlocksWithHalo( roi )
+            else:
+                self.PredictionImage.setDirty( slice(None) )
+
+    def _setDirtyBlocksWithHalo(self, roi):
+        """
+        Mark all blocks whose halo intersects the given input roi as dirty.
+        """
+        shape = self.PredictionImage.meta.shape
+        c_index = self.RawImage.meta.getAxisKeys().index('c')
+        block_shape = numpy.array( self._getFullShape( self._block_shape_dict ) )
+        halo_padding = numpy.array( self._getFullShape( self._halo_padding_dict ) )
+
+        start = numpy.maximum( numpy.array(roi.start) - halo_padding, 0 )
+        stop = numpy.minimum( numpy.array(roi.stop) + halo_padding, shape )
+        start[c_index] = 0
+        stop[c_index] = 1
+
+        # Expand to the block boundaries
+        start = (start // block_shape) * block_shape
+        stop = numpy.minimum( ( (stop + block_shape - 1) // block_shape ) * block_shape, shape )
+        self.PredictionImage.setDirty( start, stop )
     
     
+    def _handleDirtyStitchedPrediction(self, slot, roi):
+        self.PredictionImage.setDirty( roi.start, roi.stop )
+
     def _handleDirtyBlock(self, block_start, slot, roi):
         # Convert roi from block coords to global coords
         block_relative_roi = (roi.start, roi.stop)
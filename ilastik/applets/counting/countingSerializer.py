@@ -207,6 +207,9 @@ class CountingSerializer(AppletSerializer):
     workflow parameters and datasets.
 
     """
+    # Batch prediction only needs the trained regressors, not the labels, boxes or cached predictions.
+    loadProfiles = { 'prediction' : ['LabelNames', 'LabelColors', 'PmapColors', 'CountingWrappers'] }
+
     def __init__(self, operator, projectFileGroupName):
         self.predictionSlot = SerialPredictionSlot(operator.PredictionProbabilities,
                                                    operator,
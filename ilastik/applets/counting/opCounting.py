@@ -31,7 +31,7 @@ from lazyflow.operators import OpBlockedSparseLabelArray, OpValueCache, \
                                OpPrecomputedInput, OpPixelOperator, OpMaxChannelIndicatorOperator, \
                                Op5ifyer
 from lazyflow.request import Request, RequestPool
-from lazyflow.roi     import roiToSlice, sliceToRoi
+from lazyflow.roi     import roiToSlice, sliceToRoi, getIntersectingBlocks
                                
 from ilastik.applets.counting.countingOperators import OpTrainCounter, OpPredictCounter, OpLabelPreviewer
 
@@ -60,47 +60,68 @@ class OpVolumeOperator(Operator):
         self.outputs["Output"].setDirty((slice(0,1,None),))
         self.cache = None
         self._lock = threading.Lock()
+        # Protects _dirtyBlocks and cache.  Unlike _lock, it is not held while computing.
+        self._dirtyLock = threading.Lock()
 
+        # The result of each block is kept, so that only the dirty blocks are recomputed
+        self._fullBlockShape = numpy.array([self.blockShape.value for i in self.Input.meta.shape])
+        numBlocks = numpy.ceil(self.Input.meta.shape/(1.0*self._fullBlockShape)).astype("int")
+        self._blockCache = numpy.zeros(numBlocks, dtype=self.Output.meta.dtype)
+        self._dirtyBlocks = numpy.ones(numBlocks, dtype=bool)
 
     def execute(self, slot, subindex, roi, result):
         with self._lock:
             if self.cache is None:
-                fullBlockShape = numpy.array([self.blockShape.value for i in self.Input.meta.shape])
                 fun = self.inputs["Function"].value
-                #data = self.inputs["Input"][:].wait()
-                #split up requests into blocks
                 shape = self.Input.meta.shape
-                numBlocks = numpy.ceil(shape/(1.0*fullBlockShape)).astype("int")
-                blockCache = numpy.ndarray(shape = numpy.prod(numBlocks), dtype=self.Output.meta.dtype)
-                pool = RequestPool()
-                #blocks holds the different roi keys for each of the blocks
-                blocks = itertools.product(*[range(i) for i in numBlocks])
-                blockKeys = []
-                for b in blocks:
-                    start = b * fullBlockShape
-                    stop = b * fullBlockShape + fullBlockShape
-                    stop = numpy.min(numpy.vstack((stop, shape)), axis=0)
-                    blockKey = roiToSlice(start, stop)
-                    blockKeys.append(blockKey)
-                
-                def predict_block(i):
-                    data = self.Input[blockKeys[i]].wait()
-                    blockCache[i] = fun(data)
-                    
-                for i,f in enumerate(blockCache):
-                    req = pool.request(partial(predict_block,i))
+                # Blocks that become dirty while we compute are marked again by propagateDirty
+                with self._dirtyLock:
+                    blocks = numpy.transpose(numpy.nonzero(self._dirtyBlocks))
+                    self._dirtyBlocks[:] = False
 
-                pool.wait()
-                pool.clean()
+                def predict_block(block):
+                    start = block * self._fullBlockShape
+                    stop = numpy.minimum(start + self._fullBlockShape, shape)
+                    data = self.Input[roiToSlice(start, stop)].wait()
+                    self._blockCache[tuple(block)] = fun(data)
 
-                self.cache = [fun(blockCache)]
+                pool = RequestPool()
+                for block in blocks:
+                    req = pool.request(partial(predict_block, block))
+
+                try:
+                    pool.wait()
+                except:
+                    with self._dirtyLock:
+                        self._dirtyBlocks[tuple(blocks.transpose())] = True
+                    raise
+                finally:
+                    pool.clean()
+
+                total = [fun(self._blockCache.reshape(-1))]
+                with self._dirtyLock:
+                    # Don't keep the result if a block became dirty in the meantime
+                    if not self._dirtyBlocks.any():
+                        self.cache = total
+                return total
             return self.cache
 
     def propagateDirty(self, slot, subindex, roi):
-        key = roi.toSlice()
+        if not self.Output.ready():
+            self.cache = None
+            return
+        # execute() only stores its result if no block is dirty (under the same lock),
+        # so a result that misses these blocks can't be kept.
+        with self._dirtyLock:
+            if slot == self.Input:
+                blockStarts = getIntersectingBlocks(self._fullBlockShape, (roi.start, roi.stop))
+                blocks = numpy.asarray(blockStarts, dtype=int).reshape(-1, len(self._fullBlockShape)) // self._fullBlockShape
+                self._dirtyBlocks[tuple(blocks.transpose())] = True
+            else:
+                self._dirtyBlocks[...] = True
+            self.cache = None
         if slot == self.Input or slot == self.Function:
             self.outputs["Output"].setDirty( slice(None) )
-        self.cache = None
 
 class OpUpperBound(Operator):
     name = "OpUpperBound"
@@ -0,0 +1,316 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+#Python
+import os
+import errno
+import hashlib
+import tempfile
+import threading
+import logging
+from functools import partial
+
+#SciPy
+import numpy
+
+#lazyflow
+from lazyflow.graph import Operator, InputSlot, OutputSlot
+from lazyflow.request import Request, RequestPool
+from lazyflow.roi import getIntersectingBlocks, getBlockBounds, getIntersection, roiToSlice
+
+from ilastik.config import cfg as ilastik_config
+
+logger = logging.getLogger(__name__)
+
+class FeatureBlockStore(object):
+    """
+    A directory of feature blocks, stored as .npy files named by their key.
+
+    The store can be shared by several processes (e.g. a GUI session and
+    cluster workers).  Blocks are written to a temporary file first and
+    then renamed, so readers never see partially written blocks.
+
+    If the files in the directory exceed maxBytes, the least recently
+    used blocks are deleted.  Reading a block updates its mtime.
+    """
+    # After eviction, the store is this fraction of maxBytes
+    EVICTION_TARGET = 0.8
+
+    def __init__(self, directory, maxBytes):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self._lock = threading.Lock()
+        self._totalBytes = None # Not known until the first scan
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Return the stored block for the given key, or None.
+        """
+        path = self._path(key)
+        try:
+            data = numpy.load(path)
+            os.utime(path, None)
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+        except ValueError:
+            # Corrupt file, e.g. left over from a crashed process that didn't use our rename protocol.
+            logger.warn( "Removing corrupt feature cache file: {}".format( path ) )
+            self._remove(path)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise
+
+        fd, tmpPath = tempfile.mkstemp( dir=directory, suffix='.tmp' )
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                numpy.save(f, data)
+            os.rename(tmpPath, path)
+        except:
+            self._remove(tmpPath)
+            raise
+
+        with self._lock:
+            if self._totalBytes is None:
+                self._totalBytes = self._scan()[0]
+            else:
+                self._totalBytes += os.path.getsize(path)
+            if self._totalBytes > self.maxBytes:
+                self._evict()
+
+    def _evict(self):
+        # Other processes may have added or removed files, so we always rescan here.
+        totalBytes, files = self._scan()
+        files.sort()
+        targetBytes = self.EVICTION_TARGET * self.maxBytes
+        numRemoved = 0
+        for mtime, size, path in files:
+            if totalBytes <= targetBytes:
+                break
+            if self._remove(path):
+                totalBytes -= size
+                numRemoved += 1
+        logger.debug( "Feature cache: evicted {} blocks, {} MB left".format( numRemoved, totalBytes / (1000*1000) ) )
+        self._totalBytes = totalBytes
+
+    def _scan(self):
+        """
+        Return the total size of all blocks and a list of (mtime, size, path) for each block.
+        """
+        totalBytes = 0
+        files = []
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if not filename.endswith('.npy'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                totalBytes += st.st_size
+                files.append( (st.st_mtime, st.st_size, path) )
+        return totalBytes, files
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.npy')
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+_stores = {}
+_storesLock = threading.Lock()
+
+def getFeatureBlockStore():
+    """
+    Return the process-wide feature store configured in the [ilastik] section of
+    ~/.ilastikrc (feature_cache_directory, feature_cache_max_mb), or None if
+    the on-disk feature cache is disabled.
+    """
+    directory = ilastik_config.get("ilastik", "feature_cache_directory").strip()
+    if not directory:
+        return None
+    directory = os.path.abspath( os.path.expanduser(directory) )
+    maxBytes = ilastik_config.getint("ilastik", "feature_cache_max_mb") * 1000*1000
+    with _storesLock:
+        if directory not in _stores:
+            _stores[directory] = FeatureBlockStore(directory, maxBytes)
+        return _stores[directory]
+
+class OpFeatureDiskCache(Operator):
+    """
+    Stores the feature image blockwise in a FeatureBlockStore and reads
+    it from there when the same features are requested again, in this
+    or any later run.
+
+    Each feature layer (feature and scale) of a block is stored separately,
+    keyed by the layer's identity and the raw data it was computed from.
+    The raw data is included with a halo that covers the filter support, so
+    a block is reused exactly when recomputing it would give the same result,
+    no matter which dataset or project it came from.
+    """
+    RawImage = InputSlot()
+    Input = InputSlot() # The feature image
+    LayerKeys = InputSlot() # A list of (key, scale, numChannels), one entry per feature layer, in channel order
+    BlockShape = InputSlot() # Spatial block shape in the axis order of the input.  The channel entry is ignored.
+
+    Output = OutputSlot()
+
+    # Halo size (in units of the feature scale) that covers the support of all features,
+    #  including the presmoothing and the outer scale of the structure tensor
+    HALO_PER_SCALE = 6.0
+
+    def __init__(self, store, *args, **kwargs):
+        super( OpFeatureDiskCache, self ).__init__( *args, **kwargs )
+        self._store = store
+
+    def setupOutputs(self):
+        self.Output.meta.assignFrom( self.Input.meta )
+        assert len(self.RawImage.meta.shape) == len(self.Input.meta.shape), \
+            "Raw image and feature image must have the same axes"
+        layerChannels = [ numChannels for key, scale, numChannels in self.LayerKeys.value ]
+        assert sum(layerChannels) == self.Input.meta.shape[self._channelIndex()], \
+            "Feature layers don't match the channels of the feature image"
+        self._layerOffsets = numpy.cumsum( [0] + layerChannels )
+
+    def execute(self, slot, subindex, roi, result):
+        channelIndex = self._channelIndex()
+        blockShape = list(self.BlockShape.value)
+        blockShape[channelIndex] = self.Input.meta.shape[channelIndex]
+        blockShape = numpy.minimum( blockShape, self.Input.meta.shape )
+
+        start = numpy.array( roi.start )
+        stop = numpy.array( roi.stop )
+        blockStarts = getIntersectingBlocks( blockShape, (start, stop) )
+
+        pool = RequestPool()
+        for blockStart in blockStarts:
+            blockRoi = getBlockBounds( self.Input.meta.shape, blockShape, blockStart )
+            pool.add( Request( partial( self._copyBlock, blockRoi, (start, stop), result ) ) )
+        pool.wait()
+        return result
+
+    def _copyBlock(self, blockRoi, requestRoi, result):
+        """
+        Copy the requested part of one block into the result,
+        reading its layers from the store or computing them.
+        """
+        channelIndex = self._channelIndex()
+        intersection = getIntersection( blockRoi, requestRoi )
+        firstChannel, lastChannel = intersection[0][channelIndex], intersection[1][channelIndex]
+
+        layerKeys = self.LayerKeys.value
+        layers = [ i for i in range(len(layerKeys))
+                   if self._layerOffsets[i] < lastChannel and self._layerOffsets[i+1] > firstChannel ]
+
+        rawDigests = {}
+        layerData = {}
+        missing = []
+        for i in layers:
+            key, scale, numChannels = layerKeys[i]
+            if scale not in rawDigests:
+                rawDigests[scale] = self._rawDigest( blockRoi, scale )
+            blockKey = self._blockKey( key, rawDigests[scale] )
+            data = self._store.get( blockKey )
+            if data is None:
+                missing.append( (i, blockKey) )
+            else:
+                layerData[i] = data
+
+        if missing:
+            # Compute all missing layers with a single request, so the feature operator can share the presmoothing.
+            computeStart = numpy.array( blockRoi[0] )
+            computeStop = numpy.array( blockRoi[1] )
+            computeStart[channelIndex] = self._layerOffsets[ missing[0][0] ]
+            computeStop[channelIndex] = self._layerOffsets[ missing[-1][0] + 1 ]
+            computed = self.Input( computeStart, computeStop ).wait()
+            for i, blockKey in missing:
+                channelSlicing = [slice(None)] * computed.ndim
+                channelSlicing[channelIndex] = slice( self._layerOffsets[i] - computeStart[channelIndex],
+                                                      self._layerOffsets[i+1] - computeStart[channelIndex] )
+                layerData[i] = computed[channelSlicing]
+                self._store.put( blockKey, layerData[i] )
+
+        for i in layers:
+            # Intersect the requested roi with this layer's part of the block
+            layerStart = numpy.array( intersection[0] )
+            layerStop = numpy.array( intersection[1] )
+            layerStart[channelIndex] = max( layerStart[channelIndex], self._layerOffsets[i] )
+            layerStop[channelIndex] = min( layerStop[channelIndex], self._layerOffsets[i+1] )
+
+            sourceOffset = numpy.array( blockRoi[0] )
+            sourceOffset[channelIndex] = self._layerOffsets[i]
+            source = layerData[i][ roiToSlice( layerStart - sourceOffset, layerStop - sourceOffset ) ]
+            result[ roiToSlice( layerStart - requestRoi[0], layerStop - requestRoi[0] ) ] = source
+
+    def _rawDigest(self, blockRoi, scale):
+        """
+        Hash the raw data that the features of this block (at the given scale) depend on.
+        """
+        channelIndex = self._channelIndex()
+        rawShape = numpy.array( self.RawImage.meta.shape )
+        halo = int( numpy.ceil( self.HALO_PER_SCALE * scale ) )
+        haloStart = numpy.maximum( numpy.array( blockRoi[0] ) - halo, 0 )
+        haloStop = numpy.minimum( numpy.array( blockRoi[1] ) + halo, rawShape )
+        haloStart[channelIndex] = 0
+        haloStop[channelIndex] = rawShape[channelIndex]
+        # Time slices are computed independently
+        tagged = self.RawImage.meta.getTaggedShape()
+        if 't' in tagged:
+            timeIndex = tagged.keys().index('t')
+            haloStart[timeIndex] = blockRoi[0][timeIndex]
+            haloStop[timeIndex] = blockRoi[1][timeIndex]
+
+        raw = self.RawImage( haloStart, haloStop ).wait()
+        sha = hashlib.sha1()
+        sha.update( str( numpy.dtype(raw.dtype) ) )
+        # The position of the block within the halo matters (e.g. at the dataset border)
+        sha.update( str( ( tuple(raw.shape), tuple( numpy.array(blockRoi[0]) - haloStart ), tuple( numpy.array(blockRoi[1]) - haloStart ) ) ) )
+        sha.update( numpy.ascontiguousarray(raw).data )
+        return sha.hexdigest()
+
+    @staticmethod
+    def _blockKey(layerKey, rawDigest):
+        sha = hashlib.sha1()
+        sha.update( layerKey )
+        sha.update( rawDigest )
+        return sha.hexdigest()
+
+    def _channelIndex(self):
+        return self.Input.meta.getTaggedShape().keys().index('c')
+
+    def propagateDirty(self, slot, subindex, roi):
+        if slot == self.Input:
+            self.Output.setDirty( roi.start, roi.stop )
+        else:
+            self.Output.setDirty( slice(None) )
@@ -31,6 +31,7 @@ from lazyflow.operators import OpPixelFeaturesInterpPresmoothed as OpPixelFeatur
 from lazyflow.operators.imgFilterOperators import OpPixelFeaturesPresmoothed as OpPixelFeaturesPresmoothed_Refactored
 
 from ilastik.applets.base.applet import DatasetConstraintError
+from opFeatureDiskCache import OpFeatureDiskCache, getFeatureBlockStore
 
 logger = logging.getLogger(__name__)
 
@@ -64,9 +65,13 @@ class OpFeatureSelectionNoCache(Operator):
     # For ease of development and testing, the underlying feature computation implementation 
     #  can be switched via a constructor argument.  These are the possible choices.
     FilterImplementations = ['Original', 'Refactored', 'Interpolated']
+
+    # Block shape of the on-disk feature cache (if enabled, see opFeatureDiskCache.getFeatureBlockStore)
+    DiskCacheBlockDims = { 't' : 1, 'z' : 64, 'y' : 256, 'x' : 256, 'c' : 1 }
     
     def __init__(self, filter_implementation, *args, **kwargs):
         super(OpFeatureSelectionNoCache, self).__init__(*args, **kwargs)
+        self._filterImplementation = filter_implementation
 
         # Create the operator that actually generates the features
         if filter_implementation == 'Original':
@@ -89,6 +94,16 @@ class OpFeatureSelectionNoCache(Operator):
         #  check it for errors (See setupOutputs)
         # self.opPixelFeatures.SelectionMatrix.connect( self.SelectionMatrix )
 
+        # Optionally, read/write the features from/to a persistent store that is shared across runs
+        self.opFeatureDiskCache = None
+        self._featureOutput = self.opPixelFeatures.Output
+        store = getFeatureBlockStore()
+        if store is not None:
+            self.opFeatureDiskCache = OpFeatureDiskCache( store, parent=self )
+            self.opFeatureDiskCache.RawImage.connect( self.InputImage )
+            self.opFeatureDiskCache.Input.connect( self.opPixelFeatures.Output )
+            self._featureOutput = self.opFeatureDiskCache.Output
+
     def setupOutputs(self):
         if self.FeatureListFilename.ready() and len(self.FeatureListFilename.value) > 0:
             f = open(self.FeatureListFilename.value, 'r')
@@ -133,10 +148,33 @@ class OpFeatureSelectionNoCache(Operator):
                       "The invalid scales are: {}".format( invalid_scales )                      
                 raise DatasetConstraintError( "Feature Selection", msg )
             
+            if self.opFeatureDiskCache is not None:
+                self._configureDiskCache()
+
             # Connect our external outputs to our internal operators
-            self.OutputImage.connect( self.opPixelFeatures.Output )
+            self.OutputImage.connect( self._featureOutput )
             self.FeatureLayers.connect( self.opPixelFeatures.Features )
 
+    def _configureDiskCache(self):
+        # Each feature layer is identified by its description (feature name and scale)
+        layerKeys = []
+        for layerSlot, scale in zip( self.opPixelFeatures.Features, self._selectedScales() ):
+            key = "{} {} {}".format( self._filterImplementation, layerSlot.meta.description, numpy.dtype(layerSlot.meta.dtype).name )
+            layerKeys.append( (key, scale, layerSlot.meta.getTaggedShape()['c']) )
+        self.opFeatureDiskCache.LayerKeys.setValue( layerKeys )
+
+        axisOrder = [ tag.key for tag in self.InputImage.meta.axistags ]
+        self.opFeatureDiskCache.BlockShape.setValue( tuple( self.DiskCacheBlockDims[k] for k in axisOrder ) )
+
+    def _selectedScales(self):
+        """
+        The scale of each feature layer, in the order of the feature channels.
+        """
+        selections = self.SelectionMatrix.value
+        scales = self.Scales.value
+        return [ scales[j] for i in range( selections.shape[0] )
+                           for j in range( selections.shape[1] ) if selections[i,j] ]
+
     def propagateDirty(self, slot, subindex, roi):
         # Output slots are directly connected to internal operators
         pass
@@ -187,7 +225,7 @@ class OpFeatureSelection( OpFeatureSelectionNoCache ):
         self.opPixelFeatureCache.name = "opPixelFeatureCache"
 
         # Connect the cache to the feature output
-        self.opPixelFeatureCache.Input.connect(self.opPixelFeatures.Output)
+        self.opPixelFeatureCache.Input.connect(self._featureOutput)
         self.opPixelFeatureCache.fixAtCurrent.setValue(False)
 
         # Connect external output to internal output
@@ -16,6 +16,14 @@
 
 # FIXME: use ilastik config file
 compress_labels = False
+
+# Local ("in neighborhood") object features are computed in chunks of
+# this many objects. Each chunk is processed by a separate request.
+local_features_chunk_size = 500
+
+# Maximum number of chunks that are processed at the same time.
+# 0 means no limit, i.e. the lazyflow thread pool decides.
+local_features_max_workers = 0
 '''
 # all these features are precalculated in opExtractObjects
 #vigra_features = ['Count', 'Mean', 'Variance', 'Skewness', 'Kurtosis', 'RegionCenter', 'RegionAxes']
@@ -46,3 +54,22 @@ if not has_skimage:
 
 #selected_features = ['Histogram_excl', 'Histogram_obj', 'lbp_excl', 'lbp_obj']
 '''
+
+# If set to a tuple (x, y, z), region features are computed tile by
+# tile instead of on the whole volume at once, so that peak memory is
+# bounded by the tile size. This is only possible if all selected
+# features can be merged across tiles, otherwise the whole volume is
+# loaded as usual.
+region_features_tile_shape = None
+
+# Maximum number of tiles that are processed (and held in memory) at the
+# same time in tile-wise mode. 0 means one tile per lazyflow worker thread.
+region_features_max_tiles = 0
+
+# If True, a changed region of the label or raw image only causes the
+# features of the objects near that region to be recomputed. The
+# feature rows of all other objects are reused from the previous
+# computation. Global features are only patched this way if all of
+# them can be computed on a crop of the volume (no histograms or
+# Global<...> features), and not in tile-wise mode.
+incremental_region_features = False
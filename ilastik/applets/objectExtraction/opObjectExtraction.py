@@ -15,9 +15,13 @@
 # Copyright 2011-2014, the ilastik developers
 
 #Python
-from copy import copy
+from copy import copy, deepcopy
+import time
+import itertools
+import threading
 import collections
 from collections import defaultdict
+from functools import partial
 
 #SciPy
 import numpy as np
@@ -29,6 +33,7 @@ from lazyflow.stype import Opaque
 from lazyflow.rtype import List, SubRegion
 from lazyflow.roi import roiToSlice, sliceToRoi
 from lazyflow.operators import OpCachedLabelImage, OpMultiArraySlicer2, OpMultiArrayStacker, OpArrayCache, OpCompressedCache
+from lazyflow.request import Request, RequestPool
 
 import logging
 logger = logging.getLogger(__name__)
@@ -40,6 +45,8 @@ except:
     logger.warn('could not import pluginManager')
 
 from ilastik.applets.base.applet import DatasetConstraintError
+from ilastik.applets.objectExtraction import config
+from ilastik.applets.objectExtraction.regionFeatureAccumulator import RegionFeatureAccumulator
 
 # These features are always calculated, but not used for prediction.
 # They are needed by our gui, or by downstream applets.
@@ -53,6 +60,22 @@ default_features = {'Coord<Minimum>':{}, 'Coord<Maximum>':{}, 'RegionCenter': {}
 # to distinguish them, they go in their own category with this name
 default_features_key = 'Default features'
 
+def coordinate_axes(tagged_shape):
+    """The axis keys of the columns of coordinate features (e.g.
+    Coord<Minimum>) for data with the given tagged shape.
+
+    The features are computed on xyz volumes, and the z column is
+    dropped for 2D data.
+
+    >>> coordinate_axes(collections.OrderedDict([('t', 1), ('z', 1), ('y', 20), ('x', 30), ('c', 1)]))
+    ['x', 'y']
+
+    """
+    keys = [k for k in 'xyz' if k in tagged_shape]
+    if tagged_shape.get('z', 1) == 1 and 'z' in keys:
+        keys.remove('z')
+    return keys
+
 def max_margin(d, default=(0, 0, 0)):
     """find any parameter named 'margin' in the nested feature
     dictionary 'd' and return the max.
@@ -78,27 +101,66 @@ def max_margin(d, default=(0, 0, 0)):
                 continue
     return margin
 
-def make_bboxes(binary_bbox, margin):
-    """Return binary label arrays for an object with margin.
+def margin_pitch(margin):
+    """Pixel pitch used for the distance transform of an object with
+    this margin.
 
-    Helper for feature plugins.
+    Margins that are multiples of each other have the same pitch, so
+    their distance transforms are identical and can be shared.
 
-    Returns (the object + context, context only)
+    Zero entries are treated as a margin of 1, so they do not produce
+    an infinite pitch.
+
+    >>> margin_pitch((10, 10, 5)) == margin_pitch((2, 2, 1))
+    True
+
+    >>> margin_pitch((10, 10, 0)) == margin_pitch((10, 10, 1))
+    True
 
     """
-    # object and context
-    max_margin = np.max(margin).astype(np.float32)
-    scaled_margin = (max_margin / margin)
+    margin = np.asarray(margin, dtype=np.float64)
+    if np.any(margin < 0):
+        raise ValueError("margin must not be negative: {}".format(tuple(margin)))
+    margin = np.maximum(margin, 1)
+    return tuple(np.round(np.max(margin) / margin, 6))
+
+def object_distance_transform(binary_bbox, margin):
+    """Distance transform of the background of binary_bbox, scaled such
+    that the points with dt < max(margin) are within 'margin' of the
+    object.
+
+    The result can be reused by make_bboxes() for all margins with the
+    same margin_pitch().
+
+    """
+    scaled_margin = np.asarray(margin_pitch(margin), dtype=np.float64)
     if len(margin) > 2:
         dt = vigra.filters.distanceTransform3D(np.asarray(binary_bbox, dtype=np.float32),
                                                background=True,
-                                               pixel_pitch=np.asarray(scaled_margin).astype(np.float64))
+                                               pixel_pitch=scaled_margin)
     else:
         dt = vigra.filters.distanceTransform2D(np.asarray(binary_bbox.squeeze(), dtype=np.float32),
-                                               pixel_pitch=np.asarray(scaled_margin).astype(np.float64))
+                                               pixel_pitch=scaled_margin)
         dt = dt.reshape(dt.shape + (1,))
 
     assert dt.ndim == 3
+    return dt
+
+def make_bboxes(binary_bbox, margin, dt=None):
+    """Return binary label arrays for an object with margin.
+
+    Helper for feature plugins.
+
+    :param dt: optional result of object_distance_transform() for a
+        margin with the same margin_pitch(), to avoid recomputing it.
+
+    Returns (the object + context, context only)
+
+    """
+    # object and context
+    max_margin = np.max(margin).astype(np.float32)
+    if dt is None:
+        dt = object_distance_transform(binary_bbox, margin)
     passed = np.asarray(dt < max_margin).astype(np.bool)
 
     # context only
@@ -121,6 +183,10 @@ class OpRegionFeatures3d(Operator):
     * Features : a nested dictionary of features to compute.
       Features[plugin name][feature name][parameter name] = parameter value
 
+    * TileShape : (optional) tile shape in xyz order.  If given, the
+      features are computed tile by tile (if the selected features
+      allow it), instead of according to config.region_features_tile_shape.
+
     Outputs:
 
     * Output : a nested dictionary of features.
@@ -130,10 +196,22 @@ class OpRegionFeatures3d(Operator):
     RawVolume = InputSlot()
     LabelVolume = InputSlot()
     Features = InputSlot(rtype=List, stype=Opaque)
+    TileShape = InputSlot(optional=True)
 
     Output = OutputSlot()
 
+    def __init__(self, *args, **kwargs):
+        super(OpRegionFeatures3d, self).__init__(*args, **kwargs)
+        # For incremental recomputation: the spatial rois (xyz) that
+        # became dirty since the last computation, and the features
+        # of that computation.
+        self._dirtyRois = []
+        self._dirtyRoisLock = threading.Lock()
+        self._previousFeatures = None
+
     def setupOutputs(self):
+        self._resetIncrementalState()
+
         if self.LabelVolume.meta.axistags != self.RawVolume.meta.axistags:
             raise Exception('raw and label axis tags do not match')
 
@@ -165,8 +243,38 @@ class OpRegionFeatures3d(Operator):
     def execute(self, slot, subindex, roi, result):
         assert len(roi.start) == len(roi.stop) == len(self.Output.meta.shape)
         assert slot == self.Output
-        import time
         start = time.time()
+
+        # Take the dirty regions before any data is requested. Changes
+        # that arrive during the computation are handled next time.
+        with self._dirtyRoisLock:
+            dirtyRois = self._dirtyRois
+            self._dirtyRois = []
+
+        try:
+            return self._execute(roi, result, dirtyRois, start)
+        except:
+            # Nothing was recomputed, keep the dirty regions for next time.
+            with self._dirtyRoisLock:
+                self._dirtyRois = dirtyRois + self._dirtyRois
+            raise
+
+    def _execute(self, roi, result, dirtyRois, start):
+        if self.TileShape.ready():
+            tile_shape = self.TileShape.value
+        else:
+            tile_shape = config.region_features_tile_shape
+        if tile_shape is not None:
+            feature_names = self.Features([]).wait()
+            if self._canComputeTiled(feature_names):
+                assert np.prod(roi.stop - roi.start) == 1
+                result[tuple(roi.start)] = self._extractTiled(feature_names, tile_shape, dirtyRois)
+                stop = time.time()
+                logger.debug("TIMING: computing features tile-wise took {:.3f}s".format(stop-start))
+                return result
+            logger.warning("Selected features can not be computed tile-wise, processing the entire volume. "
+                           "The memory use is not bounded by the tile shape.")
+
         # Process ENTIRE volume
         rawVolume = self.RawVolume[:].wait()
         labelVolume = self.LabelVolume[:].wait()
@@ -184,7 +292,7 @@ class OpRegionFeatures3d(Operator):
         labelVolume4d = labelVolume.withAxes(*axes4d)
 
         assert np.prod(roi.stop - roi.start) == 1
-        acc = self._extract(rawVolume4d, labelVolume4d)
+        acc = self._extract(rawVolume4d, labelVolume4d, dirtyRois)
         result[tuple(roi.start)] = acc
         stop = time.time()
         logger.debug("TIMING: computing features took {:.3f}s".format(stop-start))
@@ -222,28 +330,205 @@ class OpRegionFeatures3d(Operator):
         key.insert(axes.c, slice(None))
         return image[tuple(key)]
 
-    def _extract(self, image, labels):
-        if not (image.ndim == labels.ndim == 4):
-            raise Exception("both images must be 4D. raw image shape: {}"
-                            " label image shape: {}".format(image.shape, labels.shape))
+    @staticmethod
+    def _make_object_chunks(nobj, chunk_size):
+        """Split the object indices [0, nobj) into consecutive (start, stop) ranges.
 
-        # FIXME: maybe simplify? taggedShape should be easier here
-        class Axes(object):
-            x = image.axistags.index('x')
-            y = image.axistags.index('y')
-            z = image.axistags.index('z')
-            c = image.axistags.index('c')
-        axes = Axes()
+        >>> OpRegionFeatures3d._make_object_chunks(5, 2)
+        [(0, 2), (2, 4), (4, 5)]
 
-        slc3d = [slice(None)] * 4 # FIXME: do not hardcode
-        slc3d[axes.c] = 0
+        """
+        chunk_size = max(int(chunk_size), 1)
+        return [(start, min(start + chunk_size, nobj))
+                for start in range(0, nobj, chunk_size)]
 
-        labels = labels[slc3d]
-        
-        logger.debug("Computing default features")
+    def _extract_local_chunk(self, get_bboxes, feature_names, has_local_features, axes, objects):
+        """Compute the local features of the given objects.
 
-        feature_names = self.Features([]).wait()
+        get_bboxes(i) must return (rawbbox, binary_bbox) for object i.
+
+        Returns local_features[plugin_name][feature_name] = list of
+        per-object values, in object order.
+
+        """
+        local_features = defaultdict(lambda: defaultdict(list))
+        for i in objects:
+            logger.debug("processing object {}".format(i))
+            rawbbox, binary_bbox = get_bboxes(i)
+            for plugin_name, feature_dict in feature_names.iteritems():
+                if not has_local_features[plugin_name]:
+                    continue
+                plugin = pluginManager.getPluginByName(plugin_name, "ObjectFeatures")
+                feats = plugin.plugin_object.compute_local(rawbbox, binary_bbox, feature_dict, axes)
+                for key in feats:
+                    local_features[plugin_name][key].append(feats[key])
+        return local_features
+
+    def _compute_local_features(self, get_bboxes, objects, feature_names, has_local_features, axes):
+        """Compute the local features of the given list of objects.
+
+        The objects are split into chunks and the chunks are processed
+        in parallel. The chunk results are merged in the order of
+        'objects' afterwards, so the rows do not depend on the order
+        in which the requests finish.
+
+        """
+        chunks = self._make_object_chunks(len(objects), config.local_features_chunk_size)
+        chunk_results = [None] * len(chunks)
+
+        def compute_chunk(index):
+            start, stop = chunks[index]
+            chunk_results[index] = self._extract_local_chunk(get_bboxes, feature_names,
+                                                             has_local_features, axes,
+                                                             objects[start:stop])
+
+        max_workers = config.local_features_max_workers
+        if max_workers <= 0:
+            max_workers = max(len(chunks), 1)
+
+        for first in range(0, len(chunks), max_workers):
+            pool = RequestPool()
+            for index in range(first, min(first + max_workers, len(chunks))):
+                pool.add(Request(partial(compute_chunk, index)))
+            pool.wait()
+            pool.clean()
+
+        local_features = defaultdict(lambda: defaultdict(list))
+        for chunk_features in chunk_results:
+            for plugin_name, feats in chunk_features.iteritems():
+                for key, values in feats.iteritems():
+                    local_features[plugin_name][key].extend(values)
+        return local_features
+
+    def _local_features(self, get_bboxes, extrafeats, keys, margin, feature_names,
+                        has_local_features, axes, dirtyRois, previous):
+        """Compute the local features of all objects.
+
+        In incremental mode, the rows of objects that did not change
+        since the previous computation are copied from its result, and
+        only the remaining objects are computed.
+
+        """
+        nobj = extrafeats["Coord<Minimum>"].shape[0]
+
+        if not config.incremental_region_features \
+           or dirtyRois is None \
+           or previous is None \
+           or previous['feature_names'] != feature_names \
+           or list(previous['margin']) != list(margin):
+            reused = {}
+        else:
+            reused = self._reusableObjects(previous, keys, extrafeats, margin, dirtyRois)
+
+        objects = [i for i in range(nobj) if i not in reused]
+        logger.debug("computing local features of {} objects, reusing {}".format(len(objects), len(reused)))
+        computed = self._compute_local_features(get_bboxes, objects, feature_names,
+                                                has_local_features, axes)
+
+        # Assemble the rows in object order. A feature that is
+        # missing for some objects is dropped, like a failed feature.
+        local_features = defaultdict(lambda: defaultdict(list))
+        plugin_names = set(computed.keys())
+        if reused:
+            plugin_names |= set(previous['local'].keys())
+        for plugin_name in plugin_names:
+            new_feats = computed.get(plugin_name, {})
+            old_feats = previous['local'].get(plugin_name, {}) if reused else {}
+            feature_keys = set(new_feats.keys()) | set(old_feats.keys())
+            for key in feature_keys:
+                new_rows = iter(new_feats.get(key, []))
+                rows = []
+                try:
+                    for i in range(nobj):
+                        if i in reused:
+                            rows.append(old_feats[key][reused[i]])
+                        else:
+                            rows.append(next(new_rows))
+                except (KeyError, StopIteration):
+                    logger.warn('feature {} failed'.format(key))
+                    continue
+                local_features[plugin_name][key] = rows
+        return local_features
+
+    def _rememberFeatures(self, feature_names, margin, keys, global_features, local_features):
+        """Keep the result of this computation for the next incremental one.
+
+        global_features is None if the global features can't be reused.
+
+        """
+        if not config.incremental_region_features:
+            return
+        if global_features is not None:
+            global_features = dict((name, dict(feats)) for name, feats in global_features.iteritems())
+        self._previousFeatures = {'feature_names': feature_names,
+                                  'margin': list(margin),
+                                  'keys': keys,
+                                  'global': global_features,
+                                  'local': dict((name, dict(feats))
+                                                for name, feats in local_features.iteritems())}
+
+    @staticmethod
+    def _objectKeys(extrafeats):
+        """Identify objects by size, bounding box and center, so that
+        unchanged objects can be found even if their label id changed.
+
+        """
+        columns = [extrafeats[k] for k in ("Count", "Coord<Minimum>", "Coord<Maximum>", "RegionCenter")]
+        table = np.hstack([np.asarray(c, dtype=np.float64).reshape(c.shape[0], -1) for c in columns])
+        return [tuple(row) for row in table]
+
+    @staticmethod
+    def _reusableObjects(previous, keys, extrafeats, margin, dirtyRois):
+        """Find objects whose local features can be copied from the
+        previous computation.
 
+        An object is reusable if an object with the same key existed
+        before and its bounding box plus margin does not intersect any
+        dirty region. Returns a dict {new index: previous index}.
+
+        """
+        previousIndex = dict((key, i) for i, key in enumerate(previous['keys']))
+        mincoords = extrafeats["Coord<Minimum>"]
+        maxcoords = extrafeats["Coord<Maximum>"]
+        reused = {}
+        for i, key in enumerate(keys):
+            if key not in previousIndex:
+                continue
+            ndim = min(mincoords.shape[1], len(margin))
+            start = [mincoords[i][d] - margin[d] for d in range(ndim)]
+            stop = [maxcoords[i][d] + 1 + margin[d] for d in range(ndim)]
+            intersects = False
+            for dirtyStart, dirtyStop in dirtyRois:
+                if all(start[d] < dirtyStop[d] and dirtyStart[d] < stop[d] for d in range(ndim)):
+                    intersects = True
+                    break
+            if not intersects:
+                reused[i] = previousIndex[key]
+        return reused
+
+    def _resetIncrementalState(self):
+        with self._dirtyRoisLock:
+            self._dirtyRois = []
+        self._previousFeatures = None
+
+    @staticmethod
+    def _has_local_features(feature_names):
+        has_local_features = {}
+        for plugin_name, feature_dict in feature_names.iteritems():
+            has_local_features[plugin_name] = False
+            for features in feature_dict.itervalues():
+                if 'margin' in features:
+                    has_local_features[plugin_name] = True
+                    break
+        return has_local_features
+
+    def _computeGlobalFeatures(self, image, labels, axes, feature_names, slc3d):
+        """Compute the global features of all objects.
+
+        Returns (global_features, extrafeats), where extrafeats are the
+        default features.
+
+        """
         # do global features
         logger.debug("computing global features")
         extra_features_computed = False
@@ -272,55 +557,422 @@ class OpRegionFeatures3d(Operator):
                 extrafeats[feat_key] = feature
         else:
             logger.debug("default features not computed, computing separately")
-            extrafeats_acc = vigra.analysis.extractRegionFeatures(image[slc3d].squeeze().astype(np.float32), labels.squeeze(),
-                                                        default_features.keys(),
-                                                        ignoreLabel=0)
-            #remove the 0th object, we'll add it again later
-            for k, v in extrafeats_acc.iteritems():
-                extrafeats[k]=v[1:]
-                if len(v.shape)==1:
-                    extrafeats[k]=extrafeats[k].reshape(extrafeats[k].shape+(1,))
-        
+            return global_features, self._defaultFeatures(image, labels, slc3d)
+
         extrafeats = dict((k.replace(' ', ''), v)
                           for k, v in extrafeats.iteritems())
+        return global_features, extrafeats
+
+    @staticmethod
+    def _defaultFeatures(image, labels, slc3d):
+        extrafeats_acc = vigra.analysis.extractRegionFeatures(image[slc3d].squeeze().astype(np.float32), labels.squeeze(),
+                                                    default_features.keys(),
+                                                    ignoreLabel=0)
+        #remove the 0th object, we'll add it again later
+        extrafeats = {}
+        for k, v in extrafeats_acc.iteritems():
+            extrafeats[k]=v[1:]
+            if len(v.shape)==1:
+                extrafeats[k]=extrafeats[k].reshape(extrafeats[k].shape+(1,))
+        return dict((k.replace(' ', ''), v)
+                    for k, v in extrafeats.iteritems())
+
+    @staticmethod
+    def _globalFeatureShift(name):
+        """How a global feature behaves if it is computed on a crop of the
+        volume: 'none' if it only depends on the pixels of the object,
+        'offset' if it is a position that must be shifted by the crop
+        start, None if it can't be computed on a crop at all (e.g.
+        histograms, whose range depends on the whole image).
+
+        """
+        if 'Global<' in name or 'Histogram' in name or 'Quantiles' in name:
+            return None
+        if name in ('RegionCenter', 'Coord<Minimum>', 'Coord<Maximum>',
+                    'Coord<ArgMinWeight>', 'Coord<ArgMaxWeight>', 'Weighted<RegionCenter>'):
+            return 'offset'
+        if 'Coord<' in name or 'Weighted<' in name:
+            if 'Central<' in name or 'Principal<' in name:
+                return 'none'
+            return None
+        return 'none'
+
+    @classmethod
+    def _canPatchGlobal(cls, feature_names):
+        for plugin_name, feature_dict in feature_names.iteritems():
+            # The behaviour of other plugins on a crop is unknown
+            if plugin_name != "Standard Object Features":
+                return False
+            for name, params in feature_dict.iteritems():
+                if 'margin' not in params and cls._globalFeatureShift(name) is None:
+                    return False
+        return True
+
+    def _patchGlobalFeatures(self, image, labels, axes, feature_names, extrafeats, keys, previous, dirtyRois):
+        """Compute the global features of the objects that changed since
+        the previous computation, and copy the rows of all other objects
+        from its result.
+
+        The changed objects are computed on the smallest crop of the
+        volume that contains all of them, with the other labels removed.
+        Returns None if the previous result can't be used.
+
+        """
+        if dirtyRois is None \
+           or previous is None \
+           or previous['global'] is None \
+           or previous['feature_names'] != feature_names \
+           or not self._canPatchGlobal(feature_names):
+            return None
+
+        nobj = len(keys)
+        reused = self._reusableObjects(previous, keys, extrafeats, (0, 0, 0), dirtyRois)
+        changed = [i for i in range(nobj) if i not in reused]
+        logger.debug("computing global features of {} objects, reusing {}".format(len(changed), len(reused)))
+
+        computed = {}
+        if changed:
+            computed = self._computeGlobalOnCrop(image, labels, axes, feature_names, extrafeats, changed)
+
+        global_features = {}
+        for plugin_name, old_feats in previous['global'].iteritems():
+            new_feats = computed.get(plugin_name, {})
+            global_features[plugin_name] = {}
+            for key, old in old_feats.iteritems():
+                if changed and key not in new_feats:
+                    return None
+                rows = np.zeros((nobj,) + old.shape[1:], dtype=old.dtype)
+                if reused:
+                    indexes = sorted(reused)
+                    rows[indexes] = old[[reused[i] for i in indexes]]
+                if changed:
+                    rows[changed] = new_feats[key][changed]
+                global_features[plugin_name][key] = rows
+        return global_features
+
+    def _computeGlobalOnCrop(self, image, labels, axes, feature_names, extrafeats, objects):
+        """Compute the global features of the given objects on a crop of
+        the volume. The rows of all other objects in the result are
+        meaningless.
+
+        """
+        mincoords = extrafeats["Coord<Minimum>"]
+        maxcoords = extrafeats["Coord<Maximum>"]
+        extents = [self.compute_extent(i, image, mincoords, maxcoords, axes, (0, 0, 0)) for i in objects]
+        start = [min(e[d].start for e in extents) for d in range(3)]
+        stop = [max(e[d].stop for e in extents) for d in range(3)]
+
+        # The plugin squeezes singleton axes, so the crop must keep at
+        # least two pixels along each axis that has them.
+        for d in range(3):
+            if stop[d] - start[d] < 2 and labels.shape[d] >= 2:
+                if stop[d] < labels.shape[d]:
+                    stop[d] += 1
+                else:
+                    start[d] -= 1
+        crop = [slice(a, b) for a, b in zip(start, stop)]
+
+        cropLabels = labels[tuple(crop)].copy()
+        keep = np.zeros(max(int(cropLabels.max()), max(objects) + 1) + 1, dtype=np.bool)
+        #it's i+1 here, because the background has label 0
+        keep[np.asarray(objects) + 1] = True
+        cropLabels[np.logical_not(keep[np.asarray(cropLabels, dtype=np.intp)])] = 0
+        cropImage = self.compute_rawbbox(image, crop, axes)
+
+        # The coordinates are given for the axes that remain after squeezing
+        is2d = (image.shape[axes.z] == 1)
+        offset = [start[d] for d in sorted([axes.x, axes.y, axes.z]) if not (is2d and d == axes.z)]
+
+        computed = {}
+        for plugin_name, feature_dict in feature_names.iteritems():
+            plugin = pluginManager.getPluginByName(plugin_name, "ObjectFeatures")
+            feats = plugin.plugin_object.compute_global(cropImage, cropLabels, feature_dict, axes)
+            for key, value in feats.iteritems():
+                if self._globalFeatureShift(key) == 'offset':
+                    feats[key] = value + np.asarray(offset[:value.shape[1]], dtype=value.dtype)
+            computed[plugin_name] = feats
+        return computed
+
+    def _extract(self, image, labels, dirtyRois=None):
+        if not (image.ndim == labels.ndim == 4):
+            raise Exception("both images must be 4D. raw image shape: {}"
+                            " label image shape: {}".format(image.shape, labels.shape))
+
+        # FIXME: maybe simplify? taggedShape should be easier here
+        class Axes(object):
+            x = image.axistags.index('x')
+            y = image.axistags.index('y')
+            z = image.axistags.index('z')
+            c = image.axistags.index('c')
+        axes = Axes()
+
+        slc3d = [slice(None)] * 4 # FIXME: do not hardcode
+        slc3d[axes.c] = 0
+
+        labels = labels[slc3d]
         
+        logger.debug("Computing default features")
+
+        feature_names = self.Features([]).wait()
+        requested_names = deepcopy(feature_names)
+
+        previous = self._previousFeatures
+        self._previousFeatures = None
+
+        global_features = None
+        if config.incremental_region_features:
+            extrafeats = self._defaultFeatures(image, labels, slc3d)
+            keys = self._objectKeys(extrafeats)
+            global_features = self._patchGlobalFeatures(image, labels, axes, feature_names, extrafeats,
+                                                        keys, previous, dirtyRois)
+        if global_features is None:
+            global_features, extrafeats = self._computeGlobalFeatures(image, labels, axes, feature_names, slc3d)
+            keys = self._objectKeys(extrafeats)
+
         mincoords = extrafeats["Coord<Minimum>"]
         maxcoords = extrafeats["Coord<Maximum>"]
         nobj = mincoords.shape[0]
         
-        # local features: loop over all objects
-        def dictextend(a, b):
-            for key in b:
-                a[key].append(b[key])
-            return a
-        
-
-        local_features = defaultdict(lambda: defaultdict(list))
+        local_features = {}
         margin = max_margin(feature_names)
-        has_local_features = {}
-        for plugin_name, feature_dict in feature_names.iteritems():
-            has_local_features[plugin_name] = False
-            for features in feature_dict.itervalues():
-                if 'margin' in features:
-                    has_local_features[plugin_name] = True
-                    break
-            
-                            
+        has_local_features = self._has_local_features(feature_names)
+
         if np.any(margin) > 0:
-            #starting from 0, we stripped 0th background object in global computation
-            for i in range(0, nobj):
-                logger.debug("processing object {}".format(i))
+            def get_bboxes(i):
                 extent = self.compute_extent(i, image, mincoords, maxcoords, axes, margin)
                 rawbbox = self.compute_rawbbox(image, extent, axes)
                 #it's i+1 here, because the background has label 0
                 binary_bbox = np.where(labels[tuple(extent)] == i+1, 1, 0).astype(np.bool)
-                for plugin_name, feature_dict in feature_names.iteritems():
-                    if not has_local_features[plugin_name]:
-                        continue
-                    plugin = pluginManager.getPluginByName(plugin_name, "ObjectFeatures")
-                    feats = plugin.plugin_object.compute_local(rawbbox, binary_bbox, feature_dict, axes)
-                    local_features[plugin_name] = dictextend(local_features[plugin_name], feats)
+                return rawbbox, binary_bbox
+
+            #starting from 0, we stripped 0th background object in global computation
+            local_features = self._local_features(get_bboxes, extrafeats, keys, margin, feature_names,
+                                                  has_local_features, axes, dirtyRois, previous)
+
+        self._rememberFeatures(requested_names, margin, keys, global_features, local_features)
+        return self._merge_features(global_features, local_features, extrafeats, nobj)
+
+    @classmethod
+    def _canComputeTiled(cls, feature_names):
+        """Check if all selected global features can be computed without
+        the whole volume: either merged across tiles, or computed on a
+        crop around the objects (see _computeGlobalPerTile).
+
+        Local features are always possible, because they are computed
+        on the bounding box of each object.
+
+        """
+        for plugin_name, feature_dict in feature_names.iteritems():
+            if plugin_name != "Standard Object Features":
+                return False
+            for name, params in feature_dict.iteritems():
+                if 'margin' in params or RegionFeatureAccumulator.supportsFeatures([name]):
+                    continue
+                if cls._globalFeatureShift(name) is None:
+                    return False
+        return True
+
+    def _fetchXyzBlocks(self, slots, start, stop):
+        """Request the block [start, stop) (given in xyz order) of all
+        channels from each of the slots and return the blocks with
+        xyzc axes. The requests of all slots run concurrently.
+
+        """
+        requests = []
+        for slot in slots:
+            taggedShape = slot.meta.getTaggedShape()
+            roiStart = []
+            roiStop = []
+            for key, size in taggedShape.items():
+                if key in 'xyz':
+                    roiStart.append(int(start['xyz'.index(key)]))
+                    roiStop.append(int(stop['xyz'.index(key)]))
+                else:
+                    roiStart.append(0)
+                    roiStop.append(size)
+            requests.append(slot(roiStart, roiStop))
+        for request in requests:
+            request.submit()
+
+        blocks = []
+        for slot, request in zip(slots, requests):
+            data = request.wait().view(vigra.VigraArray)
+            data.axistags = copy(slot.meta.axistags)
+            blocks.append(data.withAxes('x', 'y', 'z', 'c'))
+        return blocks
+
+    def _extractTiled(self, feature_names, tile_shape, dirtyRois=None):
+        """Compute the features without loading the whole volume.
+
+        The global features are accumulated tile by tile with a
+        RegionFeatureAccumulator, which merges objects that span
+        several tiles exactly. The local features are computed on
+        the bounding box (plus margin) of each object, which is
+        requested separately.
+
+        """
+        requested_names = deepcopy(feature_names)
+        previous = self._previousFeatures
+        self._previousFeatures = None
+
+        taggedShape = self.RawVolume.meta.getTaggedShape()
+        shape = [taggedShape[k] for k in 'xyz']
+        is2d = (shape[2] == 1)
+        ndim = 2 if is2d else 3
+
+        class Axes(object):
+            x = 0
+            y = 1
+            z = 2
+            c = 3
+        axes = Axes()
+
+        tile_shape = [min(max(int(ts), 1), s) for ts, s in zip(tile_shape, shape)]
+        accumulator = RegionFeatureAccumulator()
+
+        def add_tile(tile_start):
+            tile_stop = [min(a + ts, s) for a, ts, s in zip(tile_start, tile_shape, shape)]
+            raw, labels = self._fetchXyzBlocks((self.RawVolume, self.LabelVolume), tile_start, tile_stop)
+            labels = labels[..., 0]
+            if is2d:
+                raw = raw[:, :, 0, :]
+                labels = labels[:, :, 0]
+            accumulator.addTile(raw, labels, tile_start[:ndim])
 
+        tile_starts = itertools.product(*[range(0, s, ts) for s, ts in zip(shape, tile_shape)])
+        self._processTiles(add_tile, list(tile_starts))
+
+        nobj = accumulator.nlabels - 1
+        extrafeats = accumulator.features(default_features.keys())
+        keys = self._objectKeys(extrafeats)
+
+        global_features = {}
+        cropped_names = {}
+        for plugin_name, feature_dict in feature_names.iteritems():
+            global_names = [name for name, params in feature_dict.iteritems()
+                            if 'margin' not in params]
+            accumulated = [name for name in global_names
+                           if RegionFeatureAccumulator.supportsFeatures([name])]
+            global_features[plugin_name] = accumulator.features(accumulated)
+            cropped = dict((name, feature_dict[name]) for name in global_names
+                           if name not in accumulated)
+            if cropped:
+                cropped_names[plugin_name] = cropped
+
+        if cropped_names and nobj > 0:
+            computed = self._computeGlobalPerTile(cropped_names, extrafeats, tile_shape, shape, axes)
+            for plugin_name, feats in computed.iteritems():
+                global_features[plugin_name].update(feats)
+
+        local_features = {}
+        margin = max_margin(feature_names)
+        has_local_features = self._has_local_features(feature_names)
+
+        if np.any(margin) > 0:
+            for plugin_name in feature_names:
+                # compute_global() is not called in this mode, but the
+                # plugin needs to know the dimensionality of the data.
+                plugin = pluginManager.getPluginByName(plugin_name, "ObjectFeatures")
+                plugin.plugin_object.ndim = ndim
+
+            mincoords = extrafeats["Coord<Minimum>"].astype(np.int64)
+            maxcoords = extrafeats["Coord<Maximum>"].astype(np.int64)
+            # compute_extent() only needs the shape of the volume
+            volume = collections.namedtuple('Volume', 'shape')(tuple(shape) + (taggedShape['c'],))
+
+            def get_bboxes(i):
+                extent = self.compute_extent(i, volume, mincoords, maxcoords, axes, margin)
+                start = [s.start for s in extent]
+                stop = [s.stop for s in extent]
+                rawbbox, labelbbox = self._fetchXyzBlocks((self.RawVolume, self.LabelVolume), start, stop)
+                labelbbox = labelbbox[..., 0]
+                #it's i+1 here, because the background has label 0
+                binary_bbox = np.where(labelbbox == i+1, 1, 0).astype(np.bool)
+                return rawbbox, binary_bbox
+
+            local_features = self._local_features(get_bboxes, extrafeats, keys, margin, feature_names,
+                                                  has_local_features, axes, dirtyRois, previous)
+
+        # The accumulated global features are not kept, they are
+        # recomputed tile by tile.
+        self._rememberFeatures(requested_names, margin, keys, None, local_features)
+        return self._merge_features(global_features, local_features, extrafeats, nobj)
+
+    def _computeGlobalPerTile(self, feature_names, extrafeats, tile_shape, shape, axes):
+        """Compute the global features that can't be merged across tiles.
+
+        Each object belongs to the tile that contains its minimum
+        coordinate. The objects of a tile are computed together on the
+        smallest crop of the volume that contains all of them (see
+        _computeGlobalOnCrop). The tiles are processed in waves, see
+        _processTiles.
+
+        """
+        nobj = extrafeats["Coord<Minimum>"].shape[0]
+        # Coordinates have no z column for 2D data
+        ndim = extrafeats["Coord<Minimum>"].shape[1]
+        mincoords = np.zeros((nobj, 3), dtype=np.int64)
+        maxcoords = np.zeros((nobj, 3), dtype=np.int64)
+        mincoords[:, :ndim] = extrafeats["Coord<Minimum>"]
+        maxcoords[:, :ndim] = extrafeats["Coord<Maximum>"]
+
+        tile_objects = defaultdict(list)
+        for i in range(nobj):
+            tile_objects[tuple(mincoords[i] // tile_shape)].append(i)
+
+        result = defaultdict(dict)
+        lock = threading.Lock()
+
+        def compute_tile(objects):
+            start = mincoords[objects].min(axis=0)
+            stop = maxcoords[objects].max(axis=0) + 1
+            # Keep two pixels along each axis, see _computeGlobalOnCrop
+            for d in range(3):
+                if stop[d] - start[d] < 2 and shape[d] >= 2:
+                    if stop[d] < shape[d]:
+                        stop[d] += 1
+                    else:
+                        start[d] -= 1
+            raw, labels = self._fetchXyzBlocks((self.RawVolume, self.LabelVolume), start, stop)
+            labels = labels[..., 0]
+
+            crop_extrafeats = {"Coord<Minimum>": mincoords[:, :ndim] - start[:ndim],
+                               "Coord<Maximum>": maxcoords[:, :ndim] - start[:ndim]}
+            computed = self._computeGlobalOnCrop(raw, labels, axes, feature_names, crop_extrafeats, objects)
+            with lock:
+                for plugin_name, feats in computed.iteritems():
+                    for key, value in feats.iteritems():
+                        if self._globalFeatureShift(key) == 'offset':
+                            value = value + start[:value.shape[1]].astype(value.dtype)
+                        if key not in result[plugin_name]:
+                            result[plugin_name][key] = np.zeros((nobj,) + value.shape[1:], dtype=value.dtype)
+                        result[plugin_name][key][objects] = value[objects]
+
+        self._processTiles(compute_tile, tile_objects.values())
+        return result
+
+    def _processTiles(self, func, args):
+        """Call func with each of the args, in waves of at most
+        config.region_features_max_tiles concurrent requests. Only
+        the tiles of the current wave are held in memory.
+
+        """
+        max_tiles = config.region_features_max_tiles
+        if max_tiles <= 0:
+            max_tiles = max(Request.global_thread_pool.num_workers, 1)
+
+        for first in range(0, len(args), max_tiles):
+            pool = RequestPool()
+            for arg in args[first:first + max_tiles]:
+                pool.add(Request(partial(func, arg)))
+            pool.wait()
+            pool.clean()
+
+    def _merge_features(self, global_features, local_features, extrafeats, nobj):
+        """Combine global, local and default features into the output
+        dictionary, adding the background row to every feature.
+
+        """
         logger.debug("computing done, removing failures")
         # remove local features that failed
         for pname, pfeats in local_features.iteritems():
@@ -365,12 +1017,22 @@ class OpRegionFeatures3d(Operator):
 
     def propagateDirty(self, slot, subindex, roi):
         if slot is self.Features:
+            self._resetIncrementalState()
             self.Output.setDirty(slice(None))
+        elif slot is self.TileShape:
+            # The tiling doesn't change the result
+            pass
         else:
             axes = self.RawVolume.meta.getTaggedShape().keys()
             dirtyStart = collections.OrderedDict(zip(axes, roi.start))
             dirtyStop = collections.OrderedDict(zip(axes, roi.stop))
 
+            # Remember the spatial part, so that the next computation
+            # only needs to recompute the affected objects.
+            with self._dirtyRoisLock:
+                self._dirtyRois.append(([dirtyStart[k] for k in 'xyz'],
+                                        [dirtyStop[k] for k in 'xyz']))
+
             # Remove the spatial and channel dims (keep t, if present)
             del dirtyStart['x']
             del dirtyStart['y']
@@ -389,6 +1051,7 @@ class OpRegionFeatures(Operator):
     RawImage = InputSlot()
     LabelImage = InputSlot()
     Features = InputSlot(rtype=List, stype=Opaque)
+    TileShape = InputSlot(optional=True) # See OpRegionFeatures3d
     Output = OutputSlot()
 
     # Schematic:
@@ -418,6 +1081,7 @@ class OpRegionFeatures(Operator):
         self.opRegionFeatures3dBlocks.RawVolume.connect(self.opRawTimeSlicer.Slices)
         self.opRegionFeatures3dBlocks.LabelVolume.connect(self.opLabelTimeSlicer.Slices)
         self.opRegionFeatures3dBlocks.Features.connect(self.Features)
+        self.opRegionFeatures3dBlocks.TileShape.connect(self.TileShape)
         assert self.opRegionFeatures3dBlocks.Output.level == 1
 
         self.opTimeStacker = OpMultiArrayStacker(parent=self)
@@ -443,6 +1107,7 @@ class OpCachedRegionFeatures(Operator):
     LabelImage = InputSlot()
     CacheInput = InputSlot(optional=True)
     Features = InputSlot(rtype=List, stype=Opaque)
+    TileShape = InputSlot(optional=True) # See OpRegionFeatures3d
 
     Output = OutputSlot()
     CleanBlocks = OutputSlot()
@@ -463,6 +1128,7 @@ class OpCachedRegionFeatures(Operator):
         self._opRegionFeatures.RawImage.connect(self.RawImage)
         self._opRegionFeatures.LabelImage.connect(self.LabelImage)
         self._opRegionFeatures.Features.connect(self.Features)
+        self._opRegionFeatures.TileShape.connect(self.TileShape)
 
         # Hook up the cache.
         self._opCache = OpArrayCache(parent=self)
@@ -0,0 +1,195 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+import threading
+
+import numpy as np
+import vigra
+
+class RegionFeatureAccumulator(object):
+    """Computes region features of a labeled volume one tile at a time.
+
+    Each call to addTile() computes vigra region features on a single
+    tile and merges them into running per-label statistics. Objects
+    that span several tiles are merged exactly, so the result does
+    not depend on the tiling.
+
+    Only features that can be merged from partial statistics are
+    supported, see ``supported_features``.
+
+    The label ids must be globally consistent across tiles (e.g. the
+    output of a connected components operator on the whole volume).
+    Label 0 is background and is ignored.
+
+    addTile() may be called from several threads at once: the vigra
+    features are computed in parallel, only the merge is serialized.
+
+    """
+    supported_features = set(['Count', 'Sum', 'Mean', 'Variance',
+                              'Minimum', 'Maximum',
+                              'RegionCenter', 'Coord<Minimum>', 'Coord<Maximum>'])
+
+    _vigra_features = ['Count', 'Mean', 'Variance', 'Minimum', 'Maximum',
+                       'RegionCenter', 'Coord<Minimum>', 'Coord<Maximum>']
+
+    def __init__(self):
+        self.count = None
+        self._mean = None
+        self._m2 = None
+        self._minimum = None
+        self._maximum = None
+        self._coordMean = None
+        self._coordMinimum = None
+        self._coordMaximum = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def supportsFeatures(cls, feature_names):
+        return set(feature_names) <= cls.supported_features
+
+    @property
+    def nlabels(self):
+        """Number of labels seen so far, including the background label 0."""
+        if self.count is None:
+            return 0
+        return self.count.shape[0]
+
+    def addTile(self, image, labels, offset):
+        """Compute the statistics of one tile and merge them.
+
+        :param image: float32 VigraArray with spatial axes and a channel axis
+        :param labels: VigraArray with the same spatial shape as image, no channel axis
+        :param offset: position of the tile in the full volume (one entry per spatial axis)
+
+        """
+        feats = vigra.analysis.extractRegionFeatures(image.astype(np.float32),
+                                                     labels.astype(np.uint32),
+                                                     self._vigra_features,
+                                                     ignoreLabel=0)
+        feats = dict((k.replace(' ', ''), np.asarray(v, dtype=np.float64)) for k, v in feats.iteritems())
+
+        offset = np.asarray(offset, dtype=np.float64).reshape(1, -1)
+        count = feats['Count'].reshape(-1)
+        mean = self._as2d(feats['Mean'])
+        with self._lock:
+            self.merge(count,
+                       mean,
+                       self._as2d(feats['Variance']) * count.reshape(-1, 1),
+                       self._as2d(feats['Minimum']),
+                       self._as2d(feats['Maximum']),
+                       self._as2d(feats['RegionCenter']) + offset,
+                       self._as2d(feats['Coord<Minimum>']) + offset,
+                       self._as2d(feats['Coord<Maximum>']) + offset)
+
+    def merge(self, count, mean, m2, minimum, maximum, coordMean, coordMinimum, coordMaximum):
+        """Merge partial statistics into the running statistics.
+
+        All arrays are indexed by label. m2 is the sum of squared
+        deviations from the mean (i.e. count * population variance).
+        Rows with count 0 are ignored.
+
+        """
+        count = np.asarray(count, dtype=np.float64).reshape(-1)
+        self._grow(count.shape[0], mean.shape[1], coordMean.shape[1])
+        n = count.shape[0]
+
+        present = count > 0
+        # vigra may report NaNs for labels that do not occur in a tile
+        absent = ~present.reshape(-1, 1)
+        mean = np.where(absent, 0, mean)
+        m2 = np.where(absent, 0, m2)
+        coordMean = np.where(absent, 0, coordMean)
+
+        na = self.count[:n]
+        nb = count
+        total = na + nb
+        # avoid 0/0 for labels that are not present in either part
+        safe_total = np.where(total > 0, total, 1).reshape(-1, 1)
+        na2 = na.reshape(-1, 1)
+        nb2 = nb.reshape(-1, 1)
+
+        delta = mean - self._mean[:n]
+        self._m2[:n] += m2 + delta**2 * na2 * nb2 / safe_total
+        self._mean[:n] += delta * nb2 / safe_total
+        self._coordMean[:n] += (coordMean - self._coordMean[:n]) * nb2 / safe_total
+
+        first = present & (na == 0)
+        both = present & (na > 0)
+        for running, partial, combine in [(self._minimum, minimum, np.minimum),
+                                         (self._maximum, maximum, np.maximum),
+                                         (self._coordMinimum, coordMinimum, np.minimum),
+                                         (self._coordMaximum, coordMaximum, np.maximum)]:
+            running[:n][first] = partial[first]
+            running[:n][both] = combine(running[:n][both], partial[both])
+
+        self.count[:n] = total
+
+    def features(self, feature_names):
+        """Return the requested features as a dict of arrays with
+        shape (nlabels - 1, k), i.e. without the background row.
+
+        """
+        count = self.count.reshape(-1, 1)
+        result = {}
+        for name in feature_names:
+            if name == 'Count':
+                value = count
+            elif name == 'Sum':
+                value = self._mean * count
+            elif name == 'Mean':
+                value = self._mean
+            elif name == 'Variance':
+                value = self._m2 / np.where(count > 0, count, 1)
+            elif name == 'Minimum':
+                value = self._minimum
+            elif name == 'Maximum':
+                value = self._maximum
+            elif name == 'RegionCenter':
+                value = self._coordMean
+            elif name == 'Coord<Minimum>':
+                value = self._coordMinimum
+            elif name == 'Coord<Maximum>':
+                value = self._coordMaximum
+            else:
+                raise KeyError("Feature {} cannot be computed tile-wise".format(name))
+            result[name] = value[1:].copy()
+        return result
+
+    @staticmethod
+    def _as2d(a):
+        a = np.asarray(a, dtype=np.float64)
+        return a.reshape(a.shape[0], -1)
+
+    def _grow(self, nlabels, nchannels, ndim):
+        old = self.nlabels
+        if nlabels <= old:
+            return
+        def extend(a, ncols):
+            new = np.zeros((nlabels, ncols), dtype=np.float64)
+            if a is not None:
+                new[:old] = a
+            return new
+        if self.count is None:
+            self.count = np.zeros((nlabels,), dtype=np.float64)
+        else:
+            self.count = np.concatenate((self.count, np.zeros((nlabels - old,))))
+        self._mean = extend(self._mean, nchannels)
+        self._m2 = extend(self._m2, nchannels)
+        self._minimum = extend(self._minimum, nchannels)
+        self._maximum = extend(self._maximum, nchannels)
+        self._coordMean = extend(self._coordMean, ndim)
+        self._coordMinimum = extend(self._coordMinimum, ndim)
+        self._coordMaximum = extend(self._coordMaximum, ndim)
@@ -22,6 +22,9 @@ class PixelClassificationSerializer(AppletSerializer):
     workflow parameters and datasets.
 
     """
+    # Batch prediction only needs the classifier, not the labels.
+    loadProfiles = { 'prediction' : ['LabelNames', 'LabelColors', 'PmapColors', 'ClassifierForests'] }
+
     def __init__(self, operator, projectFileGroupName):
         self._serialClassifierSlot =  SerialClassifierSlot(operator.Classifier,
                                                            operator.classifier_cache,
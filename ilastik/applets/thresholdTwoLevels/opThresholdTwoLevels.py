@@ -18,6 +18,8 @@
 import gc
 import warnings
 import logging
+import threading
+import collections
 from functools import partial
 
 # Third-party
@@ -30,12 +32,13 @@ from lazyflow.graph import Operator, InputSlot, OutputSlot
 from lazyflow.operators import OpMultiArraySlicer2, OpPixelOperator, OpLabelVolume, OpFilterLabels, \
                                OpCompressedCache, OpColorizeLabels, OpSingleChannelSelector, OperatorWrapper, \
                                OpMultiArrayStacker, OpMultiArraySlicer, OpReorderAxes
-from lazyflow.roi import extendSlice, TinyVector
+from lazyflow.roi import extendSlice, TinyVector, getIntersectingBlocks, getBlockBounds, getIntersection, roiToSlice
 from lazyflow.rtype import SubRegion
-from lazyflow.request import Request, RequestPool
+from lazyflow.request import Request, RequestPool, RequestLock
 
 # ilastik
 from lazyflow.utility.timer import Timer
+from ilastik.utility.opBlockwiseConnectedComponents import OpBlockwiseConnectedComponents
 
 logger = logging.getLogger(__name__)
 
@@ -52,9 +55,17 @@ def getMemoryUsageMb():
 
 
 #TODO: hide this operator somewhere. deep.
+#
+# Requests that span more than TileSlices slices along the first spatial axis are
+# smoothed separably, tile by tile (see _executeTiled): each input slice is fetched
+# and smoothed in-plane only once, and the tiles share these slices as their halo.
+# The in-plane smoothed slices are kept as IntermediateDtype (float32, float16 or uint8)
+# until they are combined along the tiled axis.
 class OpAnisotropicGaussianSmoothing(Operator):
     Input = InputSlot()
     Sigmas = InputSlot( value={'x':1.0, 'y':1.0, 'z':1.0} )
+    TileSlices = InputSlot( value=64 ) # 0: Never tile
+    IntermediateDtype = InputSlot( value=numpy.float32 )
     
     Output = OutputSlot()
 
@@ -71,11 +82,18 @@ class OpAnisotropicGaussianSmoothing(Operator):
         self._sigmas = self.Sigmas.value
         assert isinstance(self.Sigmas.value, dict), "Sigmas slot expects a dict"
         assert set(self._sigmas.keys()) == set('xyz'), "Sigmas slot expects three key-value pairs for x,y,z"
+        assert numpy.dtype(self.IntermediateDtype.value) in map(numpy.dtype, (numpy.float32, numpy.float16, numpy.uint8)), \
+            "Unsupported intermediate dtype: {}".format( self.IntermediateDtype.value )
         
         self.Output.setDirty( slice(None) )
     
     def execute(self, slot, subindex, roi, result):
         assert all(roi.stop <= self.Input.meta.shape), "Requested roi {} is too large for this input image of shape {}.".format( roi, self.Input.meta.shape )
+        tileAxis = self._getTileAxis()
+        tileSlices = self.TileSlices.value
+        if tileAxis is not None and tileSlices and roi.stop[tileAxis] - roi.start[tileAxis] > tileSlices:
+            return self._executeTiled(roi, result, tileAxis, tileSlices)
+
         # Determine how much input data we'll need, and where the result will be relative to that input roi
         inputRoi, computeRoi = self._getInputComputeRois(roi)        
         # Obtain the input data 
@@ -124,6 +142,123 @@ class OpAnisotropicGaussianSmoothing(Operator):
         assert tuple(smoothed.shape) == expectedShape, "Smoothed data shape {} didn't match expected shape {}".format( smoothed.shape, roi.stop - roi.start )
         return result
     
+    def _getTileAxis(self):
+        """
+        Return the index of the axis along which requests are tiled,
+        or None if this image can't be smoothed tile by tile.
+        """
+        tagged_shape = self.Input.meta.getTaggedShape()
+        if 't' in tagged_shape or tagged_shape.get('c', 1) != 1:
+            return None
+        spatialkeys = filter( lambda k: k in 'xyz', tagged_shape.keys() )
+        if len(spatialkeys) != 3 or 1 in [tagged_shape[k] for k in spatialkeys]:
+            return None
+        if any( self._sigmas[k] < 0.1 for k in spatialkeys ):
+            return None
+        # Slices along the first axis are contiguous in memory
+        return tagged_shape.keys().index( spatialkeys[0] )
+
+    def _executeTiled(self, roi, result, tileAxis, tileSlices):
+        axiskeys = self.Input.meta.getAxisKeys()
+        numSlices = self.Input.meta.shape[tileAxis]
+        kernel = vigra.filters.gaussianKernel( self._sigmas[axiskeys[tileAxis]], 1.0, 2.0 )
+        radius = kernel.right()
+        weights = [ (offset, kernel[offset]) for offset in range(kernel.left(), kernel.right()+1) ]
+
+        # Output slice i is the weighted sum of the in-plane smoothed slices i-radius..i+radius.
+        # Slices outside the image are mirrored, as in vigra's default border treatment.
+        def sourceSlice(i):
+            if i < 0:
+                return -i
+            if i >= numSlices:
+                return 2*(numSlices-1) - i
+            return i
+
+        planes = collections.OrderedDict() # slice index -> in-plane smoothed slice (intermediate dtype)
+        for tileStart in range( roi.start[tileAxis], roi.stop[tileAxis], tileSlices ):
+            tileStop = min( tileStart + tileSlices, roi.stop[tileAxis] )
+
+            # Forget the slices that no later tile needs (we move forward only)
+            for i in planes.keys():
+                if i < tileStart - radius:
+                    del planes[i]
+
+            needed = set( sourceSlice(i + offset) for i in range(tileStart, tileStop) for offset, _ in weights )
+            missing = sorted( needed.difference( planes.keys() ) )
+            if missing:
+                planes.update( self._smoothPlanes( roi, tileAxis, missing[0], missing[-1]+1 ) )
+
+            for i in range(tileStart, tileStop):
+                outputSlice = numpy.zeros( planes[sourceSlice(i)].shape, dtype=numpy.float32 )
+                for offset, weight in weights:
+                    outputSlice += weight * self._fromIntermediate( planes[sourceSlice(i + offset)] )
+                resultKey = [slice(None)] * len(axiskeys)
+                resultKey[tileAxis] = i - roi.start[tileAxis]
+                resultKey[axiskeys.index('c')] = 0
+                result[tuple(resultKey)] = outputSlice
+        return result
+
+    def _smoothPlanes(self, roi, tileAxis, firstSlice, stopSlice):
+        """
+        Fetch the input slices firstSlice..stopSlice-1 along the tile axis and smooth each of them in-plane.
+        Returns a dict of { slice index : smoothed slice (cropped to the requested roi, intermediate dtype) }.
+        """
+        axiskeys = self.Input.meta.getAxisKeys()
+        cIndex = axiskeys.index('c')
+        planeAxes = [ i for i, k in enumerate(axiskeys) if k in 'xyz' and i != tileAxis ]
+        planeSigmas = [ self._sigmas[axiskeys[i]] for i in planeAxes ]
+
+        inputRoi, _ = self._getInputComputeRois(roi)
+        inputStart = numpy.array( inputRoi[0] )
+        inputStop = numpy.array( inputRoi[1] )
+        inputStart[tileAxis] = firstSlice
+        inputStop[tileAxis] = stopSlice
+        planeComputeRoi = ( tuple( int(roi.start[i] - inputStart[i]) for i in planeAxes ),
+                            tuple( int(roi.stop[i] - inputStart[i]) for i in planeAxes ) )
+
+        with Timer() as resultTimer:
+            data = self.Input( inputStart, inputStop ).wait()
+        logger.debug("Obtaining input data took {} seconds for roi {}".format( resultTimer.seconds(), (inputStart, inputStop) ))
+
+        planes = {}
+        def smoothPlane(i):
+            key = [slice(None)] * len(axiskeys)
+            key[tileAxis] = i - firstSlice
+            key[cIndex] = 0
+            plane = numpy.asarray( data[tuple(key)], dtype=numpy.float32 )
+            smoothed = vigra.filters.gaussianSmoothing(plane, planeSigmas, window_size=2.0, roi=planeComputeRoi)
+            planes[i] = self._toIntermediate( numpy.asarray(smoothed) )
+
+        pool = RequestPool()
+        for i in range(firstSlice, stopSlice):
+            pool.add( Request( partial(smoothPlane, i) ) )
+        pool.wait()
+        pool.clean()
+        return planes
+
+    def _getIntermediateScale(self):
+        """
+        For the uint8 intermediate mode: the factor that maps the input range to 0..255.
+        """
+        drange = self.Input.meta.drange
+        if drange is None:
+            assert self.Input.meta.dtype == numpy.uint8, \
+                "A uint8 intermediate needs uint8 input data or a known drange."
+            drange = (0, 255)
+        assert drange[0] == 0, "Don't know how to quantize data with this drange."
+        return 255.0 / drange[1]
+
+    def _toIntermediate(self, plane):
+        dtype = numpy.dtype( self.IntermediateDtype.value )
+        if dtype == numpy.uint8:
+            plane = numpy.clip( plane * self._getIntermediateScale() + 0.5, 0, 255 )
+        return plane.astype( dtype )
+
+    def _fromIntermediate(self, plane):
+        if plane.dtype == numpy.uint8:
+            return plane.astype( numpy.float32 ) / self._getIntermediateScale()
+        return numpy.asarray( plane, dtype=numpy.float32 )
+
     def _getInputComputeRois(self, roi):
         axiskeys = self.Input.meta.getAxisKeys()
         spatialkeys = filter( lambda k: k in 'xyz', axiskeys )
@@ -176,8 +311,10 @@ class OpAnisotropicGaussianSmoothing(Operator):
             # Halo calculation is bidirectional, so we can re-use the function that computes the halo during execute()
             inputRoi, _ = self._getInputComputeRois(roi)
             self.Output.setDirty( inputRoi[0], inputRoi[1] )
-        elif slot == self.Sigmas:
+        elif slot == self.Sigmas or slot == self.IntermediateDtype:
             self.Output.setDirty( slice(None) )
+        elif slot == self.TileSlices:
+            pass # Only the order of the computation changes
         else:
             assert False, "Unknown input slot: {}".format( slot.name )
 
@@ -202,6 +339,13 @@ class OpAnisotropicGaussianSmoothing(Operator):
 #
 #   Given two label images, produce a copy of BigLabels, EXCEPT first remove all labels 
 #   from BigLabels that do not overlap with any labels in SmallLabels.
+#
+#   If BlockShape is given, the inputs are processed block by block in two passes:
+#   first the ids of the big labels that overlap with small labels are collected
+#   for the whole time slice (only the ids are kept in memory), then each requested
+#   block is relabeled on its own.  This requires BigLabels to be consistent across
+#   blocks (e.g. from OpBlockwiseConnectedComponents), and works for volumes that
+#   don't fit into RAM.
 class OpSelectLabels(Operator):
 
     ## The smaller clusters
@@ -212,15 +356,30 @@ class OpSelectLabels(Operator):
     # i.e. results of low thresholding
     BigLabels = InputSlot()
 
+    ## Optional dict of SPATIAL block dims, e.g. {'x': 256, 'y': 256, 'z': 256}
+    # If given, the labels are selected blockwise (see above)
+    BlockShape = InputSlot(optional=True)
+
     Output = OutputSlot()
 
+    def __init__(self, *args, **kwargs):
+        super(OpSelectLabels, self).__init__(*args, **kwargs)
+        self._passedLabels = {}  # For the blockwise mode, indexed by the non-spatial coordinates of a slice
+        self._sliceLocks = {}  # slice key -> RequestLock, held while the first pass of that slice runs
+        self._generation = 0  # Incremented whenever selections are invalidated
+        # Only protects the dicts above, never held while computing
+        self._lock = threading.Lock()
+
     def setupOutputs(self):
         self.Output.meta.assignFrom(self.BigLabels.meta)
         self.Output.meta.dtype = numpy.uint32
         self.Output.meta.drange = (0, 1)
+        self._invalidatePassedLabels()
 
     def execute(self, slot, subindex, roi, result):
         assert slot == self.Output
+        if self.BlockShape.ready():
+            return self._executeBlockwise(roi, result)
 
         # This operator is typically used with very big rois, so be extremely memory-conscious:
         # - Don't request the small and big inputs in parallel.
@@ -279,13 +438,141 @@ class OpSelectLabels(Operator):
         logMemoryIncrease("Just before return")
         return result
 
+    def _executeBlockwise(self, roi, result):
+        block_shape = self._getBlockShape()
+        block_starts = getIntersectingBlocks(block_shape, (roi.start, roi.stop))
+
+        def relabel_block(block_start):
+            block_roi = getBlockBounds(self.Output.meta.shape, block_shape, block_start)
+            intersection = getIntersection(block_roi, (roi.start, roi.stop))
+            passed = self._getPassedLabels(self._sliceKey(block_start))
+            bigLabels = self.BigLabels(*intersection).wait()
+            result[roiToSlice(*numpy.subtract(intersection, roi.start))] = _relabelSelected(bigLabels, passed)
+
+        pool = RequestPool()
+        for block_start in block_starts:
+            pool.add(Request(partial(relabel_block, block_start)))
+        pool.wait()
+        pool.clean()
+        return result
+
+    def _getBlockShape(self):
+        block_shape_dict = self.BlockShape.value
+        block_shape = []
+        for k, size in self.BigLabels.meta.getTaggedShape().items():
+            if k in 'xyz':
+                block_shape.append(min(block_shape_dict[k], size))
+            else:
+                block_shape.append(1)
+        return numpy.array(block_shape)
+
+    def _sliceKey(self, coords):
+        keys = self.BigLabels.meta.getAxisKeys()
+        return tuple(int(x) for k, x in zip(keys, coords) if k not in 'xyz')
+
+    def _getPassedLabels(self, slice_key):
+        with self._lock:
+            passed = self._passedLabels.get(slice_key)
+            if passed is not None:
+                return passed
+            sliceLock = self._sliceLocks.setdefault(slice_key, RequestLock())
+
+        # Slices are computed concurrently, but each slice only once
+        with sliceLock:
+            with self._lock:
+                passed = self._passedLabels.get(slice_key)
+                if passed is not None:
+                    return passed
+                generation = self._generation
+            passed = self._collectPassedLabels(slice_key)
+            with self._lock:
+                # Don't keep a selection that became dirty while it was computed
+                if generation == self._generation:
+                    self._passedLabels[slice_key] = passed
+            return passed
+
+    def _invalidatePassedLabels(self, isAffected=None):
+        """
+        Forget the selections of the slices for which isAffected(slice_key) is True (default: all).
+        """
+        with self._lock:
+            self._generation += 1
+            for slice_key in self._passedLabels.keys():
+                if isAffected is None or isAffected(slice_key):
+                    del self._passedLabels[slice_key]
+
+    def _collectPassedLabels(self, slice_key):
+        """
+        First pass of the blockwise mode: return the sorted ids of all big labels
+        in the given slice that overlap with a small label.
+        """
+        keys = self.BigLabels.meta.getAxisKeys()
+        slice_start = numpy.zeros((len(keys),), dtype=int)
+        slice_stop = numpy.array(self.BigLabels.meta.shape)
+        nonspatial = iter(slice_key)
+        for i, k in enumerate(keys):
+            if k not in 'xyz':
+                slice_start[i] = next(nonspatial)
+                slice_stop[i] = slice_start[i] + 1
+
+        block_shape = self._getBlockShape()
+        block_starts = getIntersectingBlocks(block_shape, (slice_start, slice_stop))
+        block_passed = []
+
+        def collect_block(block_start):
+            block_roi = getBlockBounds(self.BigLabels.meta.shape, block_shape, block_start)
+            # Don't request the small and big inputs in parallel (see execute())
+            smallNonZero = (self.SmallLabels(*block_roi).wait() != 0)
+            if not smallNonZero.any():
+                return
+            bigLabels = self.BigLabels(*block_roi).wait()
+            block_passed.append(numpy.unique(bigLabels[smallNonZero]))
+
+        pool = RequestPool()
+        for block_start in block_starts:
+            pool.add(Request(partial(collect_block, block_start)))
+        pool.wait()
+        pool.clean()
+
+        if not block_passed:
+            return numpy.zeros((0,), dtype=numpy.uint32)
+        passed = numpy.unique(numpy.concatenate(block_passed))
+        # 0 is not a valid label
+        passed = numpy.setdiff1d(passed, (0,))
+        logger.debug("Slice {}: {} labels passed".format(slice_key, len(passed)))
+        return passed
+
     def propagateDirty(self, slot, subindex, roi):
         if slot == self.SmallLabels or slot == self.BigLabels:
+            # Forget the selection of the affected slices
+            keys = self.BigLabels.meta.getAxisKeys()
+            nonspatial = [i for i, k in enumerate(keys) if k not in 'xyz']
+            def isAffected(slice_key):
+                return all(roi.start[i] <= x < roi.stop[i] for i, x in zip(nonspatial, slice_key))
+            self._invalidatePassedLabels(isAffected)
+            self.Output.setDirty(slice(None))
+        elif slot == self.BlockShape:
+            self._invalidatePassedLabels()
             self.Output.setDirty(slice(None))
         else:
             assert False, "Unknown input slot: {}".format(slot.name)
 
 
+def _relabelSelected(labels, selected):
+    """
+    Map the labels in the (sorted) array selected to 1..len(selected),
+    and all other labels to 0.
+    """
+    result = numpy.zeros(labels.shape, dtype=numpy.uint32)
+    if len(selected) == 0:
+        return result
+    index = numpy.searchsorted(selected, labels)
+    index = numpy.minimum(index, len(selected) - 1)
+    match = (selected[index] == labels)
+    result[match] = index[match] + 1
+    return result
+
+
 ## High level operator for one/two level threshold
 class OpThresholdTwoLevels(Operator):
     name = "OpThresholdTwoLevels"
@@ -302,6 +589,10 @@ class OpThresholdTwoLevels(Operator):
     Channel = InputSlot(value=0)
     CurOperator = InputSlot(stype='int', value=0)
 
+    # Optional dict of SPATIAL block dims.  If given, the objects are labeled
+    # and filtered blockwise (for volumes that don't fit into RAM).
+    BlockShape = InputSlot(optional=True)
+
     Output = OutputSlot()
 
     CachedOutput = OutputSlot()  # For the GUI (blockwise-access)
@@ -357,6 +648,7 @@ class OpThresholdTwoLevels(Operator):
         self.opThreshold1.Threshold.connect(self.SingleThreshold)
         self.opThreshold1.MinSize.connect(self.MinSize)
         self.opThreshold1.MaxSize.connect(self.MaxSize)
+        self.opThreshold1.BlockShape.connect(self.BlockShape)
 
         # double threshold operator
         self.opThreshold2 = _OpThresholdTwoLevels(parent=self)
@@ -365,6 +657,7 @@ class OpThresholdTwoLevels(Operator):
         self.opThreshold2.MaxSize.connect(self.MaxSize)
         self.opThreshold2.LowThreshold.connect(self.LowThreshold)
         self.opThreshold2.HighThreshold.connect(self.HighThreshold)
+        self.opThreshold2.BlockShape.connect(self.BlockShape)
 
         # HACK: For backwards compatibility with old projects, 
         #       the cache must by in xyzct order,
@@ -422,8 +715,7 @@ class OpThresholdTwoLevels(Operator):
             # connect the operators for SingleThreshold
             self._opReorder2.Input.connect(self.opThreshold1.Output)
             # Blockshape is the entire block, except only 1 time slice
-            tagged_shape = self.opThreshold1.Output.meta.getTaggedShape()
-            tagged_shape['t'] = 1
+            tagged_shape = self._getCacheBlockShape(self.opThreshold1.Output)
             
             # Blockshape must correspond to cache input order
             blockshape = map( lambda k: tagged_shape[k], 'xyzct' )
@@ -449,8 +741,7 @@ class OpThresholdTwoLevels(Operator):
             # connect the operators for TwoLevelThreshold
             self._opReorder2.Input.connect(self.opThreshold2.Output)
             # Blockshape is the entire block, except only 1 time slice
-            tagged_shape = self.opThreshold2.Output.meta.getTaggedShape()
-            tagged_shape['t'] = 1
+            tagged_shape = self._getCacheBlockShape(self.opThreshold2.Output)
 
             # Blockshape must correspond to cache input order
             blockshape = map( lambda k: tagged_shape[k], 'xyzct' )
@@ -473,6 +764,13 @@ class OpThresholdTwoLevels(Operator):
             #we only have two tabs
             return
 
+    def _getCacheBlockShape(self, slot):
+        """
+        The tagged block shape for our cache: one time slice,
+        and in blockwise mode also at most one block in space.
+        """
+        return _getTaggedBlockShape(slot, self.BlockShape)
+
     def setInSlot(self, slot, subindex, roi, value):
         pass
 
@@ -493,6 +791,7 @@ class _OpThresholdOneLevel(Operator):
     MinSize = InputSlot(stype='int', value=0)
     MaxSize = InputSlot(stype='int', value=1000000)
     Threshold = InputSlot(stype='float', value=0.5)
+    BlockShape = InputSlot(optional=True)  # If given, label and filter blockwise
 
     Output = OutputSlot()
 
@@ -516,6 +815,14 @@ class _OpThresholdOneLevel(Operator):
         self._opFilter.MaxLabelSize.connect( self.MaxSize )
         self._opFilter.BinaryOut.setValue(False)
 
+        # Blockwise mode: the label sizes are counted during labeling,
+        # so the size filter is just a table lookup.
+        self._opBlockwiseLabeler = OpBlockwiseConnectedComponents(parent=self)
+        self._opBlockwiseLabeler.BlockShape.connect(self.BlockShape)
+        self._opBlockwiseLabeler.MinLabelSize.connect(self.MinSize)
+        self._opBlockwiseLabeler.MaxLabelSize.connect(self.MaxSize)
+        self._blockwise = False
+
         self.Output.connect(self._opFilter.Output)
 
     def setupOutputs(self):
@@ -535,6 +842,18 @@ class _OpThresholdOneLevel(Operator):
 
         self._opThresholder.Function.setValue(
             partial(thresholdToUint8, self.Threshold.value))
+
+        if self.BlockShape.ready() != self._blockwise:
+            self._blockwise = self.BlockShape.ready()
+            if self._blockwise:
+                self._opBlockwiseLabeler.Input.connect(self._opThresholder.Output)
+                self.BeforeSizeFilter.connect(self._opBlockwiseLabeler.Output)
+                self.Output.connect(self._opBlockwiseLabeler.FilteredOutput)
+            else:
+                self.BeforeSizeFilter.connect(self._opLabeler.CachedOutput)
+                self.Output.connect(self._opFilter.Output)
+                self._opBlockwiseLabeler.Input.disconnect()
+
         # Copy the input metadata to the output
         self.Output.meta.assignFrom(self.InputImage.meta)
         self.Output.meta.dtype=numpy.uint32
@@ -563,6 +882,7 @@ class _OpThresholdTwoLevels(Operator):
     MaxSize = InputSlot(stype='int', value=1000000)
     HighThreshold = InputSlot(stype='float', value=0.5)
     LowThreshold = InputSlot(stype='float', value=0.2)
+    BlockShape = InputSlot(optional=True)  # If given, label, select and filter blockwise
 
     Output = OutputSlot()
     CachedOutput = OutputSlot()  # For the GUI (blockwise-access)
@@ -588,6 +908,11 @@ class _OpThresholdTwoLevels(Operator):
     #           opLowThresholder ----> opLowLabeler --------------------------                                       InputHdf5     --> OutputHdf5
     #                   /                \                                                                                        -> CleanBlocks
     #           LowThreshold            --(cache)--> BigRegions
+    #
+    # In blockwise mode (BlockShape is given), opHighLabeler and opHighLabelSizeFilter are replaced
+    # by opHighBlockwiseLabeler, and opLowLabeler by opLowBlockwiseLabeler.  These filter the labels
+    # by size while labeling, so opSelectLabels (also blockwise) feeds the cache directly:
+    # each selected object is a big label, so it was already filtered by opLowBlockwiseLabeler.
 
     def __init__(self, *args, **kwargs):
         super(_OpThresholdTwoLevels, self).__init__(*args, **kwargs)
@@ -625,6 +950,18 @@ class _OpThresholdTwoLevels(Operator):
         self._opFinalLabelSizeFilter.MaxLabelSize.connect( self.MaxSize )
         self._opFinalLabelSizeFilter.BinaryOut.setValue(False)
 
+        # Blockwise mode
+        self._opHighBlockwiseLabeler = OpBlockwiseConnectedComponents(parent=self)
+        self._opHighBlockwiseLabeler.BlockShape.connect(self.BlockShape)
+        self._opHighBlockwiseLabeler.MinLabelSize.connect(self.MinSize)
+        self._opHighBlockwiseLabeler.MaxLabelSize.connect(self.MaxSize)
+
+        self._opLowBlockwiseLabeler = OpBlockwiseConnectedComponents(parent=self)
+        self._opLowBlockwiseLabeler.BlockShape.connect(self.BlockShape)
+        self._opLowBlockwiseLabeler.MinLabelSize.connect(self.MinSize)
+        self._opLowBlockwiseLabeler.MaxLabelSize.connect(self.MaxSize)
+        self._blockwise = False
+
         self._opCache = OpCompressedCache( parent=self )
         self._opCache.name = "_OpThresholdTwoLevels._opCache"
         self._opCache.InputHdf5.connect( self.InputHdf5 )
@@ -677,13 +1014,33 @@ class _OpThresholdTwoLevels(Operator):
         self._opHighThresholder.Function.setValue(
             partial(thresholdToUint8, self.HighThreshold.value))
 
+        if self.BlockShape.ready() != self._blockwise:
+            self._blockwise = self.BlockShape.ready()
+            if self._blockwise:
+                self._opHighBlockwiseLabeler.Input.connect(self._opHighThresholder.Output)
+                self._opLowBlockwiseLabeler.Input.connect(self._opLowThresholder.Output)
+                self._opSelectLabels.SmallLabels.connect(self._opHighBlockwiseLabeler.FilteredOutput)
+                self._opSelectLabels.BigLabels.connect(self._opLowBlockwiseLabeler.FilteredOutput)
+                self._opSelectLabels.BlockShape.connect(self.BlockShape)
+                self._opFilteredSmallLabelsCache.Input.connect(self._opHighBlockwiseLabeler.FilteredOutput)
+                self._opCache.Input.connect(self._opSelectLabels.Output)
+                self.Output.connect(self._opSelectLabels.Output)
+            else:
+                self._opSelectLabels.SmallLabels.connect(self._opHighLabelSizeFilter.Output)
+                self._opSelectLabels.BigLabels.connect(self._opLowLabeler.CachedOutput)
+                self._opSelectLabels.BlockShape.disconnect()
+                self._opFilteredSmallLabelsCache.Input.connect(self._opHighLabelSizeFilter.Output)
+                self._opCache.Input.connect(self._opFinalLabelSizeFilter.Output)
+                self.Output.connect(self._opFinalLabelSizeFilter.Output)
+                for op in (self._opHighBlockwiseLabeler, self._opLowBlockwiseLabeler):
+                    op.Input.disconnect()
+
         # Copy the input metadata to the output
         self.Output.meta.assignFrom(self.InputImage.meta)
         self.Output.meta.dtype = numpy.uint32
 
         # Blockshape is the entire block, except only 1 time slice
-        tagged_shape = self.Output.meta.getTaggedShape()
-        tagged_shape['t'] = 1
+        tagged_shape = _getTaggedBlockShape(self.Output, self.BlockShape)
         self._opCache.BlockShape.setValue(
             tuple(tagged_shape.values()))
         self._opBigRegionCache.BlockShape.setValue(
@@ -707,6 +1064,20 @@ class _OpThresholdTwoLevels(Operator):
         #  so all calls to __setitem__ are forwarded automatically
 
 
+def _getTaggedBlockShape(slot, blockShapeSlot):
+    """
+    Return the tagged shape of the given slot, reduced to a single time slice and
+    (if the optional blockShapeSlot is ready) to the spatial block shape it contains.
+    """
+    tagged_shape = slot.meta.getTaggedShape()
+    tagged_shape['t'] = 1
+    if blockShapeSlot.ready():
+        for k, size in blockShapeSlot.value.items():
+            if k in tagged_shape:
+                tagged_shape[k] = min(size, tagged_shape[k])
+    return tagged_shape
+
+
 ## wrapper for OpFilterLabels
 # Wraps OpFilterLabels in time and channel dimension beacuse we want to filer
 # objects by size only in spatial dimensions.
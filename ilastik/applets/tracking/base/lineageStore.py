@@ -0,0 +1,266 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+import os
+import sys
+import Queue
+import threading
+
+import h5py
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+# (key in events_at, table name, number of object ids per event, format of the ids)
+EVENT_TABLES = [ ("app", "Appearances", 1, "timestep, cell label appeared in this timestep"),
+                 ("dis", "Disappearances", 1, "timestep, cell label disappeared in this timestep"),
+                 ("mov", "Moves", 2, "timestep, from (previous timestep), to (this timestep)"),
+                 ("div", "Splits", 3, "timestep, ancestor (previous timestep), descendant (this timestep), descendant (this timestep)"),
+                 ("merger", "Mergers", 2, "timestep, descendant (this timestep), number of objects") ]
+
+LABELS_DS = "segmentation/labels"
+WRITTEN_DS = "segmentation/written"
+TRACKS_DS = "tracking/Tracks"
+
+class LineageStoreWriter(object):
+    """
+    Writes the tracking result of a whole movie into a single HDF5 file:
+
+    - segmentation/labels: the label images of all timesteps, as one dataset
+      with one chunk row per timestep.
+    - tracking/<Event>: one appendable table per event type (Appearances, Moves, ...).
+      Column 0 is the timestep, the other columns are the object ids of the
+      event (in the same order as in the per-timestep files of write_events()).
+      tracking/<Event>-Energy holds the energy of each row.
+    - tracking/Tracks: rows of (timestep, object id, track id), if track ids are given.
+
+    The data is written by a background thread, so the caller can compute the next
+    timestep in the meantime.  write() only blocks if maxQueued timesteps are waiting.
+    Errors of the writer thread are raised by the next call to write() or close().
+    """
+    CHUNK_ROWS = 4096
+
+    def __init__(self, path, labelShape, numTimesteps, maxQueued=4, compression=1):
+        if os.path.exists(path):
+            raise IOError("File " + str(path) + " exists already. Please choose a different file or delete it.")
+        self._path = path
+        self._file = h5py.File(path, 'w')
+
+        chunks = (1,) + tuple( min(s, 256) for s in labelShape )
+        self._file.create_dataset(LABELS_DS, shape=(numTimesteps,) + tuple(labelShape), dtype=np.uint32,
+                                  chunks=chunks, compression=compression)
+        self._file.create_dataset(WRITTEN_DS, shape=(numTimesteps,), dtype=np.uint8)
+        for _, name, numIds, format in EVENT_TABLES:
+            self._createTable( name, 1 + numIds, format )
+        self._createTable( os.path.basename(TRACKS_DS), 3, "timestep, cell label, track id", withEnergy=False )
+
+        self._queue = Queue.Queue(maxsize=maxQueued)
+        self._exc_info = None
+        self._thread = threading.Thread( target=self._run, name="LineageStoreWriter" )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, t, events_at, labelImage, trackIds=None):
+        """
+        Queue the results of timestep t for writing.
+        events_at is a dict as returned by get_events_at(), trackIds an optional dict of { object id : track id }.
+        """
+        self._raiseWriterError()
+        self._queue.put( (t, events_at, np.asarray(labelImage), trackIds) )
+
+    def close(self):
+        """
+        Wait until everything is written and close the file.
+        """
+        if self._thread is not None:
+            self._queue.put( None )
+            self._thread.join()
+            self._thread = None
+            self._file.close()
+        self._raiseWriterError()
+
+    def _raiseWriterError(self):
+        if self._exc_info is not None:
+            exc_info, self._exc_info = self._exc_info, None
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self._exc_info is not None:
+                continue # Keep draining the queue, so write() doesn't block forever
+            try:
+                self._write( *item )
+            except:
+                logger.error( "Failed to write the lineage of timestep {} to {}".format( item[0], self._path ) )
+                self._exc_info = sys.exc_info()
+
+    def _write(self, t, events_at, labelImage, trackIds):
+        self._file[LABELS_DS][t] = labelImage
+        for key, name, numIds, _ in EVENT_TABLES:
+            events = np.asarray( events_at[key] ) if key in events_at else np.empty(0)
+            if len(events) == 0:
+                continue
+            rows = np.empty( (len(events), 1 + numIds), dtype=np.uint32 )
+            rows[:, 0] = t
+            rows[:, 1:] = events[:, :numIds]
+            self._append( name, rows, energies=events[:, -1] )
+        if trackIds:
+            rows = np.empty( (len(trackIds), 3), dtype=np.uint32 )
+            rows[:, 0] = t
+            rows[:, 1] = trackIds.keys()
+            rows[:, 2] = trackIds.values()
+            self._append( os.path.basename(TRACKS_DS), rows )
+        self._file[WRITTEN_DS][t] = 1
+        self._file.flush()
+
+    def _createTable(self, name, numColumns, format, withEnergy=True):
+        group = self._file.require_group("tracking")
+        ds = group.create_dataset(name, shape=(0, numColumns), maxshape=(None, numColumns), dtype=np.uint32,
+                                  chunks=(self.CHUNK_ROWS, numColumns), compression=1)
+        ds.attrs["Format"] = format
+        if withEnergy:
+            ds = group.create_dataset(name + "-Energy", shape=(0,), maxshape=(None,), dtype=np.double,
+                                      chunks=(self.CHUNK_ROWS,), compression=1)
+            ds.attrs["Format"] = "lower energy -> higher confidence"
+
+    def _append(self, name, rows, energies=None):
+        group = self._file["tracking"]
+        table = group[name]
+        start = table.shape[0]
+        table.resize( (start + len(rows), table.shape[1]) )
+        table[start:] = rows
+        if energies is not None:
+            energy = group[name + "-Energy"]
+            energy.resize( (start + len(rows),) )
+            energy[start:] = energies
+
+def exportLineage(path, events, timeRange, getLabelImage, numTimesteps, trackIds=None, progress=None):
+    """
+    Write a tracking result to a new lineage store at path.
+
+    events[str(k)] holds the events that lead into timestep timeRange[0]+k
+    (as returned by get_events()), so the first timestep has no events.
+    getLabelImage(t) returns the label image of timestep t, and trackIds[t]
+    (optional) the { object id : track id } dict of timestep t.
+    progress (optional) is called with the percentage of written timesteps.
+    """
+    first = timeRange[0]
+    def trackIdsAt(t):
+        if trackIds is None or t >= len(trackIds):
+            return None
+        return trackIds[t]
+
+    labelImage = getLabelImage(first)
+    # The label images are written by a background thread while the next one is computed
+    with LineageStoreWriter(path, labelImage.shape, numTimesteps) as writer:
+        writer.write(first, {}, labelImage, trackIdsAt(first))
+        keys = sorted(events.keys(), key=int)
+        for n, k in enumerate(keys):
+            t = first + int(k)
+            writer.write(t, events[k], getLabelImage(t), trackIdsAt(t))
+            if progress is not None:
+                progress(100 * (n+1) / len(keys))
+
+class LineageStore(object):
+    """
+    Random access to a file written by LineageStoreWriter.
+    The event tables are indexed on first use, so each lookup only reads the matching rows.
+    """
+    def __init__(self, path):
+        self._file = h5py.File(path, 'r')
+        self._index = {} # (table name, column) -> (row order sorted by that column, sorted values)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    @property
+    def numTimesteps(self):
+        return self._file[LABELS_DS].shape[0]
+
+    def writtenTimesteps(self):
+        return np.flatnonzero( self._file[WRITTEN_DS][:] )
+
+    def labels(self, t):
+        """
+        The label image of timestep t.
+        """
+        return self._file[LABELS_DS][t]
+
+    def events(self, t):
+        """
+        The events of timestep t, in the format of get_events_at():
+        a dict of arrays with the object ids and the energy in the last column.
+        """
+        events_at = {}
+        for key, name, _, _ in EVENT_TABLES:
+            rows = self._lookup( "tracking/" + name, 0, t )
+            if len(rows) == 0:
+                continue
+            energies = self._readRows( "tracking/" + name + "-Energy", rows )
+            ids = self._readRows( "tracking/" + name, rows )[:, 1:]
+            events_at[key] = np.column_stack( (ids, energies) )
+        return events_at
+
+    def track(self, trackId):
+        """
+        The objects of the given track, as an array of (timestep, object id) rows in time order.
+        """
+        rows = self._lookup( TRACKS_DS, 2, trackId )
+        objects = self._readRows( TRACKS_DS, rows )[:, :2]
+        return objects[ np.argsort( objects[:, 0], kind='mergesort' ) ]
+
+    def trackAt(self, trackId, t):
+        """
+        The object ids of the given track at timestep t (more than one after a division).
+        """
+        objects = self.track( trackId )
+        return objects[ objects[:, 0] == t, 1 ]
+
+    def _lookup(self, tableName, column, key):
+        """
+        Return the row numbers of the given table where the given column equals key.
+        """
+        if (tableName, column) not in self._index:
+            values = self._file[tableName][:, column] if self._file[tableName].shape[0] else np.empty(0, dtype=np.uint32)
+            order = np.argsort( values, kind='mergesort' )
+            self._index[(tableName, column)] = ( order, values[order] )
+        order, sortedValues = self._index[(tableName, column)]
+        first = np.searchsorted( sortedValues, key, side='left' )
+        stop = np.searchsorted( sortedValues, key, side='right' )
+        # h5py point selections must be increasing
+        return np.sort( order[first:stop] ).tolist()
+
+    def _readRows(self, datasetName, rows):
+        if len(rows) == 0:
+            dataset = self._file[datasetName]
+            return np.empty( (0,) + dataset.shape[1:], dtype=dataset.dtype )
+        return self._file[datasetName][rows]
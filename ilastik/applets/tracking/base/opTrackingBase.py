@@ -19,10 +19,10 @@ from lazyflow.rtype import List
 from lazyflow.stype import Opaque
 
 import numpy as np
-import pgmlink
-from ilastik.applets.tracking.base.trackingUtilities import relabel,\
-    get_dict_value
+from ilastik.applets.tracking.base.trackingUtilities import relabel, relabel_lut,\
+    get_dict_value, get_track_ids
 from ilastik.applets.objectExtraction.opObjectExtraction import default_features_key
+from ilastik.applets.tracking.base.traxelStoreBuilder import build_traxelstore, PgmlinkTraxelBackend
 from ilastik.applets.base.applet import DatasetConstraintError
 from lazyflow.operators.opCompressedCache import OpCompressedCache
 from lazyflow.operators.valueProviders import OpZeroDefault
@@ -55,6 +55,8 @@ class OpTrackingBase(Operator):
     def __init__(self, parent=None, graph=None):
         super(OpTrackingBase, self).__init__(parent=parent, graph=graph)        
         self.label2color = []    
+        self.trackIds = [] # indexed by t: { object id : track id }, unlike label2color without filtered objects
+        self.traxelStoreBackend = PgmlinkTraxelBackend() # Creates the traxels in _generate_traxelstore()
     
         self._opCache = OpCompressedCache( parent=self )        
         self._opCache.InputHdf5.connect( self.InputHdf5 )
@@ -123,7 +125,7 @@ class OpTrackingBase(Operator):
             t_end = roi.stop[0]
             for t in range(t_start, t_end):
                 if ('time_range' in parameters and t <= parameters['time_range'][-1] and t >= parameters['time_range'][0]) and len(self.label2color) > t:                
-                    result[t-t_start, ..., 0] = relabel(result[t-t_start, ..., 0], self.label2color[t])
+                    result[t-t_start, ..., 0] = relabel(result[t-t_start, ..., 0], self._getLabel2ColorLut(t))
                 else:
                     result[t-t_start,...] = 0
             return result         
@@ -153,6 +155,29 @@ class OpTrackingBase(Operator):
 
     def setInSlot(self, slot, subindex, roi, value):
         assert slot == self.InputHdf5, "Invalid slot for setInSlot(): {}".format( slot.name )
+
+    @property
+    def label2color(self):
+        return self._label2color
+
+    @label2color.setter
+    def label2color(self, label2color):
+        self._label2color = label2color
+        self._label2colorLuts = {} # indexed by t, built from label2color on demand
+
+    def _getLabel2ColorLut(self, t):
+        """
+        Return label2color[t] as a lookup table, so each request for this
+        timestep only needs a single vectorized relabeling.
+        """
+        luts = self._label2colorLuts
+        lut = luts.get(t)
+        if lut is None:
+            label2color_at = self.label2color[t]
+            max_label = max(label2color_at.keys()) if len(label2color_at) > 0 else 0
+            lut = relabel_lut(label2color_at, max_label, dtype=self.LabelImage.meta.dtype)
+            luts[t] = lut
+        return lut
         
     def _setLabel2Color(self, successive_ids=True):
         if not self.EventsVector.ready() or not self.Parameters.ready() \
@@ -169,19 +194,19 @@ class OpTrackingBase(Operator):
 #         z_range = parameters['z_range']
 #         
         filtered_labels = self.FilteredLabels.value
-                                                    
+
+        # The display ids are the track ids, or a random color per track
+        self.trackIds = get_track_ids(events, parameters['time_range'])
+        track2color = {}
         label2color = []
-        label2color.append({})
-        mergers = []
-        mergers.append({})
-        
-        maxId = 1 #  misdetections have id 1
-        
-        # handle start time offsets
-        for i in range(time_range[0]):            
-            label2color.append({})
-            mergers.append({})
-        
+        for ids_at in self.trackIds:
+            if successive_ids:
+                label2color.append(dict(ids_at))
+            else:
+                label2color.append(dict((l, track2color.setdefault(track, np.random.randint(1, 255)))
+                                        for l, track in ids_at.iteritems()))
+
+        mergers = [{} for t in range(time_range[0] + 1)]
         for i in time_range:
             dis = get_dict_value(events[str(i-time_range[0]+1)], "dis", [])            
             app = get_dict_value(events[str(i-time_range[0]+1)], "app", [])
@@ -195,36 +220,7 @@ class OpTrackingBase(Operator):
             logger.info( " {} mov at {}".format( len(mov), i ) )
             logger.info( " {} merger at {}\n".format( len(merger), i ) )
             
-            label2color.append({})
             mergers.append({})
-                        
-            for e in app:
-                if successive_ids:
-                    label2color[-1][e[0]] = maxId
-                    maxId += 1
-                else:
-                    label2color[-1][e[0]] = np.random.randint(1, 255)
-
-            for e in mov:                
-                if not label2color[-2].has_key(e[0]):
-                    if successive_ids:
-                        label2color[-2][e[0]] = maxId
-                        maxId += 1
-                    else:
-                        label2color[-2][e[0]] = np.random.randint(1, 255)
-                label2color[-1][e[1]] = label2color[-2][e[0]]
-
-            for e in div:
-                if not label2color[-2].has_key(e[0]):
-                    if successive_ids:
-                        label2color[-2][e[0]] = maxId
-                        maxId += 1
-                    else:
-                        label2color[-2][e[0]] = np.random.randint(1, 255)
-                ancestor_color = label2color[-2][e[0]]
-                label2color[-1][e[1]] = ancestor_color
-                label2color[-1][e[2]] = ancestor_color
-            
             for e in merger:
                 mergers[-1][e[0]] = e[1]
                 
@@ -280,84 +276,21 @@ class OpTrackingBase(Operator):
             localCenters = self.RegionLocalCenters(time_range).wait()
         
         logger.info( "filling traxelstore" )
-        ts = pgmlink.TraxelStore()
-                
-        max_traxel_id_at = pgmlink.VectorOfInt()  
-        filtered_labels = {}        
+        ts, traxels = build_traxelstore(feats, x_range, y_range, z_range, size_range,
+                                        (x_scale, y_scale, z_scale), self.traxelStoreBackend,
+                                        divProbs=divProbs if with_div else None,
+                                        localCenters=localCenters if with_local_centers else None)
+
+        filtered_labels = {}
         obj_sizes = []
-        total_count = 0
         empty_frame = False
-        for t in feats.keys():
-            rc = feats[t][default_features_key]['RegionCenter']
-            if rc.size:
-                rc = rc[1:, ...]
-
-            ct = feats[t][default_features_key]['Count']
-            if ct.size:
-                ct = ct[1:, ...]
-            
-            logger.info( "at timestep {}, {} traxels found".format( t, rc.shape[0] ) )
-            count = 0
-            filtered_labels_at = []
-            for idx in range(rc.shape[0]):
-                # for 2d data, set z-coordinate to 0:
-                if len(rc[idx]) == 2:
-                    x, y = rc[idx]
-                    z = 0
-                elif len(rc[idx]) == 3:                    
-                    x, y, z = rc[idx]
-                else:
-                    raise Exception, "The RegionCenter feature must have dimensionality 2 or 3."
-                size = ct[idx]
-                if (x < x_range[0] or x >= x_range[1] or
-                    y < y_range[0] or y >= y_range[1] or
-                    z < z_range[0] or z >= z_range[1] or
-                    size < size_range[0] or size >= size_range[1]):
-                    filtered_labels_at.append(int(idx + 1))
-                    continue
-                else:
-                    count += 1
-                tr = pgmlink.Traxel()
-                tr.set_x_scale(x_scale)
-                tr.set_y_scale(y_scale)
-                tr.set_z_scale(z_scale)
-                tr.Id = int(idx + 1)
-                tr.Timestep = t
-                
-                # pgmlink expects always 3 coordinates, z=0 for 2d data
-                tr.add_feature_array("com", 3)
-                for i, v in enumerate([x,y,z]):
-                    tr.set_feature_value('com', i, float(v))                    
-                
-                if with_div:
-                    tr.add_feature_array("divProb", 1)
-                    # idx+1 because rc and ct start from 1, divProbs starts from 0
-                    tr.set_feature_value("divProb", 0, float(divProbs[t][idx+1][1]))
-                
-                # FIXME: check whether it is 2d or 3d data!
-                if with_local_centers:
-                    tr.add_feature_array("localCentersX", len(localCenters[t][idx+1]))  
-                    tr.add_feature_array("localCentersY", len(localCenters[t][idx+1]))
-                    tr.add_feature_array("localCentersZ", len(localCenters[t][idx+1]))            
-                    for i, v in enumerate(localCenters[t][idx+1]):
-                        tr.set_feature_value("localCentersX", i, float(v[0]))
-                        tr.set_feature_value("localCentersY", i, float(v[1]))
-                        tr.set_feature_value("localCentersZ", i, float(v[2]))                
-                
-                tr.add_feature_array("count", 1)
-                tr.set_feature_value("count", 0, float(size))
-                if median_object_size is not None:
-                    obj_sizes.append(float(size))
-                ts.add(tr)   
-            
-            if len(filtered_labels_at) > 0:
-                filtered_labels[str(int(t)-time_range[0])] = filtered_labels_at
-            logger.info( "at timestep {}, {} traxels passed filter".format(t, count) )
-            max_traxel_id_at.append(int(rc.shape[0]))
-            if count == 0:
+        for traxels_at in traxels:
+            if len(traxels_at.filteredIds) > 0:
+                filtered_labels[str(int(traxels_at.t)-time_range[0])] = traxels_at.filteredIds
+            if len(traxels_at.ids) == 0:
                 empty_frame = True
-                
-            total_count += count
+            if median_object_size is not None:
+                obj_sizes.extend(traxels_at.sizes.tolist())
         
         if median_object_size is not None:
             median_object_size[0] = np.median(np.array(obj_sizes),overwrite_input=True)
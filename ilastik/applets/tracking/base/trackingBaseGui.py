@@ -26,7 +26,8 @@ import logging
 import os
 import numpy as np
 import vigra
-from ilastik.applets.tracking.base.trackingUtilities import relabel,write_events
+from ilastik.applets.tracking.base.trackingUtilities import relabel
+from ilastik.applets.tracking.base.lineageStore import exportLineage
 from volumina.layer import GrayscaleLayer
 from volumina.utility import encode_from_qstring
 from ilastik.applets.layerViewer.layerViewerGui import LayerViewerGui
@@ -309,55 +310,40 @@ class TrackingBaseGui( LayerViewerGui ):
             self.applet.progressSignal.emit(x)
         
         def _export():
-            t_from = None
-            # determine from_time (it could has been changed in the GUI meanwhile)            
-            for t_from, label2color_at in enumerate(self.mainOperator.label2color):
-                if len(label2color_at) == 0:                
-                    continue
-                else:
-                    break
-            
-            if t_from == None:
+            if not self.mainOperator.Parameters.ready() or not self.mainOperator.EventsVector.ready():
                 return
-            
-            logger.info( "Saving first label image..." )
-            key = []
-            for idx, flag in enumerate(axisTagsToString(self.mainOperator.LabelImage.meta.axistags)):
-                if flag is 't':
-                    key.append(slice(t_from,t_from+1))
-                elif flag is 'c':
-                    key.append(slice(0,1))                
-                else:
-                    key.append(slice(0,self.mainOperator.LabelImage.meta.shape[idx]))                        
-            
-            roi = SubRegion(self.mainOperator.LabelImage, key)
-            labelImage = self.mainOperator.LabelImage.get(roi).wait()
-            labelImage = labelImage[0,...,0]
-            
-            try:
-                write_events([], str(directory), t_from, labelImage)
-                
-                events = self.mainOperator.EventsVector.value
-                logger.info( "Saving events..." )
-                logger.info( "Length of events " + str(len(events)) )
-                
-                num_files = float(len(events))
-                for i in events.keys():
-                    events_at = events[i]
-                    t = t_from + i            
-                    key[0] = slice(t+1,t+2)
-                    roi = SubRegion(self.mainOperator.LabelImage, key)
-                    labelImage = self.mainOperator.LabelImage.get(roi).wait()
-                    labelImage = labelImage[0,...,0]
-                    if self.withMergers:                
-                        write_events(events_at, str(directory), t+1, labelImage, self.mainOperator.mergers)
+            # The time range could have been changed in the GUI meanwhile
+            time_range = self.mainOperator.Parameters.value['time_range']
+            events = self.mainOperator.EventsVector.value
+            logger.info( "Length of events " + str(len(events)) )
+
+            axes = axisTagsToString(self.mainOperator.LabelImage.meta.axistags)
+            def getLabelImage(t):
+                key = []
+                for idx, flag in enumerate(axes):
+                    if flag is 't':
+                        key.append(slice(t,t+1))
+                    elif flag is 'c':
+                        key.append(slice(0,1))
                     else:
-                        write_events(events_at, str(directory), t+1, labelImage)
-                    _handle_progress(i/num_files * 100)
-            except IOError as e:                    
-                self._criticalMessage("Cannot export the tracking results. Maybe these files already exist. "\
-                                      "Please delete them or choose a different directory.")
+                        key.append(slice(0,self.mainOperator.LabelImage.meta.shape[idx]))
+                roi = SubRegion(self.mainOperator.LabelImage, key)
+                return self.mainOperator.LabelImage.get(roi).wait()[0,...,0]
+
+            fn = os.path.join(str(directory), "lineage.h5")
+            if os.path.exists(fn):
+                self._criticalMessage("Cannot export the tracking results. The file " + fn + " already exists. "\
+                                      "Please delete it or choose a different directory.")
                 return
+
+            logger.info( "Saving events..." )
+            try:
+                exportLineage(fn, events, time_range, getLabelImage, self.mainOperator.LabelImage.meta.shape[0],
+                              trackIds=self.mainOperator.trackIds, progress=_handle_progress)
+            except Exception as e:
+                # e.g. no permission, disk full, or an error in the writer thread
+                logger.error( "Exporting the tracking results to {} failed".format( fn ), exc_info=True )
+                self._criticalMessage("Cannot export the tracking results to " + fn + ": " + str(e))
                 
         def _handle_finished(*args):
             self._drawer.exportButton.setEnabled(True)
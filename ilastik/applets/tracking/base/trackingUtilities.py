@@ -22,32 +22,45 @@ import pgmlink
 import logging
 logger = logging.getLogger(__name__)
 
+def relabel_lut(replace, max_label, default=1, dtype=np.uint32):
+    """
+    Return a lookup table (array) that maps each label 1..max_label to replace[label],
+    or to default if the label is not in replace.  The background (0) is mapped to 0.
+    replace may be a dict or a lookup table that was built by this function.
+    """
+    max_label = int(max_label)
+    if isinstance(replace, np.ndarray):
+        if len(replace) > max_label:
+            return replace.astype(dtype, copy=False)
+        lut = np.empty((max_label + 1,), dtype=dtype)
+        lut[:len(replace)] = replace
+        lut[len(replace):] = default
+        return lut
+
+    lut = np.empty((max_label + 1,), dtype=dtype)
+    lut[:] = default
+    lut[0] = 0
+    if len(replace) > 0:
+        labels = np.asarray(replace.keys(), dtype=np.int64)
+        values = np.asarray(replace.values())
+        valid = (labels > 0) & (labels <= max_label)
+        lut[labels[valid]] = values[valid]
+    return lut
+
 def relabel(volume, replace):
-    mp = np.arange(0, np.amax(volume) + 1, dtype=volume.dtype)
-    mp[1:] = 1
-    labels = np.unique(volume)
-    for label in labels:
-        if label > 0:
-            try:
-                r = replace[label]
-                mp[label] = r
-            except:                
-                pass
-#    mp[replace.keys()] = replace.values()
-    return mp[volume]
+    """
+    Replace each label l > 0 in volume by replace[l], or by 1 if l is not in replace.
+    replace may be a dict or a lookup table from relabel_lut().
+    """
+    return relabel_lut(replace, np.amax(volume), dtype=volume.dtype)[volume]
     
     
 def relabelMergers(volume, merger):
-    mp = np.arange(0, np.amax(volume) + 1, dtype=volume.dtype)    
-    mp[:] = 0
-    labels = np.unique(volume)
-    for label in labels:
-        if label > 0:
-            if label in merger:
-                mp[label] = merger[label]
-            else:
-                mp[label] = 1
-    return mp[volume]
+    """
+    Replace each label l > 0 in volume by merger[l] (the number of merged objects),
+    or by 1 if l is not a merger.
+    """
+    return relabel_lut(merger, np.amax(volume), dtype=volume.dtype)[volume]
 
 def get_dict_value(dic, key, default=[]):
     if key not in dic:
@@ -68,6 +81,40 @@ def get_events(eventsVector):
         events[str(t)] = get_events_at(eventsVector, t-1)
     return events
 
+def get_track_ids(events, time_range):
+    """
+    Follow the objects through the events and return a list, indexed by
+    timestep, of dicts { object id : track id }.  Track ids are numbered
+    1, 2, ... in the order in which the tracks start.  Both descendants of a
+    division keep the track id of their ancestor.
+
+    events[str(k)] holds the events between timesteps time_range[0]+k-1 and
+    time_range[0]+k, as returned by get_events().
+    """
+    track_ids = [{} for t in range(time_range[0] + 1)]
+    next_id = [1]
+    def track_of(ids_at, label):
+        label = int(label)
+        if label not in ids_at:
+            ids_at[label] = next_id[0]
+            next_id[0] += 1
+        return ids_at[label]
+
+    for t in range(time_range[0] + 1, time_range[1] + 1):
+        events_at = events[str(t - time_range[0])]
+        previous = track_ids[-1]
+        current = {}
+        for e in get_dict_value(events_at, "app", []):
+            track_of(current, e[0])
+        for e in get_dict_value(events_at, "mov", []):
+            current[int(e[1])] = track_of(previous, e[0])
+        for e in get_dict_value(events_at, "div", []):
+            ancestor = track_of(previous, e[0])
+            current[int(e[1])] = ancestor
+            current[int(e[2])] = ancestor
+        track_ids.append(current)
+    return track_ids
+
 def get_events_at(eventsVector, t):  
     dis = []
     app = []
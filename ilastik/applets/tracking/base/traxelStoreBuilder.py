@@ -0,0 +1,169 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+from functools import partial
+
+import numpy as np
+
+from lazyflow.request import Request, RequestPool
+
+from ilastik.applets.objectExtraction.opObjectExtraction import default_features_key
+
+import logging
+logger = logging.getLogger(__name__)
+
+class TimestepTraxels(object):
+    """
+    The objects of one timestep that passed the filter, as arrays with one row per traxel.
+    Object ids start at 1 (the row index in the region features, which include the background).
+    """
+    def __init__(self, t, ids, coms, sizes, divProbs=None, localCenters=None, filteredIds=None, numObjects=0):
+        self.t = t
+        self.ids = ids                   # (N,) int
+        self.coms = coms                 # (N,3) float, z=0 for 2d data
+        self.sizes = sizes               # (N,) float
+        self.divProbs = divProbs         # (N,) float, or None
+        self.localCenters = localCenters # list of N point lists, or None
+        self.filteredIds = filteredIds if filteredIds is not None else []
+        self.numObjects = numObjects
+
+def filter_objects(rc, ct, x_range, y_range, z_range, size_range):
+    """
+    Return a boolean mask of the objects whose center and size are within the given [min, max) ranges.
+    rc and ct are the RegionCenter and Count features without the background row.
+    Also returns the centers with 3 coordinates (z=0 for 2d data).
+    """
+    rc = np.asarray(rc, dtype=np.float64)
+    if rc.ndim != 2 or rc.shape[1] not in (2, 3):
+        raise Exception, "The RegionCenter feature must have dimensionality 2 or 3."
+    coms = np.zeros((rc.shape[0], 3), dtype=np.float64)
+    coms[:, :rc.shape[1]] = rc
+    sizes = np.asarray(ct, dtype=np.float64).reshape(-1)
+
+    passed = np.ones((rc.shape[0],), dtype=bool)
+    for values, (low, high) in zip((coms[:, 0], coms[:, 1], coms[:, 2], sizes),
+                                   (x_range, y_range, z_range, size_range)):
+        passed &= (values >= low) & (values < high)
+    return passed, coms, sizes
+
+def prepare_timestep(t, feats_at, x_range, y_range, z_range, size_range, divProbs_at=None, localCenters_at=None):
+    """
+    Filter the objects of one timestep and collect the traxel features as arrays.
+    """
+    rc = feats_at[default_features_key]['RegionCenter']
+    ct = feats_at[default_features_key]['Count']
+    if rc.size:
+        rc = rc[1:, ...]
+    if ct.size:
+        ct = ct[1:, ...]
+    if rc.size == 0:
+        rc = np.zeros((0, 3))
+
+    passed, coms, sizes = filter_objects(rc, ct, x_range, y_range, z_range, size_range)
+    ids = np.flatnonzero(passed) + 1
+
+    divProbs = None
+    if divProbs_at is not None:
+        # divProbs start from 0 (the background)
+        divProbs = np.asarray([divProbs_at[i][1] for i in ids], dtype=np.float64)
+
+    localCenters = None
+    if localCenters_at is not None:
+        localCenters = [localCenters_at[i] for i in ids]
+
+    return TimestepTraxels(t, ids, coms[passed], sizes[passed], divProbs, localCenters,
+                           filteredIds=(np.flatnonzero(~passed) + 1).tolist(),
+                           numObjects=rc.shape[0])
+
+def build_traxelstore(feats, x_range, y_range, z_range, size_range, scales, backend,
+                      divProbs=None, localCenters=None):
+    """
+    Build a traxel store from the region features of all timesteps.
+    The timesteps are filtered in parallel and then added to the store in order.
+
+    Returns a tuple (store, traxels), where traxels is the list of TimestepTraxels in time order.
+    """
+    timesteps = sorted(feats.keys())
+    traxels = {}
+
+    def prepare(t):
+        traxels[t] = prepare_timestep(t, feats[t], x_range, y_range, z_range, size_range,
+                                      divProbs[t] if divProbs is not None else None,
+                                      localCenters[t] if localCenters is not None else None)
+
+    pool = RequestPool()
+    for t in timesteps:
+        pool.add(Request(partial(prepare, t)))
+    pool.wait()
+    pool.clean()
+
+    store = backend.createStore()
+    for t in timesteps:
+        logger.info( "at timestep {}, {} traxels found".format( t, traxels[t].numObjects ) )
+        backend.addTraxels(store, traxels[t], scales)
+        logger.info( "at timestep {}, {} traxels passed filter".format( t, len(traxels[t].ids) ) )
+    return store, [traxels[t] for t in timesteps]
+
+class PgmlinkTraxelBackend(object):
+    """
+    Creates pgmlink traxels.  (pgmlink is imported on first use, so the
+    filtering above can be used and tested without it.)
+    """
+    def createStore(self):
+        import pgmlink
+        return pgmlink.TraxelStore()
+
+    def addTraxels(self, store, traxels, scales):
+        import pgmlink
+        x_scale, y_scale, z_scale = scales
+        # Convert to python types once, instead of once per value
+        ids = traxels.ids.tolist()
+        coms = traxels.coms.tolist()
+        sizes = traxels.sizes.tolist()
+        divProbs = traxels.divProbs.tolist() if traxels.divProbs is not None else None
+        t = traxels.t
+
+        for i, traxel_id in enumerate(ids):
+            tr = pgmlink.Traxel()
+            tr.set_x_scale(x_scale)
+            tr.set_y_scale(y_scale)
+            tr.set_z_scale(z_scale)
+            tr.Id = traxel_id
+            tr.Timestep = t
+
+            # pgmlink expects always 3 coordinates, z=0 for 2d data
+            tr.add_feature_array("com", 3)
+            for j, v in enumerate(coms[i]):
+                tr.set_feature_value('com', j, v)
+
+            if divProbs is not None:
+                tr.add_feature_array("divProb", 1)
+                tr.set_feature_value("divProb", 0, divProbs[i])
+
+            # FIXME: check whether it is 2d or 3d data!
+            if traxels.localCenters is not None:
+                centers = traxels.localCenters[i]
+                tr.add_feature_array("localCentersX", len(centers))
+                tr.add_feature_array("localCentersY", len(centers))
+                tr.add_feature_array("localCentersZ", len(centers))
+                for j, v in enumerate(centers):
+                    tr.set_feature_value("localCentersX", j, float(v[0]))
+                    tr.set_feature_value("localCentersY", j, float(v[1]))
+                    tr.set_feature_value("localCentersZ", j, float(v[2]))
+
+            tr.add_feature_array("count", 1)
+            tr.set_feature_value("count", 0, sizes[i])
+            store.add(tr)
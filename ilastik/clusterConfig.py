@@ -31,6 +31,13 @@ ClusterConfigFields = \
     "task_parallel_subrequests" : AutoEval(int),
     "task_threadpool_size" : AutoEval(int),
     "task_timeout_secs" : AutoEval(int),
+    "task_max_queue_wait_secs" : AutoEval(int), # Optional.  How long a launched task may wait before it starts working (default: task_timeout_secs)
+    "task_scheduler" : str, # "none" (launch and return), "local" (child processes) or "poll" (launch and poll block status)
+    "task_max_concurrent" : AutoEval(int),
+    "task_max_retries" : AutoEval(int),
+    "task_poll_interval_secs" : AutoEval(int),
+    "task_write_queue_size" : AutoEval(int), # Max. number of result blocks waiting to be written (0: write synchronously)
+    "task_work_queue_workers" : AutoEval(int), # If set, launch this many workers that pull blocks from a shared queue instead of one task per block
     "use_node_local_scratch" : bool,
     "use_master_local_scratch" : bool,
     "node_output_compression_cmd" :   FormattedField( requiredFields=["compressed_file", "uncompressed_file"]),
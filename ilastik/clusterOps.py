@@ -16,12 +16,18 @@
 
 import os
 import copy
+import glob
+import Queue
+import threading
+import shutil
+import tempfile
 import subprocess
 import collections
 import hashlib
 import functools
 
 import numpy
+import h5py
 
 from lazyflow.rtype import Roi, SubRegion
 from lazyflow.graph import Operator, InputSlot, OutputSlot, OrderedSignal
@@ -29,12 +35,198 @@ from lazyflow.utility import BigRequestStreamer
 from lazyflow.utility.io.blockwiseFileset import BlockwiseFileset
 
 from ilastik.clusterConfig import parseClusterConfigFile
+from ilastik.clusterScheduler import ClusterTaskScheduler, launchLocalProcess
+from ilastik.clusterWorkQueue import BlockWorkQueue
 from lazyflow.utility.timer import Timer
 from lazyflow.utility.pathHelpers import getPathVariants
 
 import logging
 logger = logging.getLogger(__name__)
 
+class NodeScratchFile(object):
+    """
+    An hdf5 file on node-local disk that holds the data of one block of a BlockwiseFileset.
+    Writing many small sub-blocks to this file is cheap.  Afterwards the whole
+    block is transferred to the shared fileset at once.
+    """
+    DATASET_NAME = 'data'
+
+    def __init__(self, path, blockRoi, dtype):
+        self.path = path
+        self.blockStart = numpy.array( blockRoi[0] )
+        self.blockStop = numpy.array( blockRoi[1] )
+        self._file = h5py.File( path, 'w' )
+        self._file.create_dataset( self.DATASET_NAME, shape=tuple(self.blockStop - self.blockStart), dtype=dtype )
+
+    def writeData(self, roi, data):
+        start = numpy.array( roi[0] ) - self.blockStart
+        stop = numpy.array( roi[1] ) - self.blockStart
+        self._file[self.DATASET_NAME][ tuple( slice(a, b) for a, b in zip(start, stop) ) ] = data
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+def importScratchFile( path, blockwiseFileset, blockRoi, maxSlabBytes=256*1000*1000 ):
+    """
+    Copy a block that was written to a NodeScratchFile into the blockwiseFileset.
+    The data is written in a few large slabs (split along the first axis)
+    instead of many small sub-blocks.
+    """
+    blockStart = numpy.array( blockRoi[0] )
+    blockStop = numpy.array( blockRoi[1] )
+    with h5py.File( path, 'r' ) as f:
+        dataset = f[NodeScratchFile.DATASET_NAME]
+        rowBytes = dataset.dtype.itemsize * numpy.prod( dataset.shape[1:] )
+        rowsPerSlab = max( 1, int( maxSlabBytes / max(rowBytes, 1) ) )
+        for first in range( 0, dataset.shape[0], rowsPerSlab ):
+            last = min( first + rowsPerSlab, dataset.shape[0] )
+            slabStart = blockStart.copy()
+            slabStop = blockStop.copy()
+            slabStart[0] += first
+            slabStop[0] = blockStart[0] + last
+            blockwiseFileset.writeData( (slabStart, slabStop), dataset[first:last] )
+
+def importNodeTransfer( decompressionCmd, transfers ):
+    """
+    Decompress the node-transferred files of one block to master-local scratch
+    and import them into their filesets.
+
+    transfers is a list of (transferBase, fileset, blockRoi).  The transferred
+    files are only deleted once all of them were imported, so a failed import
+    can be retried.  The scratch directory is always removed.
+    """
+    scratchDir = tempfile.mkdtemp( prefix="ilastik-master-scratch-" )
+    try:
+        for transferBase, fileset, blockRoi in transfers:
+            uncompressedPath = os.path.join( scratchDir, os.path.split( transferBase )[1] )
+            _runShellCommand( decompressionCmd.format( compressed_file=transferBase,
+                                                       uncompressed_file=uncompressedPath ) )
+            importScratchFile( uncompressedPath, fileset, blockRoi )
+    finally:
+        shutil.rmtree( scratchDir, ignore_errors=True )
+
+    for transferBase, _, _ in transfers:
+        for transferredPath in glob.glob( transferBase + '*' ):
+            os.remove( transferredPath )
+
+def getNodeTransferPath( descriptionPath, blockStart ):
+    """
+    Location on the shared filesystem where a node puts the compressed data
+    of a block, if node output compression is used.
+    (The master imports it from there.)
+    The name includes the description file name, since several outputs may be described in the same directory.
+    """
+    descriptionDir, descriptionName = os.path.split( descriptionPath )
+    blockName = os.path.splitext( descriptionName )[0] + "-block-" + "_".join( str(int(x)) for x in blockStart ) + ".h5"
+    return os.path.join( descriptionDir, "node_transfer", blockName )
+
+def _runShellCommand( command ):
+    logger.debug( "Running: " + command )
+    returncode = subprocess.call( command, shell=True )
+    if returncode != 0:
+        raise RuntimeError( "Command failed with exit code {}: {}".format( returncode, command ) )
+
+class BlockWriterQueue(object):
+    """
+    Writes result blocks to their filesets in a background thread,
+    so computation of the next blocks can proceed while the previous ones are written.
+
+    At most maxQueuedItems arrays are queued.  put() blocks when the queue is full,
+    which bounds the memory held by results that were not written yet.
+
+    The writer thread never waits for requests: results of pending requests are
+    queued by the requests' completion callbacks (see putRequest()).  Hence a put()
+    on a lazyflow worker thread only waits for the disk, even if the writer is
+    behind results that still need a worker thread (e.g. with a single-thread pool).
+    """
+    def __init__(self, writeFunc, maxQueuedItems):
+        self._writeFunc = writeFunc
+        self._queue = Queue.Queue( maxsize=maxQueuedItems )
+        self._error = None
+        self._pendingRequests = set()
+        self._pendingCondition = threading.Condition()
+        self._thread = threading.Thread( target=self._run, name="BlockWriterQueue" )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, fileset, roi, data):
+        if self._error is not None:
+            raise self._error
+        self._queue.put( (fileset, roi, data) )
+
+    def putRequest(self, fileset, roi, request):
+        """
+        Submit the given request and write its result once it is available.
+        """
+        with self._pendingCondition:
+            self._pendingRequests.add( request )
+
+        def handleFinished( result ):
+            try:
+                self.put( fileset, roi, result )
+            except Exception:
+                pass # The error is re-raised by close()
+            finally:
+                self._requestDone( request )
+
+        def handleFailed( ex, exc_info ):
+            logger.error( "Failed to compute block {}: {}".format( roi, ex ) )
+            if self._error is None:
+                self._error = ex
+            self._requestDone( request )
+
+        request.notify_finished( handleFinished )
+        request.notify_failed( handleFailed )
+        request.submit()
+
+    def _requestDone(self, request):
+        with self._pendingCondition:
+            self._pendingRequests.discard( request )
+            self._pendingCondition.notify_all()
+
+    def close(self):
+        """
+        Wait until all pending requests are finished and all queued items are written,
+        then stop the writer thread.
+        Re-raises the first error that occurred while computing or writing.
+        """
+        with self._pendingCondition:
+            pendingRequests = list( self._pendingRequests )
+        for request in pendingRequests:
+            # Waiting for a request (unlike waiting for the condition below) lets
+            # lazyflow run it, even if close() is called from the only worker thread.
+            try:
+                request.wait()
+            except Exception:
+                pass # Recorded by handleFailed()
+
+        # The completion callbacks may still be queueing the results.
+        with self._pendingCondition:
+            while self._pendingRequests:
+                self._pendingCondition.wait()
+
+        self._queue.put( None )
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._error is not None:
+                # Keep draining the queue, so producers don't block forever.
+                continue
+            fileset, roi, data = item
+            try:
+                self._writeFunc( fileset, roi, data )
+            except Exception as ex:
+                logger.error( "Failed to write block {}: {}".format( roi, ex ) )
+                self._error = ex
+
 class OpTaskWorker(Operator):
     Input = InputSlot()
     RoiString = InputSlot(stype='string')
@@ -52,6 +244,8 @@ class OpTaskWorker(Operator):
         self.progressSignal = OrderedSignal()
         self._primaryBlockwiseFileset = None
         self._secondaryBlockwiseFilesets = []
+        self._scratchFiles = {} # fileset : NodeScratchFile
+        self._writerQueue = None
 
     def setupOutputs(self):
         self.ReturnCode.meta.dtype = bool
@@ -95,12 +289,15 @@ class OpTaskWorker(Operator):
 
         logger.info( "Executing for roi: {}".format(roi) )
 
-        if config.use_node_local_scratch:
-            assert False, "FIXME."
-
         assert (blockwiseFileset.getEntireBlockRoi( roi.start )[1] == roi.stop).all(), "Each task must execute exactly one full block.  ({},{}) is not a valid block roi.".format( roi.start, roi.stop )
         assert self.Input.ready()
 
+        scratchDir = None
+        if config.use_node_local_scratch:
+            # Write all sub-blocks to node-local disk first
+            scratchDir = tempfile.mkdtemp( prefix="ilastik-node-scratch-" )
+            self._openScratchFiles( scratchDir, roi )
+
         # Convert the task subrequest shape dict into a shape for this dataset (and axisordering)
         subrequest_shape = map( lambda tag: config.task_subrequest_shape[tag.key], self.Input.meta.axistags )
         primary_subrequest_shape = self._primaryBlockwiseFileset.description.sub_block_shape
@@ -108,15 +305,43 @@ class OpTaskWorker(Operator):
             # If the output dataset specified a sub_block_shape, override the cluster config
             subrequest_shape = primary_subrequest_shape
 
+        # Results are written by a separate writer stage, unless disabled in the config.
+        writeQueueSize = config.task_write_queue_size
+        if writeQueueSize is None:
+            writeQueueSize = 4
+
         with Timer() as computeTimer:
-            # Stream the data out to disk.
-            streamer = BigRequestStreamer(self.Input, (roi.start, roi.stop), subrequest_shape, config.task_parallel_subrequests )
-            streamer.progressSignal.subscribe( self.progressSignal )
-            streamer.resultSignal.subscribe( self._handlePrimaryResultBlock )
-            streamer.execute()
+            try:
+                # Stream the data out to disk.
+                if writeQueueSize > 0:
+                    self._writerQueue = BlockWriterQueue( self._writeData, writeQueueSize )
+                try:
+                    streamer = BigRequestStreamer(self.Input, (roi.start, roi.stop), subrequest_shape, config.task_parallel_subrequests )
+                    streamer.progressSignal.subscribe( self.progressSignal )
+                    streamer.resultSignal.subscribe( self._handlePrimaryResultBlock )
+                    streamer.execute()
+                finally:
+                    if self._writerQueue is not None:
+                        writerQueue = self._writerQueue
+                        self._writerQueue = None
+                        writerQueue.close()
+
+                if config.use_node_local_scratch:
+                    blockIsReady = self._transferScratchFiles( config )
+                else:
+                    blockIsReady = True
+            finally:
+                # Also discard the scratch files if the computation failed.
+                if scratchDir is not None:
+                    for scratchFile in self._scratchFiles.values():
+                        scratchFile.close()
+                    self._scratchFiles = {}
+                    shutil.rmtree( scratchDir, ignore_errors=True )
 
             # Now the block is ready.  Update the status.
-            blockwiseFileset.setBlockStatus( roi.start, BlockwiseFileset.BLOCK_AVAILABLE )
+            # (With node output compression, the master does this after importing the data.)
+            if blockIsReady:
+                blockwiseFileset.setBlockStatus( roi.start, BlockwiseFileset.BLOCK_AVAILABLE )
 
         logger.info( "Finished task in {} seconds".format( computeTimer.seconds() ) )
         result[0] = True
@@ -125,9 +350,85 @@ class OpTaskWorker(Operator):
     def propagateDirty(self, slot, subindex, roi):
         self.ReturnCode.setDirty( slice(None) )
         
+    def _openScratchFiles(self, scratchDir, roi):
+        """
+        Create a NodeScratchFile for the primary block and the corresponding secondary blocks.
+        """
+        primaryDescription = self._primaryBlockwiseFileset.description
+        blockIndex = numpy.array( roi.start ) / primaryDescription.block_shape
+
+        self._scratchFiles = {}
+        filesets = [ (self._primaryBlockwiseFileset, self.Input) ] + zip( self._secondaryBlockwiseFilesets, self.SecondaryInputs )
+        for i, (fileset, slot) in enumerate( filesets ):
+            blockStart = blockIndex * fileset.description.block_shape
+            blockStop = numpy.minimum( blockStart + fileset.description.block_shape, fileset.description.shape )
+            path = os.path.join( scratchDir, "output-{}.h5".format(i) )
+            self._scratchFiles[fileset] = NodeScratchFile( path, (blockStart, blockStop), slot.meta.dtype )
+
+    def _transferScratchFiles(self, config):
+        """
+        Move the node-local block data to the shared filesets.
+
+        Without node output compression, the data is imported into the filesets directly.
+        With compression, the compressed files are copied to the node transfer directory
+        and the master imports them.
+
+        Returns True if the block data has arrived in the filesets.
+        """
+        descriptionPaths = [ self.OutputFilesetDescription.value ] + [ slot.value for slot in self.SecondaryOutputDescriptions ]
+        filesets = [ self._primaryBlockwiseFileset ] + self._secondaryBlockwiseFilesets
+
+        for fileset, descriptionPath in zip( filesets, descriptionPaths ):
+            scratchFile = self._scratchFiles[fileset]
+            scratchFile.close()
+            blockRoi = ( scratchFile.blockStart, scratchFile.blockStop )
+            if config.node_output_compression_cmd is None:
+                with Timer() as transferTimer:
+                    importScratchFile( scratchFile.path, fileset, blockRoi )
+                logger.info( "Imported node scratch data for {} in {} seconds".format( descriptionPath, transferTimer.seconds() ) )
+                continue
+
+            compressedBase = scratchFile.path + ".compressed"
+            _runShellCommand( config.node_output_compression_cmd.format( compressed_file=compressedBase,
+                                                                          uncompressed_file=scratchFile.path ) )
+            # The compression command may append a suffix (e.g. .gz), so copy everything it created.
+            transferBase = getNodeTransferPath( descriptionPath, blockRoi[0] )
+            transferDir = os.path.split( transferBase )[0]
+            if not os.path.exists( transferDir ):
+                try:
+                    os.makedirs( transferDir )
+                except OSError:
+                    # Another node may have created it in the meantime.
+                    if not os.path.exists( transferDir ):
+                        raise
+            with Timer() as transferTimer:
+                for compressedPath in glob.glob( compressedBase + '*' ):
+                    suffix = compressedPath[len(compressedBase):]
+                    shutil.copyfile( compressedPath, transferBase + suffix )
+            logger.info( "Transferred compressed node data for {} in {} seconds".format( descriptionPath, transferTimer.seconds() ) )
+
+        if config.node_output_compression_cmd is None:
+            return True
+
+        # Tell the master that all files for this block have been transferred.
+        primaryTransferBase = getNodeTransferPath( descriptionPaths[0], self._scratchFiles[filesets[0]].blockStart )
+        open( primaryTransferBase + ".ready", 'w' ).close()
+        return False
+
+    def _writeData(self, fileset, roi, data):
+        if fileset in self._scratchFiles:
+            self._scratchFiles[fileset].writeData( roi, data )
+        else:
+            fileset.writeData( roi, data )
+
     def _handlePrimaryResultBlock(self, roi, result):
+        # Without a writer stage, write everything synchronously.
+        write = self._writeData
+        if self._writerQueue is not None:
+            write = self._writerQueue.put
+
         # First write the primary
-        self._primaryBlockwiseFileset.writeData(roi, result)
+        write(self._primaryBlockwiseFileset, roi, result)
 
         # Get this block's index with respect to the primary dataset
         sub_block_index = roi[0] / self._primaryBlockwiseFileset.description.sub_block_shape
@@ -141,8 +442,12 @@ class OpTaskWorker(Operator):
             sub_block_stop = numpy.minimum( sub_block_stop, fileset.description.shape )
             sub_block_roi = (sub_block_start, sub_block_stop)
             
-            secondary_result = slot( *sub_block_roi ).wait()
-            fileset.writeData( sub_block_roi, secondary_result )
+            if self._writerQueue is None:
+                secondary_result = slot( *sub_block_roi ).wait()
+                self._writeData( fileset, sub_block_roi, secondary_result )
+            else:
+                # Start computing the secondary now, it is written when it's done.
+                self._writerQueue.putRequest( fileset, sub_block_roi, slot( *sub_block_roi ) )
 
 class OpClusterize(Operator):
     Input = InputSlot()
@@ -159,6 +464,8 @@ class OpClusterize(Operator):
         taskName = None
         command = None
         subregion = None
+        numBytes = 0
+        workQueuePath = None # Only for work queue workers (see task_work_queue_workers)
         
     def setupOutputs(self):
         self.ReturnCode.meta.dtype = bool
@@ -189,6 +496,11 @@ class OpClusterize(Operator):
     def _validateConfig(self):
         if not self._config.use_master_local_scratch:
             assert self._config.node_output_compression_cmd is None, "Can't use node dataset compression unless master local scratch is also used."
+        if self._config.node_output_compression_cmd is not None:
+            assert self._config.use_node_local_scratch, "Node dataset compression requires node local scratch."
+            assert self._config.node_output_decompression_cmd is not None, "Node dataset compression requires a decompression command."
+            assert (self._config.task_scheduler or "none") != "none", "Node dataset compression requires a task_scheduler, because the master imports the node data."
+            assert not self._config.task_work_queue_workers, "Node dataset compression can't be combined with a work queue."
     
     def execute(self, slot, subindex, roi, result):
         dtypeBytes = self._getDtypeBytes()
@@ -217,7 +529,17 @@ class OpClusterize(Operator):
                 logger.info( "No need to run task: {} for roi: {}".format( taskInfos[roi].taskName, roi ) )
                 del taskInfos[roi]
 
+            # In work queue mode, launch a fixed number of workers that pull the remaining blocks from a shared queue.
+            if self._config.task_work_queue_workers:
+                taskInfos = self._prepareWorkQueueTasks( taskInfos.keys(), self._config.task_work_queue_workers )
+
             absWorkDir, _ = getPathVariants(self._config.server_working_directory, os.path.split( configFilePath )[0] )
+
+            scheduler = self._config.task_scheduler or "none"
+            if scheduler != "none":
+                result[0] = self._runScheduled( scheduler, blockwiseFileset, taskInfos, absWorkDir )
+                return result
+
             if self._config.task_launch_server == "localhost":
                 def localCommand( cmd ):
                     cwd = os.getcwd()
@@ -246,6 +568,136 @@ class OpClusterize(Operator):
         finally:
             blockwiseFileset.close()
 
+    def _runScheduled(self, scheduler, blockwiseFileset, taskInfos, absWorkDir):
+        """
+        Run the tasks and wait for them to finish, relaunching failed tasks.
+
+        scheduler is one of:
+        - "local": Run each task as a child process on this machine.
+        - "poll": Launch the tasks with the command_format (e.g. via qsub)
+                  and poll the block status of the output fileset.
+
+        Returns True if all blocks were computed.
+        """
+        if scheduler == "local":
+            launchFunc = lambda taskInfo: launchLocalProcess( taskInfo.command, absWorkDir )
+        elif scheduler == "poll":
+            launchFunc = self._getCommandLauncher( absWorkDir )
+        else:
+            raise RuntimeError( "Unknown task_scheduler: {}".format( scheduler ) )
+
+        secondaryFilesets = []
+        if self._config.node_output_compression_cmd is not None:
+            secondaryFilesets = [ BlockwiseFileset( slot.value, 'a' ) for slot in self.SecondaryOutputDescriptions ]
+
+        workQueue = None
+        if self._config.task_work_queue_workers:
+            workQueue = BlockWorkQueue( self._getWorkQueuePath(), staleClaimSecs=self._config.task_timeout_secs )
+
+        def isTaskFinished( taskInfo ):
+            if workQueue is not None:
+                return workQueue.isWorkerFinished( taskInfo.taskName )
+            blockStart = taskInfo.subregion.start
+            if blockwiseFileset.getBlockStatus( blockStart ) == BlockwiseFileset.BLOCK_AVAILABLE:
+                return True
+            if self._config.node_output_compression_cmd is not None:
+                return self._importNodeTransfer( blockwiseFileset, secondaryFilesets, blockStart )
+            return False
+
+        timeoutSecs = self._config.task_timeout_secs
+        maxQueueWaitSecs = self._config.task_max_queue_wait_secs
+        isTaskAlive = None
+        if workQueue is None:
+            # A task is working on its block while the block is locked.
+            isTaskStarted = lambda taskInfo: blockwiseFileset.isBlockLocked( taskInfo.subregion.start )
+        else:
+            # A work queue worker computes many blocks, so its runtime can't be limited.
+            # Instead, it has started once it sent a heartbeat, and is considered dead
+            # once it didn't send one for task_timeout_secs.  (Its block is then handed
+            # to another worker.)
+            isTaskStarted = lambda taskInfo: workQueue.isWorkerStarted( taskInfo.taskName )
+            isTaskAlive = lambda taskInfo: workQueue.isWorkerAlive( taskInfo.taskName )
+            if maxQueueWaitSecs is None:
+                maxQueueWaitSecs = timeoutSecs
+            timeoutSecs = None
+
+        pollInterval = self._config.task_poll_interval_secs
+        if pollInterval is None:
+            pollInterval = 10
+        taskScheduler = ClusterTaskScheduler( launchFunc,
+                                              isTaskFinished,
+                                              maxConcurrent=self._config.task_max_concurrent,
+                                              timeoutSecs=timeoutSecs,
+                                              maxRetries=self._config.task_max_retries,
+                                              pollIntervalSecs=pollInterval,
+                                              isTaskStarted=isTaskStarted,
+                                              isTaskAlive=isTaskAlive,
+                                              maxQueueWaitSecs=maxQueueWaitSecs )
+        try:
+            finished, failed = taskScheduler.run( taskInfos.values() )
+            if workQueue is not None:
+                queueCounts = workQueue.counts()
+                logger.info( "Work queue status: {}".format( dict(queueCounts) ) )
+                if queueCounts[BlockWorkQueue.FAILED] > 0:
+                    logger.error( "{} blocks of the work queue failed.".format( queueCounts[BlockWorkQueue.FAILED] ) )
+                    return False
+        finally:
+            for fileset in secondaryFilesets:
+                fileset.close()
+            if workQueue is not None:
+                workQueue.close()
+        for taskInfo in failed:
+            logger.error( "Task {} for roi {} failed.".format( taskInfo.taskName, taskInfo.subregion ) )
+        return len(failed) == 0
+
+    def _importNodeTransfer(self, blockwiseFileset, secondaryFilesets, blockStart):
+        """
+        If a node has transferred the compressed data of the given block,
+        decompress it to master-local scratch and import it into the output filesets.
+        Returns True if the block was imported.
+        """
+        primaryDescriptionPath = self.OutputDatasetDescription.value
+        readyPath = getNodeTransferPath( primaryDescriptionPath, blockStart ) + ".ready"
+        if not os.path.exists( readyPath ):
+            return False
+
+        blockIndex = numpy.array( blockStart ) / blockwiseFileset.description.block_shape
+        descriptionPaths = [ primaryDescriptionPath ] + [ slot.value for slot in self.SecondaryOutputDescriptions ]
+        filesets = [ blockwiseFileset ] + secondaryFilesets
+
+        transfers = []
+        for fileset, descriptionPath in zip( filesets, descriptionPaths ):
+            start = blockIndex * fileset.description.block_shape
+            stop = numpy.minimum( start + fileset.description.block_shape, fileset.description.shape )
+            transfers.append( ( getNodeTransferPath( descriptionPath, start ), fileset, (start, stop) ) )
+        try:
+            importNodeTransfer( self._config.node_output_decompression_cmd, transfers )
+        except:
+            # The block is computed again (if retries are left): wait for the new transfer.
+            os.remove( readyPath )
+            raise
+
+        blockwiseFileset.setBlockStatus( blockStart, BlockwiseFileset.BLOCK_AVAILABLE )
+        return True
+
+    def _getCommandLauncher(self, absWorkDir):
+        """
+        Return a function that submits a task with the configured command_format
+        and returns immediately (the command itself is expected to return
+        as soon as the job is queued).
+        """
+        if self._config.task_launch_server == "localhost":
+            def localCommand( taskInfo ):
+                subprocess.call( taskInfo.command, shell=True, cwd=absWorkDir )
+            return localCommand
+
+        import fabric.api as fab
+        @fab.hosts( self._config.task_launch_server )
+        def remoteCommand( cmd ):
+            with fab.cd( absWorkDir ):
+                fab.run( cmd )
+        return lambda taskInfo: fab.execute( remoteCommand, taskInfo.command )
+
     def _prepareTaskInfos(self, roiList):
         # Divide up the workload into large pieces
         logger.info( "Dividing into {} node jobs.".format( len(roiList) ) )
@@ -255,34 +707,71 @@ class OpClusterize(Operator):
             roi = ( tuple(roi[0]), tuple(roi[1]) )
             taskInfo = OpClusterize.TaskInfo()
             taskInfo.subregion = SubRegion( None, start=roi[0], stop=roi[1] )
+            taskInfo.numBytes = self._getDtypeBytes() * numpy.prod( numpy.subtract(roi[1], roi[0]) )
             
             taskName = "J{:02}".format(roiIndex)
-
-            commandArgs = []
-            commandArgs.append( "--option_config_file=" + self.ConfigFilePath.value )
-            commandArgs.append( "--project=" + self.ProjectFilePath.value )
-            commandArgs.append( "--_node_work_=\"" + Roi.dumps( taskInfo.subregion ) + "\"" )
-            commandArgs.append( "--process_name={}".format(taskName)  )
-            commandArgs.append( "--output_description_file={}".format( self.OutputDatasetDescription.value )  )
-            for slot in self.SecondaryOutputDescriptions:
-                commandArgs.append( "--secondary_output_description_file={}".format( slot.value )  )
-
-            # Check the command format string: We need to know where to put our args...
-            commandFormat = self._config.command_format
-            assert commandFormat.find("{task_args}") != -1
-
-            # Output log directory might be a relative path (relative to config file)
-            absLogDir, _ = getPathVariants(self._config.output_log_directory, os.path.split( self.ConfigFilePath.value )[0] )
-            taskOutputLogFilename = taskName + ".log"
-            taskOutputLogPath = os.path.join( absLogDir, taskOutputLogFilename )
-            
-            allArgs = " " + " ".join(commandArgs) + " "
             taskInfo.taskName = taskName
-            taskInfo.command = commandFormat.format( task_args=allArgs, task_name=taskName, task_output_file=taskOutputLogPath )
+            taskInfo.command = self._getTaskCommand( taskName, "--_node_work_=\"" + Roi.dumps( taskInfo.subregion ) + "\"" )
             taskInfos[roi] = taskInfo
 
         return taskInfos
 
+    def _prepareWorkQueueTasks(self, roiList, numWorkers):
+        """
+        Put the given block rois into the work queue and
+        return the taskInfos for the workers that will process them.
+        """
+        workQueuePath = self._getWorkQueuePath()
+        workQueue = BlockWorkQueue( workQueuePath )
+        try:
+            workQueue.initialize( roiList )
+        finally:
+            workQueue.close()
+
+        numWorkers = min( numWorkers, len(roiList) )
+        logger.info( "Distributing {} blocks among {} queue workers.".format( len(roiList), numWorkers ) )
+
+        totalBytes = sum( self._getDtypeBytes() * numpy.prod( numpy.subtract(roi[1], roi[0]) ) for roi in roiList )
+        taskInfos = collections.OrderedDict()
+        for workerIndex in range(numWorkers):
+            taskInfo = OpClusterize.TaskInfo()
+            taskName = "W{:02}".format(workerIndex)
+            taskInfo.taskName = taskName
+            taskInfo.workQueuePath = workQueuePath
+            taskInfo.numBytes = totalBytes / numWorkers
+            taskInfo.command = self._getTaskCommand( taskName, "--_node_work_queue_=" + workQueuePath )
+            taskInfos[taskName] = taskInfo
+
+        return taskInfos
+
+    def _getWorkQueuePath(self):
+        """
+        The work queue lives next to the output description, where all nodes can see it.
+        """
+        return os.path.splitext( self.OutputDatasetDescription.value )[0] + "-work-queue.sqlite"
+
+    def _getTaskCommand(self, taskName, workArg):
+        commandArgs = []
+        commandArgs.append( "--option_config_file=" + self.ConfigFilePath.value )
+        commandArgs.append( "--project=" + self.ProjectFilePath.value )
+        commandArgs.append( workArg )
+        commandArgs.append( "--process_name={}".format(taskName)  )
+        commandArgs.append( "--output_description_file={}".format( self.OutputDatasetDescription.value )  )
+        for slot in self.SecondaryOutputDescriptions:
+            commandArgs.append( "--secondary_output_description_file={}".format( slot.value )  )
+
+        # Check the command format string: We need to know where to put our args...
+        commandFormat = self._config.command_format
+        assert commandFormat.find("{task_args}") != -1
+
+        # Output log directory might be a relative path (relative to config file)
+        absLogDir, _ = getPathVariants(self._config.output_log_directory, os.path.split( self.ConfigFilePath.value )[0] )
+        taskOutputLogFilename = taskName + ".log"
+        taskOutputLogPath = os.path.join( absLogDir, taskOutputLogFilename )
+        
+        allArgs = " " + " ".join(commandArgs) + " "
+        return commandFormat.format( task_args=allArgs, task_name=taskName, task_output_file=taskOutputLogPath )
+
     def _prepareDestination(self):
         """
         - If the result file doesn't exist yet, create it (and the dataset)
@@ -0,0 +1,215 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+import os
+import time
+import signal
+import traceback
+import subprocess
+import collections
+
+import logging
+logger = logging.getLogger(__name__)
+
+class ClusterTaskScheduler(object):
+    """
+    Launches cluster tasks with a concurrency limit and waits until they are done.
+
+    A task is done when isTaskFinished(task) returns True (e.g. its block
+    is marked available in the output BlockwiseFileset).  A task fails if
+    its process exits without finishing its block, if isTaskFinished(task)
+    raises an exception (e.g. the block couldn't be imported), or if it is
+    not done after timeoutSecs.  Failed tasks are relaunched up to maxRetries times.
+
+    The clock starts when the task is launched.  If isTaskStarted(task) is
+    given (e.g. "the block is locked"), a task may wait up to maxQueueWaitSecs
+    (default: timeoutSecs) in a batch queue before it starts, and then has
+    timeoutSecs from the first poll at which it was seen working.  If
+    isTaskAlive(task) is given (e.g. "the task sent a heartbeat recently"),
+    a started task that is no longer alive is treated like a timed-out one.
+
+    A timed-out task that can't be killed is not relaunched, because it may
+    still be queued or working, and two jobs would then write the same block.
+    It is reported as failed (ABANDONED) instead.
+
+    The backend is given as a launch function:
+
+    - launchFunc(task) starts the task and returns a handle.  If the handle
+      has poll() and kill() methods (like subprocess.Popen), they are used
+      to detect process exit and to stop timed-out tasks.  Otherwise (e.g.
+      for jobs submitted to a batch queue), the task status is only known
+      from isTaskFinished().
+
+    Each task must have the attributes taskName and numBytes.
+    """
+    class TaskState(object):
+        def __init__(self, task, handle, launchTime, attempt):
+            self.task = task
+            self.handle = handle
+            self.launchTime = launchTime
+            self.attempt = attempt
+            self.startTime = None # When the task was first seen working
+
+    # Returned by _checkTask() for failed tasks that must not be relaunched.
+    ABANDONED = 'abandoned'
+
+    def __init__(self, launchFunc, isTaskFinished, maxConcurrent=None, timeoutSecs=None,
+                 maxRetries=0, pollIntervalSecs=10.0, clock=time.time, sleep=time.sleep,
+                 isTaskStarted=None, maxQueueWaitSecs=None, isTaskAlive=None):
+        self._launchFunc = launchFunc
+        self._isTaskFinished = isTaskFinished
+        self._isTaskStarted = isTaskStarted
+        self._isTaskAlive = isTaskAlive
+        self._maxConcurrent = maxConcurrent
+        self._timeoutSecs = timeoutSecs
+        self._maxQueueWaitSecs = maxQueueWaitSecs
+        if maxQueueWaitSecs is None:
+            self._maxQueueWaitSecs = timeoutSecs
+        self._maxRetries = maxRetries or 0
+        self._pollIntervalSecs = pollIntervalSecs
+        self._clock = clock
+        self._sleep = sleep
+
+    def run(self, tasks):
+        """
+        Run all tasks.  Returns a tuple (finished_tasks, failed_tasks).
+        """
+        pending = collections.deque( tasks )
+        attempts = collections.defaultdict(int)
+        running = []
+        finished = []
+        failed = []
+        finishedBytes = 0
+        startTime = self._clock()
+
+        while pending or running:
+            # Launch as many tasks as we are allowed to
+            while pending and ( not self._maxConcurrent or len(running) < self._maxConcurrent ):
+                task = pending.popleft()
+                attempts[task.taskName] += 1
+                logger.info( "Launching task {} (attempt {})".format( task.taskName, attempts[task.taskName] ) )
+                handle = self._launchFunc( task )
+                running.append( ClusterTaskScheduler.TaskState( task, handle, self._clock(), attempts[task.taskName] ) )
+
+            self._sleep( self._pollIntervalSecs )
+
+            stillRunning = []
+            for state in running:
+                status = self._checkTask( state )
+                if status is None:
+                    stillRunning.append( state )
+                elif status is ClusterTaskScheduler.ABANDONED:
+                    logger.error( "Task {} timed out and can't be stopped, not relaunching it.".format( state.task.taskName ) )
+                    failed.append( state.task )
+                elif status:
+                    finished.append( state.task )
+                    finishedBytes += state.task.numBytes
+                    self._logProgress( len(finished), len(tasks), finishedBytes, startTime )
+                elif state.attempt <= self._maxRetries:
+                    logger.warn( "Task {} failed, retrying.".format( state.task.taskName ) )
+                    pending.append( state.task )
+                else:
+                    logger.error( "Task {} failed {} times, giving up.".format( state.task.taskName, state.attempt ) )
+                    failed.append( state.task )
+            running = stillRunning
+
+        self._logProgress( len(finished), len(tasks), finishedBytes, startTime )
+        return finished, failed
+
+    def _checkTask(self, state):
+        """
+        Return True if the task finished, False if it failed, None if it is still running,
+        ABANDONED if it timed out but can't be stopped.
+        """
+        finished = self._checkFinished( state )
+        if finished is not False:
+            return bool( finished )
+
+        handle = state.handle
+        if hasattr( handle, 'poll' ):
+            returncode = handle.poll()
+            if returncode is not None:
+                # The process is gone. Check once more, the block
+                # status might have been written right before exit.
+                finished = self._checkFinished( state )
+                if finished is not False:
+                    return bool( finished )
+                logger.warn( "Task {} exited with code {} without finishing its block.".format( state.task.taskName, returncode ) )
+                return False
+
+        if state.startTime is None:
+            if self._isTaskStarted is None:
+                state.startTime = state.launchTime
+            elif self._isTaskStarted( state.task ):
+                state.startTime = self._clock()
+
+        if state.startTime is None:
+            timedOut = self._maxQueueWaitSecs and self._clock() - state.launchTime > self._maxQueueWaitSecs
+            reason = "didn't start within {} seconds".format( self._maxQueueWaitSecs )
+        elif self._isTaskAlive is not None and not self._isTaskAlive( state.task ):
+            timedOut = True
+            reason = "stopped responding"
+        else:
+            timedOut = self._timeoutSecs and self._clock() - state.startTime > self._timeoutSecs
+            reason = "timed out after {} seconds".format( self._timeoutSecs )
+        if not timedOut:
+            return None
+
+        logger.warn( "Task {} {}.".format( state.task.taskName, reason ) )
+        if not hasattr( handle, 'kill' ):
+            return ClusterTaskScheduler.ABANDONED
+        try:
+            handle.kill()
+        except OSError:
+            pass
+        return False
+
+    def _checkFinished(self, state):
+        """
+        Return True if the task finished, False if it didn't (yet),
+        and None if its result couldn't be checked (then the task failed).
+        """
+        try:
+            return bool( self._isTaskFinished( state.task ) )
+        except:
+            logger.error( "Failed to check the result of task {}:\n{}".format( state.task.taskName, traceback.format_exc() ) )
+            return None
+
+    def _logProgress(self, numFinished, numTotal, finishedBytes, startTime):
+        elapsed = max( self._clock() - startTime, 1e-6 )
+        logger.info( "Finished {}/{} tasks in {:.1f} seconds ({:.3f} blocks/s, {:.2f} MB/s)"
+                     "".format( numFinished, numTotal, elapsed,
+                                numFinished / elapsed,
+                                finishedBytes / elapsed / (1000*1000) ) )
+
+def launchLocalProcess( command, workingDirectory ):
+    """
+    Backend for running tasks as child processes of the master on a single big node.
+    """
+    # Start the task in its own process group, so kill() also stops its children.
+    process = subprocess.Popen( command, shell=True, cwd=workingDirectory, preexec_fn=os.setsid )
+    return _LocalProcessHandle( process )
+
+class _LocalProcessHandle(object):
+    def __init__(self, process):
+        self._process = process
+
+    def poll(self):
+        return self._process.poll()
+
+    def kill(self):
+        os.killpg( self._process.pid, signal.SIGKILL )
+        self._process.wait()
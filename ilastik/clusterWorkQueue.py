@@ -0,0 +1,271 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+import time
+import sqlite3
+import threading
+import collections
+
+import logging
+logger = logging.getLogger(__name__)
+
+class BlockWorkQueue(object):
+    """
+    A queue of output blocks, shared by the master and a fixed number of
+    worker processes via an SQLite file on a shared filesystem.
+
+    The master fills the queue with the blocks that still have to be
+    computed.  Each worker repeatedly claims the next pending block,
+    computes it and marks it done, until no pending blocks are left.
+    Cheap blocks (e.g. empty background) thus don't cost a whole job
+    launch, and the expensive blocks are spread over all workers.
+
+    Workers send heartbeats (see WorkerHeartbeat) while they are running,
+    which renew the claims on their blocks.  A block whose claim wasn't
+    renewed for staleClaimSecs is considered abandoned (its worker died)
+    and may be claimed again by another worker.  A worker can only mark
+    the blocks done (or release them) that it still owns.  A relaunched
+    worker with the same name resumes its own unfinished block.  After
+    maxAttempts claims, a block is marked as failed instead of being
+    handed out again.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, path, staleClaimSecs=None, maxAttempts=None, clock=time.time):
+        self._path = path
+        self._staleClaimSecs = staleClaimSecs
+        self._maxAttempts = maxAttempts
+        self._clock = clock
+
+        # isolation_level=None: We issue BEGIN/COMMIT ourselves.
+        self._connection = sqlite3.connect( path, timeout=60.0, isolation_level=None )
+        self._connection.execute( "CREATE TABLE IF NOT EXISTS blocks ("
+                                  " block_start TEXT PRIMARY KEY,"
+                                  " block_stop TEXT NOT NULL,"
+                                  " status TEXT NOT NULL,"
+                                  " worker TEXT,"
+                                  " claimed_at REAL,"
+                                  " attempts INTEGER NOT NULL DEFAULT 0 )" )
+        self._connection.execute( "CREATE TABLE IF NOT EXISTS workers ("
+                                  " name TEXT PRIMARY KEY,"
+                                  " heartbeat_at REAL NOT NULL )" )
+
+    def close(self):
+        self._connection.close()
+
+    def initialize(self, blockRois):
+        """
+        Replace the contents of the queue with the given (start, stop) block rois, all pending.
+        """
+        with self._transaction() as cursor:
+            cursor.execute( "DELETE FROM blocks" )
+            cursor.execute( "DELETE FROM workers" )
+            cursor.executemany( "INSERT INTO blocks (block_start, block_stop, status) VALUES (?, ?, ?)",
+                                [ ( self._encode(start), self._encode(stop), BlockWorkQueue.PENDING )
+                                  for start, stop in blockRois ] )
+        logger.info( "Initialized work queue {} with {} blocks".format( self._path, len(blockRois) ) )
+
+    def claim(self, workerName):
+        """
+        Claim the next block for the given worker.
+        Returns the block roi as a tuple (start, stop), or None if there is no work left.
+        """
+        with self._transaction() as cursor:
+            while True:
+                row = cursor.execute( "SELECT block_start, block_stop, attempts FROM blocks"
+                                      " WHERE status = ? OR (status = ? AND (worker = ? OR claimed_at < ?))"
+                                      " ORDER BY status = ? DESC, rowid LIMIT 1",
+                                      ( BlockWorkQueue.PENDING, BlockWorkQueue.RUNNING, workerName,
+                                        self._staleClaimTime(), BlockWorkQueue.RUNNING ) ).fetchone()
+                if row is None:
+                    return None
+                blockStart, blockStop, attempts = row
+                if self._maxAttempts and attempts >= self._maxAttempts:
+                    logger.error( "Block {} was claimed {} times without finishing.  Giving up.".format( blockStart, attempts ) )
+                    cursor.execute( "UPDATE blocks SET status = ? WHERE block_start = ?",
+                                    ( BlockWorkQueue.FAILED, blockStart ) )
+                    continue
+                cursor.execute( "UPDATE blocks SET status = ?, worker = ?, claimed_at = ?, attempts = attempts + 1"
+                                " WHERE block_start = ?",
+                                ( BlockWorkQueue.RUNNING, workerName, self._clock(), blockStart ) )
+                return self._decode(blockStart), self._decode(blockStop)
+
+    def heartbeat(self, workerName):
+        """
+        Record that the given worker is alive, and renew the claim on its block.
+        """
+        with self._transaction() as cursor:
+            now = self._clock()
+            cursor.execute( "INSERT OR REPLACE INTO workers (name, heartbeat_at) VALUES (?, ?)", ( workerName, now ) )
+            cursor.execute( "UPDATE blocks SET claimed_at = ? WHERE status = ? AND worker = ?",
+                            ( now, BlockWorkQueue.RUNNING, workerName ) )
+
+    def markDone(self, blockStart, workerName):
+        """
+        Mark a block of the given worker as done.
+        Returns False (and changes nothing) if the worker doesn't own the block anymore.
+        """
+        with self._transaction() as cursor:
+            cursor.execute( "UPDATE blocks SET status = ? WHERE block_start = ? AND status = ? AND worker = ?",
+                            ( BlockWorkQueue.DONE, self._encode(blockStart), BlockWorkQueue.RUNNING, workerName ) )
+            owned = cursor.rowcount == 1
+        if not owned:
+            logger.warn( "Worker {} lost its claim on block {}.".format( workerName, blockStart ) )
+        return owned
+
+    def markFailed(self, blockStart):
+        self._setStatus( blockStart, BlockWorkQueue.FAILED )
+
+    def release(self, blockStart, workerName):
+        """
+        Give up the given worker's claim on a block whose computation failed.
+        The block becomes pending again, unless it has used up its maxAttempts,
+        in which case it is marked as failed.
+        Returns True if the block will be retried.  If the worker doesn't own
+        the block anymore, nothing is changed (another worker has taken it over)
+        and True is returned.
+        """
+        with self._transaction() as cursor:
+            row = cursor.execute( "SELECT attempts FROM blocks WHERE block_start = ? AND status = ? AND worker = ?",
+                                  ( self._encode(blockStart), BlockWorkQueue.RUNNING, workerName ) ).fetchone()
+            if row is None:
+                logger.warn( "Worker {} lost its claim on block {}.".format( workerName, blockStart ) )
+                return True
+            retry = not ( self._maxAttempts and row[0] >= self._maxAttempts )
+            status = BlockWorkQueue.PENDING if retry else BlockWorkQueue.FAILED
+            cursor.execute( "UPDATE blocks SET status = ?, worker = NULL, claimed_at = NULL WHERE block_start = ?",
+                            ( status, self._encode(blockStart) ) )
+        return retry
+
+    def counts(self):
+        """
+        Return a dict of { status : number of blocks }.
+        """
+        counts = collections.defaultdict(int)
+        for status, count in self._connection.execute( "SELECT status, COUNT(*) FROM blocks GROUP BY status" ):
+            counts[str(status)] = count
+        return counts
+
+    def isWorkerFinished(self, workerName):
+        """
+        Return True if there are no pending blocks left and
+        the given worker doesn't hold an unfinished block.
+        """
+        row = self._connection.execute( "SELECT COUNT(*) FROM blocks WHERE status = ? OR (status = ? AND worker = ?)",
+                                        ( BlockWorkQueue.PENDING, BlockWorkQueue.RUNNING, workerName ) ).fetchone()
+        return row[0] == 0
+
+    def isWorkerStarted(self, workerName):
+        """
+        Return True if the given worker has sent a heartbeat.
+        """
+        row = self._connection.execute( "SELECT COUNT(*) FROM workers WHERE name = ?", ( workerName, ) ).fetchone()
+        return row[0] > 0
+
+    def isWorkerAlive(self, workerName):
+        """
+        Return True if the given worker has sent a heartbeat within the last staleClaimSecs.
+        """
+        row = self._connection.execute( "SELECT heartbeat_at FROM workers WHERE name = ?", ( workerName, ) ).fetchone()
+        return row is not None and row[0] >= self._staleClaimTime()
+
+    def _setStatus(self, blockStart, status):
+        with self._transaction() as cursor:
+            cursor.execute( "UPDATE blocks SET status = ? WHERE block_start = ?",
+                            ( status, self._encode(blockStart) ) )
+
+    def _staleClaimTime(self):
+        if not self._staleClaimSecs:
+            return float('-inf')
+        return self._clock() - self._staleClaimSecs
+
+    def _transaction(self):
+        return _ImmediateTransaction( self._connection )
+
+    @staticmethod
+    def _encode(coords):
+        return ",".join( str(int(x)) for x in coords )
+
+    @staticmethod
+    def _decode(text):
+        return tuple( int(x) for x in text.split(",") )
+
+class WorkerHeartbeat(object):
+    """
+    Sends heartbeats for a worker of a BlockWorkQueue from a background thread,
+    so the claims of a slow (but live) worker don't go stale.
+    The first heartbeat is sent by start(), before the worker claims anything.
+    """
+    #: Heartbeat interval if the queue has no staleClaimSecs
+    DefaultIntervalSecs = 60.0
+
+    def __init__(self, path, workerName, staleClaimSecs=None):
+        self._path = path
+        self._workerName = workerName
+        self._intervalSecs = self.DefaultIntervalSecs
+        if staleClaimSecs:
+            self._intervalSecs = min( self._intervalSecs, staleClaimSecs / 4.0 )
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        # SQLite connections can't be shared between threads.
+        queue = BlockWorkQueue( self._path )
+        try:
+            queue.heartbeat( self._workerName )
+        finally:
+            queue.close()
+        self._thread = threading.Thread( target=self._run, name="WorkQueueHeartbeat" )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        queue = BlockWorkQueue( self._path )
+        try:
+            while not self._stopped.wait( self._intervalSecs ):
+                try:
+                    queue.heartbeat( self._workerName )
+                except sqlite3.Error:
+                    logger.warn( "Failed to send a heartbeat for worker {}".format( self._workerName ) )
+        finally:
+            queue.close()
+
+class _ImmediateTransaction(object):
+    """
+    Context manager for a write transaction.  BEGIN IMMEDIATE takes the
+    database write lock right away, so two workers can't claim the same block.
+    """
+    def __init__(self, connection):
+        self._connection = connection
+
+    def __enter__(self):
+        self._connection.execute( "BEGIN IMMEDIATE" )
+        return self._connection.cursor()
+
+    def __exit__(self, excType, excValue, tb):
+        if excType is None:
+            self._connection.execute( "COMMIT" )
+        else:
+            self._connection.execute( "ROLLBACK" )
+        return False
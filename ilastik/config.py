@@ -25,6 +25,9 @@ Example:
 [ilastik]
 debug: false
 plugin_directories: ~/.ilastik/plugins,
+plugin_manifest: ~/.ilastik/plugin_manifest.json
+feature_cache_directory: ~/.ilastik/feature_cache
+feature_cache_max_mb: 20000
 logging_config: ~/custom_ilastik_logging_config.json
 """
 
@@ -32,6 +35,9 @@ default_config = """
 [ilastik]
 debug: false
 plugin_directories: ~/.ilastik/plugins,
+plugin_manifest: ~/.ilastik/plugin_manifest.json
+feature_cache_directory:
+feature_cache_max_mb: 10000
 """
 
 cfg = ConfigParser.SafeConfigParser()
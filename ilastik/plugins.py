@@ -20,16 +20,26 @@ from yapsy.IPlugin import IPlugin
 from yapsy.PluginManager import PluginManager
 
 import os
+import json
+import time
+import threading
 from collections import namedtuple
 from functools import partial
 import numpy
 
+import logging
+logger = logging.getLogger(__name__)
+
 # these directories are searched for plugins
 plugin_paths = cfg.get('ilastik', 'plugin_directories')
 plugin_paths = list(os.path.expanduser(d) for d in plugin_paths.split(',')
                     if len(d) > 0)
 plugin_paths.append(os.path.join(os.path.split(__file__)[0], "plugins_default"))
 
+# the directories that contain plugins are cached in this file
+plugin_manifest = cfg.get('ilastik', 'plugin_manifest')
+plugin_manifest = os.path.expanduser(plugin_manifest) if plugin_manifest else None
+
 ##########################
 # different plugin types #
 ##########################
@@ -134,13 +144,139 @@ class ObjectFeaturesPlugin(IPlugin):
 # the manager #
 ###############
 
-pluginManager = PluginManager()
-pluginManager.setPluginPlaces(plugin_paths)
+class LazyPluginManager(object):
+    """Wraps a yapsy PluginManager and only collects and activates the
+    plugins when they are used for the first time.
+
+    Importing plugins may be expensive (e.g. the default plugins
+    import vigra), and many ilastik runs never need them.
+
+    The plugin directories that were found to contain plugins are
+    remembered in a manifest file, together with the modification
+    times of all directories below the plugin paths and of the plugin
+    info files. As long as none of these changed (and no directory was
+    added), only the directories listed in the manifest are searched.
+
+    """
+    def __init__(self, plugin_paths, categories_filter, manifest_path=None):
+        self._plugin_paths = plugin_paths
+        self._categories_filter = categories_filter
+        self._manifest_path = manifest_path
+        self._manager = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        # Only called for attributes not defined here, i.e. the
+        # methods of the wrapped yapsy PluginManager.
+        # Private and special names are never forwarded: copy and
+        # pickle look them up before __init__ has run.
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._getManager(), name)
+
+    @property
+    def loaded(self):
+        return self._manager is not None
+
+    def _getManager(self):
+        with self._lock:
+            if self._manager is None:
+                self._manager = self._collect()
+            return self._manager
+
+    def _collect(self):
+        start = time.time()
+        plugin_places, from_manifest = self._pluginPlaces()
+
+        manager = PluginManager()
+        manager.setPluginPlaces(plugin_places)
+        manager.setCategoriesFilter(self._categories_filter)
+        manager.collectPlugins()
+        for pluginInfo in manager.getAllPlugins():
+            manager.activatePluginByName(pluginInfo.name)
+
+        if not from_manifest:
+            places = sorted(set(os.path.dirname(os.path.abspath(pluginInfo.path))
+                                for pluginInfo in manager.getAllPlugins()))
+            self._writeManifest({'mtimes': self._mTimes(self._watchedPaths(places)),
+                                 'places': places})
+
+        logger.debug("Collected {} plugins in {:.3f}s".format(len(manager.getAllPlugins()),
+                                                              time.time() - start))
+        return manager
+
+    def _pluginPlaces(self):
+        """Return (directories to search, whether they come from the manifest)."""
+        manifest = self._readManifest()
+        if manifest is not None:
+            watched = manifest['mtimes'].keys()
+            # The manifest must cover the current plugin paths
+            # (e.g. a plugin path that didn't exist before).
+            if set(self._watchedPaths([])) <= set(watched) \
+               and manifest['mtimes'] == self._mTimes(watched):
+                return manifest['places'], True
+        return self._plugin_paths, False
+
+    def _watchedPaths(self, places):
+        """The paths whose modification times are recorded in the
+        manifest: all directories below the plugin paths (so new
+        plugins are found at any depth) and the plugin info files in
+        the plugin directories. Walking the directories is cheap
+        compared to importing the plugins, which is what the manifest
+        avoids.
 
-pluginManager.setCategoriesFilter({
-   "ObjectFeatures" : ObjectFeaturesPlugin,
-   })
+        """
+        paths = []
+        for plugin_path in self._plugin_paths:
+            for directory, _, _ in os.walk(os.path.abspath(plugin_path)):
+                paths.append(directory)
+        for place in places:
+            paths.append(place)
+            if os.path.isdir(place):
+                paths += [os.path.join(place, name) for name in os.listdir(place)
+                          if name.endswith('.yapsy-plugin')]
+        return sorted(set(paths))
 
-pluginManager.collectPlugins()
-for pluginInfo in pluginManager.getAllPlugins():
-    pluginManager.activatePluginByName(pluginInfo.name)
+    @staticmethod
+    def _mTimes(paths):
+        mtimes = {}
+        for path in paths:
+            try:
+                mtimes[path] = os.path.getmtime(path)
+            except OSError:
+                mtimes[path] = None
+        return mtimes
+
+    def _readManifest(self):
+        if self._manifest_path is None or not os.path.exists(self._manifest_path):
+            return None
+        try:
+            with open(self._manifest_path, 'r') as f:
+                manifest = json.load(f)
+        except (IOError, ValueError) as ex:
+            logger.debug("Ignoring unreadable plugin manifest {}: {}".format(self._manifest_path, ex))
+            return None
+        if manifest.get('plugin_paths') != self._plugin_paths:
+            return None
+        return manifest
+
+    def _writeManifest(self, manifest):
+        if self._manifest_path is None:
+            return
+        manifest['plugin_paths'] = self._plugin_paths
+        try:
+            manifest_dir = os.path.dirname(self._manifest_path)
+            if manifest_dir and not os.path.exists(manifest_dir):
+                os.makedirs(manifest_dir)
+            # Write to a temporary file first, so concurrent processes
+            # never read a half-written manifest.
+            tmp_path = "{}.{}.tmp".format(self._manifest_path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(manifest, f)
+            os.rename(tmp_path, self._manifest_path)
+        except (IOError, OSError) as ex:
+            logger.debug("Could not write plugin manifest {}: {}".format(self._manifest_path, ex))
+
+pluginManager = LazyPluginManager(plugin_paths,
+                                  { "ObjectFeatures" : ObjectFeaturesPlugin },
+                                  plugin_manifest)
@@ -19,6 +19,7 @@ import ilastik.applets.objectExtraction.opObjectExtraction
 #from ilastik.applets.objectExtraction.opObjectExtraction import make_bboxes, max_margin
 import vigra
 import numpy as np
+from collections import defaultdict
 from lazyflow.request import Request, RequestPool
 
 def cleanup_key(k):
@@ -139,20 +140,29 @@ class VigraObjFeats(ObjectFeaturesPlugin):
 
     def compute_local(self, image, binary_bbox, feature_dict, axes):
         """helper that deals with individual objects"""
+        opObjectExtraction = ilastik.applets.objectExtraction.opObjectExtraction
         
         featurenames = feature_dict.keys()
         local = [x+self.local_suffix for x in self.local_features]
         featurenames = list(set(featurenames) & set(local))
-        featurenames = [x.split(' ')[0] for x in featurenames]
+
+        # group the features by their margins, all features of one
+        # group are computed with a single vigra call
+        groups = defaultdict(list)
+        for name in featurenames:
+            margin = opObjectExtraction.max_margin({'': {name: feature_dict[name]}})
+            groups[tuple(margin)].append(name.split(' ')[0])
+
+        # margins with the same proportions share the distance transform
+        dts = {}
         results = []
-        margin = ilastik.applets.objectExtraction.opObjectExtraction.max_margin({'': feature_dict})
-        #FIXME: this is done globally as if all the features have the same margin
-        #we should group features by their margins
-        passed, excl = ilastik.applets.objectExtraction.opObjectExtraction.make_bboxes(binary_bbox, margin)
-        #assert np.all(passed==excl)==False
-        #assert np.all(binary_bbox+excl==passed)
-        for label, suffix in zip([excl, passed],
-                                 self.local_out_suffixes):
-            result = self._do_4d(image, label, featurenames, axes)
-            results.append(self.update_keys(result, suffix=suffix))
+        for margin, names in sorted(groups.iteritems()):
+            pitch = opObjectExtraction.margin_pitch(margin)
+            if pitch not in dts:
+                dts[pitch] = opObjectExtraction.object_distance_transform(binary_bbox, margin)
+            passed, excl = opObjectExtraction.make_bboxes(binary_bbox, margin, dts[pitch])
+            for label, suffix in zip([excl, passed],
+                                     self.local_out_suffixes):
+                result = self._do_4d(image, label, names, axes)
+                results.append(self.update_keys(result, suffix=suffix))
         return self.combine_dicts(results)
@@ -46,6 +46,31 @@ class VigraTest(unittest.TestCase):
         feats = self.myclass.availableFeatures(img, labels)
         self._testFeatures(feats)
 
+    def testLocalFeaturesUsePerFeatureMargin(self):
+        from ilastik.applets.objectExtraction.opObjectExtraction import make_bboxes
+
+        class Axes(object):
+            x, y, z, c = 0, 1, 2, 3
+
+        image = np.random.rand(30, 30, 10, 1).astype(np.float32)
+        binary_bbox = np.zeros((30, 30, 10), dtype=np.bool)
+        binary_bbox[12:18, 12:18, 4:6] = True
+
+        self.myclass.ndim = 3
+        small, large = (2, 2, 1), (8, 8, 4)
+        feats = self.myclass.compute_local(image, binary_bbox,
+                                           {"Sum in neighborhood": {"margin": small},
+                                            "Mean in neighborhood": {"margin": large},
+                                            "Count": {}},
+                                           Axes())
+
+        for name, margin in [("Sum", small), ("Mean", large)]:
+            passed, excl = make_bboxes(binary_bbox, margin)
+            data = image[..., 0]
+            expected = {"Sum": np.sum, "Mean": np.mean}[name]
+            self.assertTrue(np.allclose(feats[name + " in neighborhood"], expected(data[excl]), rtol=1e-4))
+            self.assertTrue(np.allclose(feats[name + " in object and neighborhood"], expected(data[passed]), rtol=1e-4))
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
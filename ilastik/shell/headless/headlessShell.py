@@ -43,7 +43,11 @@ class HeadlessShell(object):
                                               workflow_cmdline_args=self._workflow_cmdline_args  )
         self.projectManager._loadProject(hdf5File, newProjectFilePath, readOnly)
         
-    def openProjectFile(self, projectFilePath):
+    def openProjectFile(self, projectFilePath, loadProfile=None):
+        """
+        :param loadProfile: Only load the parts of the project needed by the given profile 
+                            (e.g. 'prediction').  See ``ProjectManager``.
+        """
         # Make sure all workflow sub-classes have been loaded,
         #  so we can detect the workflow type in the project.
         import ilastik.workflows
@@ -73,7 +77,8 @@ class HeadlessShell(object):
                                                   workflow_class,
                                                   headless=True,
                                                   workflow_cmdline_args=self._workflow_cmdline_args,
-                                                  project_creation_args=project_creation_args )
+                                                  project_creation_args=project_creation_args,
+                                                  loadProfile=loadProfile )
             self.projectManager._loadProject(hdf5File, projectFilePath, readOnly = False)
 
         except ProjectManager.FileMissingError:
@@ -42,6 +42,9 @@ class ProjectManager(object):
     member for direct access to its applets and their top-level operators.
     """
 
+    #: Root attribute that is set while the project is being saved
+    SaveInProgressAttr = "saveInProgress"
+
     #########################
     ## Error types
     #########################    
@@ -147,7 +150,7 @@ class ProjectManager(object):
     ## Public methods
     #########################    
 
-    def __init__(self, shell, workflowClass, headless=False, workflow_cmdline_args=None, project_creation_args=None):
+    def __init__(self, shell, workflowClass, headless=False, workflow_cmdline_args=None, project_creation_args=None, loadProfile=None):
         """
         Constructor.
         
@@ -155,6 +158,9 @@ class ProjectManager(object):
         :param headless: A bool that is passed to the workflow constructor, 
                          indicating whether or not the workflow should be opened in 'headless' mode.
         :param workflow_cmdline_args: A list of strings from the command-line to configure the workflow.
+        :param loadProfile: If given (e.g. 'prediction'), serializers only load the parts of the project 
+                            that this profile needs (see ``AppletSerializer.loadProfiles``).  The rest is 
+                            loaded by ``loadDeferredState()``, e.g. before the project is saved.
         """
         # Init
         self.closed = True
@@ -169,6 +175,7 @@ class ProjectManager(object):
         self._workflow_cmdline_args = workflow_cmdline_args or []
         self._project_creation_args = project_creation_args or []
         self._headless = headless
+        self._loadProfile = loadProfile
         
         #the workflow class has to be specified at this point
         assert workflowClass is not None
@@ -202,6 +209,15 @@ class ProjectManager(object):
                     dirtyAppletNames.append(applet.name)
         return dirtyAppletNames
 
+    def loadDeferredState(self):
+        """
+        Load the parts of the project that were skipped because of the load profile.
+        """
+        for aplt in self._applets:
+            for item in aplt.dataSerializers:
+                if hasattr(item, 'loadDeferred'):
+                    item.loadDeferred()
+
     def saveProject(self, force_all_save=False):
         """
         Update the project file with the state of the current workflow settings.
@@ -212,12 +228,19 @@ class ProjectManager(object):
         assert self.currentProjectPath != None
         assert not self.currentProjectIsReadOnly, "Can't save a read-only project"
 
+        # Don't save the state of a partially loaded project
+        self.loadDeferredState()
+
         # Minor GUI nicety: Pre-activate the progress signals for dirty applets so
         #  the progress manager treats these tasks as a group instead of several sequential jobs.
         for aplt in self._applets:
             for ser in aplt.dataSerializers:
                 if ser.isDirty():
                     aplt.progressSignal.emit(0)
+
+        # Mark the file until the save is complete, so an interrupted save is noticed when the project is opened again.
+        self.currentProjectFile.attrs[self.SaveInProgressAttr] = True
+        self.currentProjectFile.flush()
         try:
             # Applet serializable items are given the whole file (root group) for now
             for aplt in self._applets:
@@ -231,6 +254,9 @@ class ProjectManager(object):
                 del self.currentProjectFile["workflowName"]
             self.currentProjectFile.create_dataset("workflowName",data = self.workflow.workflowName)
 
+            self.currentProjectFile.flush()
+            del self.currentProjectFile.attrs[self.SaveInProgressAttr]
+
         except Exception, err:
             logger.error("Project Save Action failed due to the following exception:")
             traceback.print_exc()
@@ -253,6 +279,7 @@ class ProjectManager(object):
         Copy the project file as it is, then serialize any dirty state into the copy.
         Original serializers and project file should not be touched.
         """
+        self.loadDeferredState()
         with h5py.File(snapshotPath, 'w') as snapshotFile:
             # Minor GUI nicety: Pre-activate the progress signals for dirty applets so
             #  the progress manager treats these tasks as a group instead of several sequential jobs.
@@ -313,6 +340,9 @@ class ProjectManager(object):
             self._takeSnapshotAndLoadIt(newPath)
             return
 
+        # The deferred state is read from the current file, which is closed below
+        self.loadDeferredState()
+
         oldPath = self.currentProjectPath
         try:
             self.currentProjectFile.close()
@@ -375,6 +405,10 @@ class ProjectManager(object):
         for aplt in self._applets:
             aplt.progressSignal.emit(0)
 
+        if self.SaveInProgressAttr in hdf5File.attrs:
+            logger.warning( "The last save of {} did not complete. Labels are loaded from their last "
+                            "completely saved state, but other settings may be incomplete.".format( projectFilePath ) )
+
         # Save this as the current project
         self.currentProjectFile = hdf5File
         self.currentProjectPath = projectFilePath
@@ -386,6 +420,8 @@ class ProjectManager(object):
                     for item in aplt.dataSerializers:
                         assert item.base_initialized, "AppletSerializer subclasses must call AppletSerializer.__init__ upon construction."
                         item.ignoreDirty = True
+                        if hasattr(item, 'loadProfile'):
+                            item.loadProfile = self._loadProfile
                                             
                         if item.caresOfHeadless:
                             item.deserializeFromHdf5(self.currentProjectFile, projectFilePath, self._headless)
@@ -0,0 +1,201 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+import os
+import glob
+import json
+import time
+import Queue
+import threading
+import traceback
+
+import logging
+logger = logging.getLogger(__name__)
+
+class BatchJob(object):
+    """
+    One file of a batch run.
+
+    :param name: Used for logging only.
+    :param run: Callable without arguments that produces the output file.
+    :param inputPath: The input file (or globstring).  Its modification time is recorded in the manifest.
+    :param outputPath: The output file.  Also used as the key of the job in the manifest.
+    :param memoryEstimate: Number of bytes the job is expected to hold while it runs.
+
+    After the batch has run, ``status`` is one of 'done', 'skipped' or 'failed' and
+    ``seconds`` is the time the job took.
+    """
+    def __init__(self, name, run, inputPath=None, outputPath=None, memoryEstimate=0):
+        self.name = name
+        self.run = run
+        self.inputPath = inputPath
+        self.outputPath = outputPath
+        self.memoryEstimate = memoryEstimate
+        self.status = None
+        self.seconds = None
+
+def inputTimestamp(inputPath):
+    """
+    The most recent modification time of the given file, or of all files matching the given globstring.
+    """
+    files = glob.glob(inputPath)
+    if not files:
+        return None
+    return max( os.path.getmtime(f) for f in files )
+
+class BatchManifest(object):
+    """
+    Records the finished jobs of a batch run in a json file, so that an interrupted run can be resumed.
+    A job is considered finished if its output file still exists, its input wasn't modified since and
+    it was produced with the same checksum (e.g. of the project or classifier that computes the outputs).
+    The file is rewritten after each job (write to a temporary file, then rename it).
+    """
+    def __init__(self, path, checksum=None):
+        self.path = path
+        self.checksum = checksum
+        self._lock = threading.Lock()
+        self._entries = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    self._entries = json.load(f)
+            except ValueError:
+                logger.warn( "Ignoring unreadable batch manifest: {}".format(path) )
+
+    def isDone(self, job):
+        with self._lock:
+            entry = self._entries.get( job.outputPath )
+        if entry is None or entry['status'] != 'done':
+            return False
+        if not os.path.exists( job.outputPath ):
+            return False
+        if entry.get('checksum') != self.checksum:
+            return False
+        return entry['input'] == job.inputPath and entry['input_mtime'] == self._timestamp(job)
+
+    def record(self, job):
+        entry = { 'input' : job.inputPath,
+                  'input_mtime' : self._timestamp(job),
+                  'checksum' : self.checksum,
+                  'status' : job.status,
+                  'seconds' : job.seconds }
+        with self._lock:
+            self._entries[job.outputPath] = entry
+            self._save()
+
+    def _timestamp(self, job):
+        if job.inputPath is None:
+            return None
+        return inputTimestamp( job.inputPath )
+
+    def _save(self):
+        tmpPath = self.path + '.tmp'
+        with open(tmpPath, 'w') as f:
+            json.dump( self._entries, f, indent=2, sort_keys=True )
+        if os.name == 'nt' and os.path.exists(self.path):
+            # On windows, rename() doesn't replace existing files.
+            os.remove(self.path)
+        os.rename(tmpPath, self.path)
+
+class BatchScheduler(object):
+    """
+    Runs a list of BatchJobs, up to maxParallelJobs at a time.
+
+    If a memoryLimit (in bytes) is given, a job only starts once the memory estimates of
+    all running jobs plus its own fit into the limit.  A job that exceeds the limit on its own
+    runs when no other job is running.
+
+    A failed job is logged and doesn't stop the other jobs.
+    """
+    def __init__(self, maxParallelJobs=1, memoryLimit=None, manifest=None):
+        assert maxParallelJobs >= 1
+        self.maxParallelJobs = maxParallelJobs
+        self.memoryLimit = memoryLimit
+        self.manifest = manifest
+
+        self._memoryCondition = threading.Condition()
+        self._reservedMemory = 0
+
+    def run(self, jobs):
+        """
+        Run the given jobs and return True if none of them failed.
+        """
+        queue = Queue.Queue()
+        for job in jobs:
+            if self.manifest is not None and self.manifest.isDone(job):
+                logger.info( "Skipping {}: {} is up-to-date.".format( job.name, job.outputPath ) )
+                job.status = 'skipped'
+            else:
+                queue.put( job )
+
+        numWorkers = min( self.maxParallelJobs, queue.qsize() )
+        workers = []
+        for i in range(numWorkers):
+            worker = threading.Thread( target=self._work, args=(queue,), name="BatchWorker-{}".format(i) )
+            worker.daemon = True
+            worker.start()
+            workers.append( worker )
+        for worker in workers:
+            worker.join()
+
+        totalSeconds = sum( job.seconds for job in jobs if job.seconds is not None )
+        numFailed = len( filter( lambda job: job.status == 'failed', jobs ) )
+        logger.info( "Batch finished: {} jobs, {} skipped, {} failed, {:.1f} seconds of work."
+                     .format( len(jobs), len( filter( lambda job: job.status == 'skipped', jobs ) ), numFailed, totalSeconds ) )
+        return numFailed == 0
+
+    def _work(self, queue):
+        while True:
+            try:
+                job = queue.get_nowait()
+            except Queue.Empty:
+                return
+            self._reserve( job.memoryEstimate )
+            try:
+                self._runJob( job )
+            finally:
+                self._release( job.memoryEstimate )
+
+    def _runJob(self, job):
+        logger.info( "Starting {}".format( job.name ) )
+        start = time.time()
+        try:
+            job.run()
+        except:
+            job.status = 'failed'
+            logger.error( "Batch job {} failed:\n{}".format( job.name, traceback.format_exc() ) )
+        else:
+            job.status = 'done'
+        job.seconds = time.time() - start
+        logger.info( "Finished {} ({}) in {:.2f} seconds".format( job.name, job.status, job.seconds ) )
+
+        if self.manifest is not None and job.outputPath is not None:
+            self.manifest.record( job )
+
+    def _reserve(self, nbytes):
+        if self.memoryLimit is None:
+            return
+        with self._memoryCondition:
+            while self._reservedMemory > 0 and self._reservedMemory + nbytes > self.memoryLimit:
+                self._memoryCondition.wait()
+            self._reservedMemory += nbytes
+
+    def _release(self, nbytes):
+        if self.memoryLimit is None:
+            return
+        with self._memoryCondition:
+            self._reservedMemory -= nbytes
+            self._memoryCondition.notify_all()
@@ -0,0 +1,404 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+# Built-in
+import logging
+import threading
+import collections
+from functools import partial
+
+# Third-party
+import numpy
+import vigra
+
+# lazyflow
+from lazyflow.graph import Operator, InputSlot, OutputSlot
+from lazyflow.request import Request, RequestPool, RequestLock
+from lazyflow.roi import getIntersectingBlocks, getBlockBounds, getIntersection, roiToSlice
+
+logger = logging.getLogger(__name__)
+
+class UnionFind(object):
+    """
+    Disjoint sets of the integers 0..n-1.
+    The representative of each set is its smallest element.
+    """
+    def __init__(self, n):
+        self.parent = numpy.arange(n, dtype=numpy.uint32)
+
+    def find(self, i):
+        parent = self.parent
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(self, a, b):
+        ra = self.find(a)
+        rb = self.find(b)
+        if ra < rb:
+            self.parent[rb] = ra
+        elif rb < ra:
+            self.parent[ra] = rb
+
+    def roots(self):
+        """
+        Return an array with the representative of every element.
+        """
+        roots = self.parent.copy()
+        while True:
+            next_roots = roots[roots]
+            if (next_roots == roots).all():
+                return roots
+            roots = next_roots
+
+class _SliceLabeling(object):
+    """
+    The result of the labeling pass for one time slice.
+
+    Each block is labeled on its own.  A label l > 0 of a block becomes the
+    provisional label offsets[block_start] + l, and lut maps the provisional
+    labels to the final, globally consistent labels 1..num_labels.
+    sizes[l] is the number of pixels of the final label l.
+    """
+    def __init__(self, offsets, lut, sizes):
+        self.offsets = offsets
+        self.lut = lut
+        self.sizes = sizes
+        self.num_labels = int(lut.max()) if len(lut) > 0 else 0
+        self._filtered = None
+
+    def filteredLut(self, min_size, max_size):
+        """
+        Like lut, but labels with less than min_size or more than max_size pixels are mapped to 0.
+        (max_size may be None.)
+        """
+        filtered = self._filtered
+        if filtered is None or filtered[0] != (min_size, max_size):
+            keep = self.sizes >= min_size
+            if max_size is not None:
+                keep &= self.sizes <= max_size
+            keep[0] = False
+            filtered = ( (min_size, max_size), numpy.where( keep[self.lut], self.lut, 0 ).astype( numpy.uint32 ) )
+            self._filtered = filtered
+        return filtered[1]
+
+class OpBlockwiseConnectedComponents(Operator):
+    """
+    Connected components of a binary image, computed block by block.
+
+    On the first request for a time slice, every block is labeled
+    independently (in parallel) and the labels that touch across block faces
+    are merged with a union-find table.  Only the faces of the blocks are kept
+    in memory, so this works for volumes that don't fit into RAM.  Afterwards,
+    each requested block is labeled again and mapped to the global labels.
+
+    The output labels are consistent across the whole time slice and
+    numbered 1..N in the order of the blocks.  Voxels are connected via
+    their faces (6-neighborhood in 3D, 4-neighborhood in 2D).
+
+    The size of each label is counted during the labeling pass, so
+    FilteredOutput (the labels without those that are smaller than
+    MinLabelSize or bigger than MaxLabelSize) only needs a table lookup.
+    Changing the size limits doesn't trigger a new labeling pass.
+
+    The block labels of the most recently used MaxCachedBlocks blocks are
+    kept, so many small requests (e.g. the bounding boxes of the objects)
+    don't label the same blocks over and over again.
+    """
+    Input = InputSlot() # Binary image with a single channel
+    BlockShape = InputSlot( value={'x' : 256, 'y' : 256, 'z' : 256} ) # A dict of SPATIAL block dims
+    MinLabelSize = InputSlot( value=0 )
+    MaxLabelSize = InputSlot( optional=True )
+    MaxCachedBlocks = InputSlot( value=16 ) # Number of labeled blocks to keep (0: no cache)
+
+    Output = OutputSlot()
+    FilteredOutput = OutputSlot() # Same labels as Output, but without the labels outside the size limits
+
+    def __init__(self, *args, **kwargs):
+        super( OpBlockwiseConnectedComponents, self ).__init__( *args, **kwargs )
+        self._labelings = {} # indexed by t
+        self._lock = RequestLock()
+        self._blockLabels = collections.OrderedDict() # block_start : labels of the block on its own, LRU order
+        self._blockLabelsLock = threading.Lock()
+
+    def setupOutputs(self):
+        tagged_shape = self.Input.meta.getTaggedShape()
+        assert tagged_shape.get('c', 1) == 1, "Input must have a single channel"
+
+        self.Output.meta.assignFrom( self.Input.meta )
+        self.Output.meta.dtype = numpy.uint32
+        self.FilteredOutput.meta.assignFrom( self.Output.meta )
+
+        self._spatial_axes = [ i for i, k in enumerate( tagged_shape.keys() ) if k in 'xyz' ]
+        self._block_shape = self._getBlockShape()
+        self._labelings = {}
+        self._clearBlockLabels()
+
+    def _getBlockShape(self):
+        block_shape_dict = self.BlockShape.value
+        block_shape = []
+        for k, size in self.Input.meta.getTaggedShape().items():
+            if k in 'xyz':
+                block_shape.append( min( block_shape_dict[k], size ) )
+            else:
+                block_shape.append( 1 )
+        return numpy.array( block_shape )
+
+    def execute(self, slot, subindex, roi, result):
+        assert slot == self.Output or slot == self.FilteredOutput
+        block_starts = getIntersectingBlocks( self._block_shape, (roi.start, roi.stop) )
+        if slot == self.FilteredOutput:
+            max_size = self.MaxLabelSize.value if self.MaxLabelSize.ready() else None
+            get_lut = lambda labeling: labeling.filteredLut( self.MinLabelSize.value, max_size )
+        else:
+            get_lut = lambda labeling: labeling.lut
+
+        def copy_block( block_start ):
+            block_roi = getBlockBounds( self.Input.meta.shape, self._block_shape, block_start )
+            labeling = self._getLabeling( self._timeIndex( block_start ) )
+            labels = self._globalBlockLabels( labeling, block_roi, get_lut( labeling ) )
+            intersection = getIntersection( block_roi, (roi.start, roi.stop) )
+            source = labels[ roiToSlice( *numpy.subtract( intersection, block_roi[0] ) ) ]
+            result[ roiToSlice( *numpy.subtract( intersection, roi.start ) ) ] = source
+
+        pool = RequestPool()
+        for block_start in block_starts:
+            pool.add( Request( partial( copy_block, block_start ) ) )
+        pool.wait()
+        return result
+
+    def getLabelCount(self, t=0):
+        """
+        The number of objects in the given time slice.
+        """
+        return self._getLabeling( t ).num_labels
+
+    def getLabelSizes(self, t=0):
+        """
+        The number of pixels of each label in the given time slice, as an array indexed by label.
+        (Entry 0 is always 0.)
+        """
+        return self._getLabeling( t ).sizes
+
+    def _timeIndex(self, block_start):
+        keys = self.Input.meta.getAxisKeys()
+        if 't' in keys:
+            return block_start[ keys.index('t') ]
+        return 0
+
+    def _getLabeling(self, t):
+        labeling = self._labelings.get( t )
+        if labeling is not None:
+            return labeling
+        with self._lock:
+            if t not in self._labelings:
+                self._labelings[t] = self._computeLabeling( t )
+            return self._labelings[t]
+
+    def _computeLabeling(self, t):
+        """
+        Label all blocks of the time slice and merge the labels across block faces.
+        """
+        shape = numpy.array( self.Input.meta.shape )
+        slice_start = numpy.zeros_like( shape )
+        slice_stop = shape.copy()
+        keys = self.Input.meta.getAxisKeys()
+        if 't' in keys:
+            slice_start[ keys.index('t') ] = t
+            slice_stop[ keys.index('t') ] = t+1
+        block_starts = [ tuple( map( int, block_start ) ) for block_start in getIntersectingBlocks( self._block_shape, (slice_start, slice_stop) ) ]
+
+        # Label each block, and keep only its label sizes and its faces (in sparse form).
+        block_faces = {}
+        def label_block( block_start ):
+            block_roi = getBlockBounds( shape, self._block_shape, block_start )
+            labels = self._labelBlock( block_roi )
+            self._cacheBlockLabels( block_start, labels )
+            faces = {}
+            for axis in self._spatial_axes:
+                first = [slice(None)] * labels.ndim
+                last = [slice(None)] * labels.ndim
+                first[axis] = 0
+                last[axis] = -1
+                faces[axis] = ( _SparseFace( labels[tuple(first)] ), _SparseFace( labels[tuple(last)] ) )
+            block_faces[block_start] = ( numpy.bincount( labels.reshape(-1) )[1:], faces )
+
+        pool = RequestPool()
+        for block_start in block_starts:
+            pool.add( Request( partial( label_block, block_start ) ) )
+        pool.wait()
+
+        # Provisional labels: offset the labels of each block (in a deterministic block order)
+        offsets = {}
+        total = 0
+        provisional_sizes = [ numpy.zeros( (1,), dtype=numpy.int64 ) ]
+        for block_start in sorted( block_starts ):
+            offsets[block_start] = total
+            total += len( block_faces[block_start][0] )
+            provisional_sizes.append( block_faces[block_start][0] )
+        provisional_sizes = numpy.concatenate( provisional_sizes )
+
+        # Merge the labels that touch across block faces
+        union_find = UnionFind( total+1 )
+        for block_start in block_starts:
+            for axis in self._spatial_axes:
+                neighbor_start = list( block_start )
+                neighbor_start[axis] += self._block_shape[axis]
+                neighbor_start = tuple( neighbor_start )
+                if neighbor_start not in offsets:
+                    continue
+                last_face = block_faces[block_start][1][axis][1].toDense()
+                first_face = block_faces[neighbor_start][1][axis][0].toDense()
+                touching = (last_face > 0) & (first_face > 0)
+                if not touching.any():
+                    continue
+                pairs = numpy.column_stack( ( last_face[touching].astype(numpy.int64) + offsets[block_start],
+                                              first_face[touching].astype(numpy.int64) + offsets[neighbor_start] ) )
+                for a, b in _unique_rows( pairs ):
+                    union_find.union( a, b )
+
+        # Number the merged labels consecutively
+        roots = union_find.roots()
+        lut = numpy.zeros( (total+1,), dtype=numpy.uint32 )
+        if total > 0:
+            _, inverse = numpy.unique( roots[1:], return_inverse=True )
+            lut[1:] = inverse + 1
+        sizes = numpy.bincount( lut, weights=provisional_sizes ).astype( numpy.int64 )
+        sizes[0] = 0
+        labeling = _SliceLabeling( offsets, lut, sizes )
+        logger.debug( "Time slice {}: merged {} block labels into {} objects".format( t, total, labeling.num_labels ) )
+        return labeling
+
+    def _labelBlock(self, block_roi):
+        """
+        Label a single block on its own.  Returns the labels with all axes of the input.
+        """
+        data = self.Input( *block_roi ).wait()
+        spatial_slicing = [ slice(None) if i in self._spatial_axes else 0 for i in range(data.ndim) ]
+        binary = numpy.asarray( data[tuple(spatial_slicing)] != 0, dtype=numpy.uint8 )
+
+        # vigra needs exactly 2 or 3 dimensions
+        squeezed = binary.squeeze()
+        if squeezed.ndim == 0:
+            squeezed = squeezed.reshape( (1,1) )
+        elif squeezed.ndim == 1:
+            squeezed = squeezed.reshape( (-1,1) )
+        if squeezed.ndim == 2:
+            labels = vigra.analysis.labelImageWithBackground( squeezed )
+        else:
+            labels = vigra.analysis.labelVolumeWithBackground( squeezed )
+        return numpy.asarray( labels, dtype=numpy.uint32 ).reshape( data.shape )
+
+    def _globalBlockLabels(self, labeling, block_roi, lut):
+        block_start = tuple( map( int, block_roi[0] ) )
+        with self._blockLabelsLock:
+            labels = self._blockLabels.pop( block_start, None )
+            if labels is not None:
+                # Mark as most recently used
+                self._blockLabels[block_start] = labels
+        if labels is None:
+            labels = self._labelBlock( block_roi )
+            self._cacheBlockLabels( block_start, labels )
+        offset = labeling.offsets[block_start]
+        provisional = numpy.where( labels > 0, labels + offset, 0 )
+        return lut[ provisional ]
+
+    def _cacheBlockLabels(self, block_start, labels):
+        max_blocks = self.MaxCachedBlocks.value
+        with self._blockLabelsLock:
+            self._blockLabels.pop( block_start, None )
+            if max_blocks <= 0:
+                return
+            self._blockLabels[block_start] = labels
+            while len( self._blockLabels ) > max_blocks:
+                self._blockLabels.popitem( last=False )
+
+    def _clearBlockLabels(self, t_range=None):
+        """
+        Discard the cached block labels (only those of the given time slices, if a range is given).
+        """
+        with self._blockLabelsLock:
+            if t_range is None:
+                self._blockLabels.clear()
+                return
+            for block_start in list( self._blockLabels.keys() ):
+                if self._timeIndex( block_start ) in t_range:
+                    del self._blockLabels[block_start]
+
+    def propagateDirty(self, slot, subindex, roi):
+        if slot == self.MinLabelSize or slot == self.MaxLabelSize:
+            # The labeling is still valid
+            self.FilteredOutput.setDirty( slice(None) )
+            return
+
+        if slot == self.MaxCachedBlocks:
+            self._clearBlockLabels()
+            return
+
+        if slot == self.BlockShape:
+            self._labelings = {}
+            self._clearBlockLabels()
+            self.Output.setDirty( slice(None) )
+            self.FilteredOutput.setDirty( slice(None) )
+            return
+
+        # The labels of the whole time slice may change
+        keys = self.Input.meta.getAxisKeys()
+        if 't' not in keys:
+            self._labelings = {}
+            self._clearBlockLabels()
+            self.Output.setDirty( slice(None) )
+            self.FilteredOutput.setDirty( slice(None) )
+            return
+
+        t_index = keys.index('t')
+        with self._lock:
+            for t in range( roi.start[t_index], roi.stop[t_index] ):
+                self._labelings.pop( t, None )
+        self._clearBlockLabels( range( roi.start[t_index], roi.stop[t_index] ) )
+        start = numpy.zeros( (len(keys),), dtype=int )
+        stop = numpy.array( self.Output.meta.shape )
+        start[t_index] = roi.start[t_index]
+        stop[t_index] = roi.stop[t_index]
+        self.Output.setDirty( start, stop )
+        self.FilteredOutput.setDirty( start, stop )
+
+class _SparseFace(object):
+    """
+    The labels on one face of a block, stored as the (flat) positions and labels of the foreground.
+    """
+    def __init__(self, face):
+        self.shape = face.shape
+        flat = face.reshape(-1)
+        self.indexes = numpy.flatnonzero( flat )
+        self.labels = flat[self.indexes]
+
+    def toDense(self):
+        dense = numpy.zeros( (numpy.prod(self.shape),), dtype=numpy.uint32 )
+        dense[self.indexes] = self.labels
+        return dense.reshape( self.shape )
+
+def _unique_rows(pairs):
+    """
+    Return the unique rows of a 2-column integer array.
+    """
+    if len(pairs) == 0:
+        return pairs
+    pairs = numpy.ascontiguousarray( pairs )
+    view = pairs.view( numpy.dtype( (numpy.void, pairs.dtype.itemsize * pairs.shape[1]) ) )
+    _, index = numpy.unique( view, return_index=True )
+    return pairs[index]
@@ -39,12 +39,14 @@ logger = logging.getLogger(__name__)
 # HCI
 import lazyflow.request
 from lazyflow.graph import OperatorWrapper
+from lazyflow.rtype import Roi, SubRegion
 
 # ilastik
 import ilastik.monkey_patches
 from lazyflow.utility.timer import timeLogged
 from ilastik.clusterConfig import parseClusterConfigFile
 from ilastik.clusterOps import OpClusterize, OpTaskWorker
+from ilastik.clusterWorkQueue import BlockWorkQueue, WorkerHeartbeat
 from ilastik.shell.headless.headlessShell import HeadlessShell
 from lazyflow.utility.pathHelpers import getPathVariants
 from ilastik.workflow import Workflow
@@ -80,6 +82,7 @@ def getArgParser():
     parser.add_argument('--output_description_file', help='The JSON file that describes the output dataset', required=False)
     parser.add_argument('--secondary_output_description_file', help='A secondary output description file, which will be used if the workflow supports secondary outputs.', required=False, action='append')
     parser.add_argument('--_node_work_', help='Internal use only', required=False)
+    parser.add_argument('--_node_work_queue_', help='Internal use only', required=False)
 
     return parser
 
@@ -107,8 +110,10 @@ def runWorkflow(parsed_args):
         task_name = args.process_name
         ilastik.ilastik_logging.default_config.init(args.process_name + ' ')
 
+    isNodeTask = args._node_work_ is not None or args._node_work_queue_ is not None
+
     rootLogHandler = None
-    if args._node_work_ is None:
+    if not isNodeTask:
         # This is the master process.
         # Tee the log to a file for future reference.
 
@@ -133,7 +138,7 @@ def runWorkflow(parsed_args):
 
     # If we're running a node job, set the threadpool size if the user specified one.
     # Note that the main thread does not count toward the threadpool total.
-    if args._node_work_ is not None and config.task_threadpool_size is not None:
+    if isNodeTask and config.task_threadpool_size is not None:
         lazyflow.request.Request.reset_thread_pool( num_workers = config.task_threadpool_size )
 
     # Make sure project file exists.
@@ -161,13 +166,14 @@ def runWorkflow(parsed_args):
     
     clusterOperator = None
     try:
-        if args._node_work_ is not None:
+        if isNodeTask:
             # We're doing node work
             opClusterTaskWorker = OperatorWrapper( OpTaskWorker, parent=finalOutputSlot.getRealOperator().parent )
 
             # FIXME: Image index is hard-coded as 0.  We assume we are working with only one (big) dataset in cluster mode.            
             opClusterTaskWorker.Input.connect( finalOutputSlot )
-            opClusterTaskWorker.RoiString[0].setValue( args._node_work_ )
+            if args._node_work_ is not None:
+                opClusterTaskWorker.RoiString[0].setValue( args._node_work_ )
             opClusterTaskWorker.TaskName.setValue( task_name )
             opClusterTaskWorker.ConfigFilePath.setValue( args.option_config_file )
 
@@ -215,7 +221,10 @@ def runWorkflow(parsed_args):
         
         # Get the result
         logger.info("Starting task")
-        result = resultSlot[0].value # FIXME: The image index is hard-coded here.
+        if args._node_work_queue_ is not None:
+            result = runQueueWorker( args._node_work_queue_, task_name, config, opClusterTaskWorker )
+        else:
+            result = resultSlot[0].value # FIXME: The image index is hard-coded here.
     finally:
         logger.info("Cleaning up")
         global stop_background_tasks
@@ -240,6 +249,46 @@ def runWorkflow(parsed_args):
     if rootLogHandler is not None:
         rootLogHandler.close()
         
+def runQueueWorker(workQueuePath, workerName, config, opClusterTaskWorker):
+    """
+    Compute blocks from the shared work queue until no work is left.
+    Returns False if any of our blocks failed.
+    """
+    maxAttempts = ( config.task_max_retries or 0 ) + 1
+    workQueue = BlockWorkQueue( workQueuePath, staleClaimSecs=config.task_timeout_secs, maxAttempts=maxAttempts )
+    heartbeat = WorkerHeartbeat( workQueuePath, workerName, config.task_timeout_secs )
+    heartbeat.start()
+    allSucceeded = True
+    numBlocks = 0
+    try:
+        while True:
+            blockRoi = workQueue.claim( workerName )
+            if blockRoi is None:
+                break
+            start, stop = blockRoi
+            logger.info( "Claimed block {}".format( blockRoi ) )
+            opClusterTaskWorker.RoiString[0].setValue( Roi.dumps( SubRegion( None, start, stop ) ) )
+            try:
+                blockSucceeded = opClusterTaskWorker.ReturnCode[0].value # FIXME: The image index is hard-coded here.
+            except:
+                logger.error( "Failed to compute block {}:\n{}".format( blockRoi, traceback.format_exc() ) )
+                blockSucceeded = False
+
+            if blockSucceeded:
+                if workQueue.markDone( start, workerName ):
+                    numBlocks += 1
+            elif workQueue.release( start, workerName ):
+                logger.info( "Block {} will be retried.".format( blockRoi ) )
+            else:
+                logger.error( "Block {} failed {} times.  Giving up.".format( blockRoi, maxAttempts ) )
+                allSucceeded = False
+    finally:
+        heartbeat.stop()
+        workQueue.close()
+
+    logger.info( "Work queue is empty.  Computed {} blocks.".format( numBlocks ) )
+    return allSucceeded
+
 if __name__ == "__main__":
 
     #make the program quit on Ctrl+C
@@ -16,6 +16,7 @@
 
 import sys
 import copy
+import hashlib
 import argparse
 import logging
 logger = logging.getLogger(__name__)
@@ -28,6 +29,7 @@ from ilastik.applets.pixelClassification import PixelClassificationApplet, Pixel
 from ilastik.applets.projectMetadata import ProjectMetadataApplet
 from ilastik.applets.dataSelection import DataSelectionApplet
 from ilastik.applets.featureSelection import FeatureSelectionApplet
+from ilastik.applets.base.appletSerializer import groupChecksum
 
 from ilastik.applets.featureSelection.opFeatureSelection import OpFeatureSelectionNoCache
 from ilastik.applets.pixelClassification.opPixelClassification import OpPredictionPipelineNoCache
@@ -35,6 +37,9 @@ from ilastik.applets.pixelClassification.opPixelClassification import OpPredicti
 from lazyflow.roi import TinyVector, fullSlicing
 from lazyflow.graph import Graph, OperatorWrapper
 from lazyflow.operators.generic import OpTransposeSlots, OpSelectSubslot
+from lazyflow.utility import PathComponents
+
+from ilastik.utility.batchScheduler import BatchJob, BatchManifest, BatchScheduler
 
 class PixelClassificationWorkflow(Workflow):
     
@@ -67,6 +72,9 @@ class PixelClassificationWorkflow(Workflow):
         parser.add_argument('--generate-random-labels', help="Add random labels to the project file.", action="store_true")
         parser.add_argument('--random-label-value', help="The label value to use injecting random labels", default=1, type=int)
         parser.add_argument('--random-label-count', help="The number of random labels to inject via --generate-random-labels", default=2000, type=int)
+        parser.add_argument('--parallel-batch-files', help="The number of batch input files to process concurrently.", default=1, type=int)
+        parser.add_argument('--batch-memory-limit-mb', help="Don't start more concurrent batch files than fit into this much RAM (in MB).", default=None, type=int)
+        parser.add_argument('--batch-manifest', help="A json file recording the finished batch outputs.  Outputs that are listed as finished and whose input and project are unchanged are skipped.", default=None)
 
         # Parse the creation args: These were saved to the project file when this project was first created.
         parsed_creation_args, unused_args = parser.parse_known_args(project_creation_args)
@@ -79,6 +87,9 @@ class PixelClassificationWorkflow(Workflow):
         self.generate_random_labels = parsed_args.generate_random_labels
         self.random_label_value = parsed_args.random_label_value
         self.random_label_count = parsed_args.random_label_count
+        self.parallel_batch_files = parsed_args.parallel_batch_files
+        self.batch_memory_limit_mb = parsed_args.batch_memory_limit_mb
+        self.batch_manifest = parsed_args.batch_manifest
         
         if parsed_args.filter and parsed_args.filter != parsed_creation_args.filter:
             logger.error("Ignoring new --filter setting.  Filter implementation cannot be changed after initial project creation.")
@@ -299,6 +310,10 @@ class PixelClassificationWorkflow(Workflow):
         the workflow for batch mode and export all results.
         (This workflow's headless mode supports only batch mode for now.)
         """
+        if self.generate_random_labels or self.print_labels_by_slice:
+            # These need the labels, which a load profile (e.g. 'prediction') may have skipped.
+            projectManager.loadDeferredState()
+
         if self.generate_random_labels:
             self._generate_random_labels(self.random_label_count, self.random_label_value)
             logger.info("Saving project...")
@@ -322,23 +337,68 @@ class PixelClassificationWorkflow(Workflow):
             self.pcApplet.topLevelOperator.FreezePredictions.setValue(False)
         
             # Now run the batch export and report progress....
-            opBatchDataExport = self.batchResultsApplet.topLevelOperator
-            for i, opExportDataLaneView in enumerate(opBatchDataExport):
-                logger.info( "Exporting result {} to {}".format(i, opExportDataLaneView.ExportPath.value) )
-    
-                sys.stdout.write( "Result {}/{} Progress: ".format( i, len( opBatchDataExport ) ) )
-                sys.stdout.flush()
-                def print_progress( progress ):
-                    sys.stdout.write( "{} ".format( progress ) )
-                    sys.stdout.flush()
-    
-                # If the operator provides a progress signal, use it.
-                slotProgressSignal = opExportDataLaneView.progressSignal
-                slotProgressSignal.subscribe( print_progress )
-                opExportDataLaneView.run_export()
-                
-                # Finished.
-                sys.stdout.write("\n")
+            if not self.exportBatchResults( self.parallel_batch_files, self.batch_memory_limit_mb, self.batch_manifest ):
+                raise Exception("Batch export failed for some of the input files (see log).")
+
+    def exportBatchResults(self, maxParallelFiles=1, memoryLimitMb=None, manifestPath=None):
+        """
+        Export the results of all batch inputs, up to maxParallelFiles at a time.
+        All files share the classifier of the training workflow, but each has its own feature and prediction pipeline.
+        If a manifest path is given, results that were completed by a previous run (of the same
+        feature selection and classifier, see _batchChecksum) are skipped.
+        Returns True if all exports succeeded.
+        """
+        opBatchDataExport = self.batchResultsApplet.topLevelOperator
+        jobs = []
+        for i, opExportDataLaneView in enumerate(opBatchDataExport):
+            exportPath = opExportDataLaneView.ExportPath.value
+            inputPath = PathComponents( opExportDataLaneView.RawDatasetInfo.value.filePath ).externalPath
+            logger.info( "Result {}/{} will be exported to {}".format( i, len( opBatchDataExport ), exportPath ) )
+
+            def print_progress( progress, i=i ):
+                logger.info( "Result {}/{} Progress: {}".format( i, len( opBatchDataExport ), progress ) )
+            opExportDataLaneView.progressSignal.subscribe( print_progress )
+
+            jobs.append( BatchJob( "result {}/{}".format( i, len( opBatchDataExport ) ),
+                                   opExportDataLaneView.run_export,
+                                   inputPath,
+                                   PathComponents( exportPath ).externalPath,
+                                   self._estimateExportMemory( opExportDataLaneView ) ) )
+
+        memoryLimit = None
+        if memoryLimitMb is not None:
+            memoryLimit = memoryLimitMb * 2**20
+        manifest = None
+        if manifestPath is not None:
+            manifest = BatchManifest( manifestPath, self._batchChecksum() )
+        scheduler = BatchScheduler( maxParallelFiles, memoryLimit, manifest )
+        return scheduler.run( jobs )
+
+    def _batchChecksum(self):
+        """
+        Checksum of the feature selection and pixel classification state (labels and classifier)
+        in the project file, which determines the batch results.
+        (Headless batch runs use the project as it is saved.)
+        """
+        serializers = self.featureSelectionApplet.dataSerializers + self.pcApplet.dataSerializers
+        projectFile = self._shell.projectManager.currentProjectFile
+        checksum = hashlib.sha1()
+        for name in sorted( set( serializer.topGroupName for serializer in serializers ) ):
+            checksum.update( name )
+            if name in projectFile:
+                checksum.update( groupChecksum( projectFile[name] ) )
+        return checksum.hexdigest()
+
+    def _estimateExportMemory(self, opExportDataLaneView):
+        """
+        Rough estimate of the memory needed to export one batch result:
+        the raw image and its predictions, each held completely once.
+        """
+        nbytes = 0
+        for slot in (opExportDataLaneView.RawData, opExportDataLaneView.Input):
+            if slot.ready():
+                nbytes += numpy.prod( slot.meta.shape ) * numpy.dtype( slot.meta.dtype ).itemsize
+        return int(nbytes)
 
     def _print_labels_by_slice(self, search_value):
         """
@@ -41,7 +41,6 @@ import ilastik.utility.monkey_patches
 from ilastik.shell.headless.headlessShell import HeadlessShell
 from pixelClassificationWorkflow import PixelClassificationWorkflow
 from ilastik.applets.dataSelection.opDataSelection import DatasetInfo
-from ilastik.applets.batchIo.opBatchIo import ExportFormat
 from lazyflow.utility import PathComponents
 import ilastik.utility.globals
 
@@ -74,6 +73,9 @@ def getArgParser():
     parser.add_argument('--batch_export_dir', default='', help='A directory to save batch outputs. (Default saves with input files)')
     parser.add_argument('--batch_output_suffix', default='_prediction', help='Suffix for batch output filenames (before extension).')
     parser.add_argument('--batch_output_dataset_name', default='/volume/prediction', help='HDF5 internal dataset path')
+    parser.add_argument('--batch_parallel_files', default=1, type=int, help='Number of batch input files to process concurrently.')
+    parser.add_argument('--batch_memory_limit_mb', default=None, type=int, help="Don't start more concurrent batch files than fit into this much RAM (in MB).")
+    parser.add_argument('--batch_manifest', default=None, help='A json file recording finished batch outputs.  Re-running with the same manifest skips outputs whose input and project are unchanged.')
     parser.add_argument('--assume_old_ilp_axes', action='store_true', help='When importing 0.5 project files, assume axes are in the wrong order and need to be transposed.')
     parser.add_argument('--stack_volume_cache_dir', help='The preprocessing step converts image stacks to hdf5 volumes.  The volumes will be saved to this directory.', required=False)
     parser.add_argument('batch_inputs', nargs='*', help='List of input files to process. Supported filenames: .h5, .npy, or globstring for stacks (e.g. *.png)')
@@ -118,7 +120,9 @@ def runWorkflow(parsed_args):
 
     # Load project (auto-import it if necessary)
     logger.info("Opening project: '" + args.project + "'")
-    shell.openProjectFile(args.project)
+    # Batch prediction doesn't need the labels, so don't load them.
+    loadProfile = None if args.generate_project_predictions else 'prediction'
+    shell.openProjectFile(args.project, loadProfile)
 
     try:
         if not args.generate_project_predictions and len(args.batch_inputs) == 0:
@@ -136,8 +140,12 @@ def runWorkflow(parsed_args):
                                                   args.batch_export_dir,
                                                   args.batch_output_suffix,
                                                   args.batch_output_dataset_name,
-                                                  args.stack_volume_cache_dir)
-                assert result
+                                                  args.stack_volume_cache_dir,
+                                                  args.batch_parallel_files,
+                                                  args.batch_memory_limit_mb,
+                                                  args.batch_manifest)
+                if not result:
+                    raise Exception("Batch export failed for some of the input files (see log).")
     finally:
         logger.info("Closing project...")
         shell.closeCurrentProject()
@@ -165,16 +173,18 @@ def generateProjectPredictions(shell):
     
     shell.workflow.pcApplet.dataSerializers[0].predictionStorageEnabled = False
 
-def generateBatchPredictions(workflow, batchInputPaths, batchExportDir, batchOutputSuffix, exportedDatasetName, stackVolumeCacheDir):
+def generateBatchPredictions(workflow, batchInputPaths, batchExportDir, batchOutputSuffix, exportedDatasetName, stackVolumeCacheDir,
+                             maxParallelFiles=1, memoryLimitMb=None, manifestPath=None):
     """
     Compute the predictions for each of the specified batch input files,
     and export them to corresponding h5 files.
+    Up to maxParallelFiles files are processed at once (see PixelClassificationWorkflow.exportBatchResults).
     """
     originalBatchInputPaths = list(batchInputPaths)
     batchInputPaths = convertStacksToH5(batchInputPaths, stackVolumeCacheDir)
 
     batchInputInfos = []
-    for p in batchInputPaths:
+    for p, origPath in zip(batchInputPaths, originalBatchInputPaths):
         info = DatasetInfo()
         info.location = DatasetInfo.Location.FileSystem
 
@@ -184,6 +194,17 @@ def generateBatchPredictions(workflow, batchInputPaths, batchExportDir, batchOut
         comp.externalPath = os.path.abspath(comp.externalPath)
         
         info.filePath = comp.totalPath()        
+
+        # By default, the output files from the batch export operator
+        #  are named using the input file name.
+        # If we converted any stacks to hdf5, then the user won't recognize the input file name.
+        # Let's override the output file name using the *original* input file names.
+        origComp = PathComponents(origPath)
+        info.nickname = origComp.filenameBase.replace('*', 'STACKED')
+        if batchExportDir == '':
+            # Save the outputs with the *original* input files, too.
+            # ({dataset_dir} would be the stack volume cache dir for converted stacks.)
+            info.nickname = os.path.join( os.path.abspath( origComp.externalDirectory ), info.nickname )
         batchInputInfos.append(info)
 
     # Also convert the export dir to absolute (for the same reason)
@@ -200,35 +221,18 @@ def generateBatchPredictions(workflow, batchInputPaths, batchExportDir, batchOut
     # Configure batch export operator
     opBatchResults = workflow.batchResultsApplet.topLevelOperator
 
-    # By default, the output files from the batch export operator
-    #  are named using the input file name.
-    # If we converted any stacks to hdf5, then the user won't recognize the input file name.
-    # Let's override the output file name using the *original* input file names.
-    outputFileNameBases = []
-    for origPath in originalBatchInputPaths:
-        outputFileNameBases.append( origPath.replace('*', 'STACKED') )
-
-    opBatchResults.OutputFileNameBase.setValues( outputFileNameBases )    
-    opBatchResults.ExportDirectory.setValue(batchExportDir)
-    opBatchResults.Format.setValue(ExportFormat.H5)
-    opBatchResults.Suffix.setValue(batchOutputSuffix)
-    opBatchResults.InternalPath.setValue(exportedDatasetName)
-    
-    logger.info( "Exporting data to " + opBatchResults.OutputDataPath[0].value )
+    # Apply all export settings in one 'transaction'
+    opBatchResults.TransactionSlot.disconnect()
+    opBatchResults.OutputFilenameFormat.setValue( os.path.join( batchExportDir, '{nickname}' + batchOutputSuffix ) )
+    opBatchResults.OutputFormat.setValue( 'hdf5' )
+    opBatchResults.OutputInternalPath.setValue( exportedDatasetName )
+    opBatchResults.TransactionSlot.setValue( True )
 
-    # Set up progress display handling (just logging for now)        
-    currentProgress = [None]
-    def handleProgress(percentComplete):
-        if currentProgress[0] != percentComplete:
-            currentProgress[0] = percentComplete
-            logger.info("Batch job: {}% complete.".format(percentComplete))
-        
-    progressSignal = opBatchResults.ProgressSignal[0].value
-    progressSignal.subscribe( handleProgress )
+    # Make sure we're using the up-to-date classifier.
+    workflow.pcApplet.topLevelOperator.FreezePredictions.setValue(False)
 
     # Make it happen!
-    result = opBatchResults.ExportResult[0].value
-    return result
+    return workflow.exportBatchResults( maxParallelFiles, memoryLimitMb, manifestPath )
 
 def convertStacksToH5(filePaths, stackVolumeCacheDir):
     """
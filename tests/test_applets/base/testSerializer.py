@@ -25,7 +25,8 @@ from lazyflow.graph import Graph, Operator, InputSlot, Slot, OperatorWrapper
 from lazyflow.operators import OpTrainRandomForestBlocked, OpValueCache, OpCompressedUserLabelArray
 
 from ilastik.applets.base.appletSerializer import \
-    SerialSlot, SerialListSlot, AppletSerializer, SerialDictSlot, SerialBlockSlot
+    SerialSlot, SerialListSlot, AppletSerializer, SerialDictSlot, SerialBlockSlot, \
+    SerialClassifierSlot, groupChecksum
 
 class OpMock(Operator):
     """A simple operator for testing serializers."""
@@ -72,6 +73,25 @@ class TestSerializer(unittest.TestCase):
         self.projectFile.close()
         shutil.rmtree(self.tmpDir)
 
+    def testLoadProfile(self):
+        self.operator.TestSlot.setValue(5)
+        self.operator.TestListSlot.setValue([1,2,3])
+        self.serializer.serializeToHdf5(self.projectFile, self.projectFilePath)
+
+        # Only the slots of the profile are loaded...
+        operator = OpMock(graph=Graph())
+        serializer = OpMockSerializer(operator, "TestApplet")
+        serializer.loadProfiles = { 'test' : ['TestSlot'] }
+        serializer.loadProfile = 'test'
+        serializer.deserializeFromHdf5(self.projectFile, self.projectFilePath)
+        self.assertEqual(operator.TestSlot.value, 5)
+        self.assertFalse(operator.TestListSlot.ready())
+
+        # ...the others when they are needed.
+        serializer.loadDeferred()
+        self.assertEqual(list(operator.TestListSlot.value), [1,2,3])
+        self.assertFalse(serializer.isDirty())
+
     def _testSlot(self, slot, ss, value, rvalue):
         """test whether serialzing and then deserializing works for a
         level-0 slot
@@ -277,15 +297,17 @@ class TestSerialBlockSlot(unittest.TestCase):
         raw_data = vigra.taggedView(raw_data, 'zyxc')
     
         opLabelArrays = OperatorWrapper( OpCompressedUserLabelArray, graph=Graph() )
+
+        # This will serialize/deserialize data to the h5 file.
+        # (Created before the lanes are added, as in the workflows, so it sees their dirty regions.)
+        slotSerializer = SerialBlockSlot( opLabelArrays.Output, opLabelArrays.Input, opLabelArrays.nonzeroBlocks )
+
         opLabelArrays.Input.resize(1)
         opLabelArrays.Input[0].setValue( raw_data )
         opLabelArrays.shape.setValue( raw_data.shape )
         opLabelArrays.eraser.setValue( 255 )
         opLabelArrays.deleteLabel.setValue( -1 )
         opLabelArrays.blockShape.setValue( (10,10,10,1) )
-        
-        # This will serialize/deserialize data to the h5 file.
-        slotSerializer = SerialBlockSlot( opLabelArrays.Output, opLabelArrays.Input, opLabelArrays.nonzeroBlocks )
         return opLabelArrays, slotSerializer
 
     def testBasic(self):
@@ -314,5 +336,198 @@ class TestSerialBlockSlot(unittest.TestCase):
         assert ( opLabelArrays.Output[0][10:11, 10:20, 10:20, 0:1].wait() == 1 ).all()
         assert ( opLabelArrays.Output[0][11:12, 10:20, 10:20, 0:1].wait() == 2 ).all()
 
+    def testChunkedLayout(self):
+        h5_filepath = os.path.join( tempfile.mkdtemp(), 'serial_blockslot_test.h5' )
+        opLabelArrays, slotSerializer = self._init_objects()
+        slotSerializer.BatchSize = 2 # Several batches
+        opLabelArrays.Input[0][5:25, 10:20, 10:20, 0:1] = 3*numpy.ones((20,10,10,1), dtype=numpy.uint8)
+
+        with h5py.File(h5_filepath, 'w') as f:
+            slotSerializer.serialize( f.create_group('label_data') )
+
+        with h5py.File(h5_filepath, 'r') as f:
+            lane_group = f['label_data'].values()[0].values()[0]
+            assert sorted( lane_group.keys() ) == ['blockIndex', 'data']
+            blockIndex = lane_group['blockIndex'][:]
+            assert blockIndex.shape == (3, 9)
+            assert lane_group['data'].shape == (3*1000,)
+            assert lane_group['data'].compression is not None
+
+            opLabelArrays, slotSerializer = self._init_objects()
+            slotSerializer.deserialize( f['label_data'] )
+
+        assert ( opLabelArrays.Output[0][5:25, 10:20, 10:20, 0:1].wait() == 3 ).all()
+        assert opLabelArrays.Output[0][:].wait().sum() == 3*20*10*10
+
+    def testIncrementalSave(self):
+        h5_filepath = os.path.join( tempfile.mkdtemp(), 'serial_blockslot_test.h5' )
+        opLabelArrays, slotSerializer = self._init_objects()
+        ones = numpy.ones((1,10,10,1), dtype=numpy.uint8)
+        opLabelArrays.Input[0][10:11, 10:20, 10:20, 0:1] = 1*ones
+        opLabelArrays.Input[0][50:51, 50:60, 50:60, 0:1] = 2*ones
+
+        with h5py.File(h5_filepath, 'w') as f:
+            label_group = f.create_group('label_data')
+            slotSerializer.serialize( label_group )
+            assert label_group['Output/0/data'].shape == (2000,)
+
+            # Only the changed block is written (appended), the other one is kept.
+            opLabelArrays.Input[0][12:13, 10:20, 10:20, 0:1] = 3*ones
+            slotSerializer.serialize( label_group )
+            assert label_group['Output/0/data'].shape == (3000,)
+            assert len( label_group['Output/0/blockIndex'] ) == 2
+            assert 'blockIndex.new' not in label_group['Output/0']
+
+            # Erased blocks are dropped, and the lane is compacted once most of the data is unused.
+            opLabelArrays.Input[0][50:51, 50:60, 50:60, 0:1] = 255*ones
+            slotSerializer.serialize( label_group )
+            assert len( label_group['Output/0/blockIndex'] ) == 1
+            assert label_group['Output/0/data'].shape == (1000,)
+
+        opLabelArrays, slotSerializer = self._init_objects()
+        with h5py.File(h5_filepath, 'r') as f:
+            slotSerializer.deserialize( f['label_data'] )
+
+        assert ( opLabelArrays.Output[0][10:11, 10:20, 10:20, 0:1].wait() == 1 ).all()
+        assert ( opLabelArrays.Output[0][12:13, 10:20, 10:20, 0:1].wait() == 3 ).all()
+        assert ( opLabelArrays.Output[0][50:51, 50:60, 50:60, 0:1].wait() == 0 ).all()
+
+    def testInterruptedSave(self):
+        h5_filepath = os.path.join( tempfile.mkdtemp(), 'serial_blockslot_test.h5' )
+        opLabelArrays, slotSerializer = self._init_objects()
+        opLabelArrays.Input[0][10:11, 10:20, 10:20, 0:1] = numpy.ones((1,10,10,1), dtype=numpy.uint8)
+
+        with h5py.File(h5_filepath, 'w') as f:
+            slotSerializer.serialize( f.create_group('label_data') )
+            # A new index that was not completely written is ignored
+            f['label_data/Output/0'].create_dataset('blockIndex.new', data=numpy.zeros((0,9), dtype=numpy.int64))
+
+        opLabelArrays, slotSerializer = self._init_objects()
+        with h5py.File(h5_filepath, 'r') as f:
+            slotSerializer.deserialize( f['label_data'] )
+        assert ( opLabelArrays.Output[0][10:11, 10:20, 10:20, 0:1].wait() == 1 ).all()
+
+    def testInterruptedLaneRewrite(self):
+        h5_filepath = os.path.join( tempfile.mkdtemp(), 'serial_blockslot_test.h5' )
+        opLabelArrays, slotSerializer = self._init_objects()
+        ones = numpy.ones((1,10,10,1), dtype=numpy.uint8)
+        opLabelArrays.Input[0][10:11, 10:20, 10:20, 0:1] = ones
+        opLabelArrays.Input[0][50:51, 50:60, 50:60, 0:1] = 2*ones
+        opLabelArrays.Input[0][70:71, 70:80, 70:80, 0:1] = 2*ones
+
+        with h5py.File(h5_filepath, 'w') as f:
+            label_group = f.create_group('label_data')
+            slotSerializer.serialize( label_group )
+
+            # A failing compaction leaves the old lane untouched
+            def fail(*args):
+                raise Exception("Failed on purpose")
+            slotSerializer._serializeLane = fail
+            opLabelArrays.Input[0][50:51, 50:60, 50:60, 0:1] = 255*ones
+            opLabelArrays.Input[0][70:71, 70:80, 70:80, 0:1] = 255*ones
+            self.assertRaises( Exception, slotSerializer.serialize, label_group )
+            assert len( label_group['Output/0/blockIndex'] ) == 3
+            del slotSerializer._serializeLane
+
+            # An incomplete rewrite is discarded...
+            assert '0.new' in label_group['Output']
+            slotSerializer.serialize( label_group )
+            assert sorted( label_group['Output'].keys() ) == ['0']
+            assert len( label_group['Output/0/blockIndex'] ) == 1
+            assert label_group['Output/0/data'].shape == (1000,)
+
+            # ...but a complete one replaces the old lane.
+            f.copy( label_group['Output/0'], 'label_data/Output/0.new' )
+            label_group['Output/0.new'].attrs['complete'] = True
+            del label_group['Output/0/blockIndex']
+            label_group['Output/0'].create_dataset('blockIndex', data=numpy.zeros((0,9), dtype=numpy.int64))
+
+        opLabelArrays, slotSerializer = self._init_objects()
+        with h5py.File(h5_filepath, 'r') as f:
+            slotSerializer.deserialize( f['label_data'] )
+        assert ( opLabelArrays.Output[0][10:11, 10:20, 10:20, 0:1].wait() == 1 ).all()
+        assert opLabelArrays.Output[0][:].wait().sum() == 100
+
+        with h5py.File(h5_filepath, 'r+') as f:
+            opLabelArrays, slotSerializer = self._init_objects()
+            slotSerializer.deserialize( f['label_data'] )
+            assert sorted( f['label_data/Output'].keys() ) == ['0']
+            assert len( f['label_data/Output/0/blockIndex'] ) == 1
+        assert ( opLabelArrays.Output[0][10:11, 10:20, 10:20, 0:1].wait() == 1 ).all()
+
+    def testOldLayout(self):
+        h5_filepath = os.path.join( tempfile.mkdtemp(), 'serial_blockslot_test.h5' )
+
+        # One dataset per block, as written by older versions
+        with h5py.File(h5_filepath, 'w') as f:
+            lane_group = f.create_group('label_data').create_group('Output').create_group('0')
+            lane_group.create_dataset('block0000', data=numpy.ones((1,10,10,1), dtype=numpy.uint8))
+            lane_group['block0000'].attrs['blockSlice'] = '[10:11,10:20,10:20,0:1]'
+            lane_group.create_dataset('block0001', data=2*numpy.ones((1,10,10,1), dtype=numpy.uint8))
+            lane_group['block0001'].attrs['blockSlice'] = '[11:12,10:20,10:20,0:1]'
+
+        opLabelArrays, slotSerializer = self._init_objects()
+        with h5py.File(h5_filepath, 'r') as f:
+            slotSerializer.deserialize( f['label_data'] )
+
+        assert ( opLabelArrays.Output[0][10:11, 10:20, 10:20, 0:1].wait() == 1 ).all()
+        assert ( opLabelArrays.Output[0][11:12, 10:20, 10:20, 0:1].wait() == 2 ).all()
+
+class TestSerialClassifierSlot(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        features = numpy.random.random((100, 3)).astype(numpy.float32)
+        labels = (features[:, 0:1] > 0.5).astype(numpy.uint32)
+        self.forest = vigra.learning.RandomForest(5)
+        self.forest.learnRF(features, labels)
+        self.features = features
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+        SerialClassifierSlot._forestCache.clear()
+
+    def _init_objects(self):
+        opCache = OpValueCache( graph=Graph() )
+        slotSerializer = SerialClassifierSlot( opCache.Output, opCache, name="ClassifierForests" )
+        return opCache, slotSerializer
+
+    def testRoundTrip(self):
+        h5_filepath = os.path.join( self.tmpDir, 'serial_classifier_test.h5' )
+        opCache, slotSerializer = self._init_objects()
+        opCache.Input.setValue( numpy.array([self.forest]) )
+        opCache.Output.value
+
+        with h5py.File(h5_filepath, 'w') as f:
+            slotSerializer.serialize( f )
+            assert len( f['ClassifierForests'] ) == 1
+
+            # Saved forests are cached, so loading them again doesn't parse them.
+            opCache, slotSerializer = self._init_objects()
+            slotSerializer.deserialize( f )
+            assert opCache.Output.value[0] is self.forest
+
+            # Without the cache, they are read from the file.
+            SerialClassifierSlot._forestCache.clear()
+            opCache, slotSerializer = self._init_objects()
+            slotSerializer.deserialize( f )
+            forest = opCache.Output.value[0]
+            assert forest is not self.forest
+            assert ( forest.predictLabels(self.features) == self.forest.predictLabels(self.features) ).all()
+
+    def testGroupChecksum(self):
+        with h5py.File(os.path.join( self.tmpDir, 'checksum_test.h5' ), 'w') as f:
+            for name in ['a', 'b']:
+                f.create_group(name).create_dataset('data', data=numpy.arange(10))
+                f[name]['data'].attrs['x'] = 1
+            assert groupChecksum(f['a']) == groupChecksum(f['b'])
+
+            f['b']['data'].attrs['x'] = 2
+            assert groupChecksum(f['a']) != groupChecksum(f['b'])
+            f['b']['data'].attrs['x'] = 1
+
+            f['b']['data'][0] = 1
+            assert groupChecksum(f['a']) != groupChecksum(f['b'])
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
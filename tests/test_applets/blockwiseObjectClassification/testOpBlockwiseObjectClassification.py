@@ -89,6 +89,42 @@ class TestOpBlockwiseObjectClassification(object):
                 "Blockwise prediction operator did not produce the same prediction image" \
                 "as the non-blockwise prediction operator!"
 
+    def testOneBlockInFlight(self):
+        # With a tiny memory budget, the blocks are computed one at a time.
+        self.op.BlockShape3dDict.setValue( {'x' : 40, 'y' : 40, 'z' : 40} )
+        self.op.HaloPadding3dDict.setValue( {'x' : 10, 'y' : 10, 'z' : 10} )
+        self.op.InflightMemoryMb.setValue( 1 )
+        assert self.op._getMaxInflightBlocks() == 1
+
+        pred = self.op.PredictionImage[:].wait()
+        if not (pred == self.prediction_volume).all():
+            self.logImage(pred, "one_block_in_flight_failed_prediction_")
+            assert False, \
+                "Blockwise prediction operator did not produce the same prediction image" \
+                "as the non-blockwise prediction operator!"
+
+    def testPipelineEviction(self):
+        # With a tiny memory budget, only one block pipeline is kept alive.
+        self.op.BlockShape3dDict.setValue( {'x' : 40, 'y' : 40, 'z' : 40} )
+        self.op.HaloPadding3dDict.setValue( {'x' : 10, 'y' : 10, 'z' : 10} )
+        self.op.PipelineMemoryMb.setValue( 1 )
+
+        pred = self.op.PredictionImage[:].wait()
+        if not (pred == self.prediction_volume).all():
+            self.logImage(pred, "pipeline_eviction_failed_prediction_")
+            assert False, \
+                "Blockwise prediction operator did not produce the same prediction image" \
+                "as the non-blockwise prediction operator!"
+
+        assert len(self.op._blockPipelines) == 1
+        assert self.op.pipelineStats['created'] == 27
+        assert self.op.pipelineStats['evicted'] == 26
+
+        # Features of evicted blocks are recomputed on demand
+        features = self.op.BlockwiseRegionFeatures[0:1,0:1,0:1,0:1,0:1].wait()
+        assert features.shape == (1,1,1,1,1)
+        assert self.op.pipelineStats['created'] == 28
+
     def testZeroHalo(self):
         # If we shrink the halo down to zero, then we get different predictions...
         # This block shape/halo combination will slice through some of the big blocks, causing mis-classification.
@@ -101,6 +137,25 @@ class TestOpBlockwiseObjectClassification(object):
             "Blockwise prediction operator produced the same prediction image" \
             "as the non-blockwise prediction operator, despite having a pathological block/halo combination!"
             
+
+    def testStitchedObjects(self):
+        # With stitching, the same pathological block shape gives the same predictions
+        # as the non-blockwise operator, because every object is classified as a whole.
+        self.op.BlockShape3dDict.setValue( {'x' : 42, 'y' : 42, 'z' : 42} )
+        self.op.HaloPadding3dDict.setValue( {'x' : 0, 'y' : 0, 'z' : 0} )
+        self.op.StitchObjects.setValue( True )
+
+        blockwise_prediction_volume = self.op.PredictionImage[:].wait()
+        if not (blockwise_prediction_volume == self.prediction_volume).all():
+            assert False, \
+                "Stitched blockwise prediction operator did not produce the same prediction image" \
+                "as the non-blockwise prediction operator!"
+        assert self.op.pipelineStats['created'] == 0
+
+        # Each object is reported by exactly one block
+        features = self.op.BlockwiseRegionFeatures[:].wait()
+        num_objects = sum( len( f['Standard Object Features']['Count'] ) - 1 for f in features.flat )
+        assert num_objects == self.op._opGlobalLabels.getLabelCount(0)
                 
     def setUpSources(self):
         """
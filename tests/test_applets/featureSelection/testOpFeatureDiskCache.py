@@ -0,0 +1,115 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+import os
+import time
+import shutil
+import tempfile
+import numpy
+import vigra
+from lazyflow.graph import Graph
+from lazyflow.operators import OpArrayPiper
+from ilastik.applets.featureSelection.opFeatureDiskCache import OpFeatureDiskCache, FeatureBlockStore
+
+class TestFeatureBlockStore(object):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testPutGet(self):
+        store = FeatureBlockStore(self.directory, 10*1000*1000)
+        data = numpy.random.random((10,20,3)).astype(numpy.float32)
+        assert store.get('ab1234') is None
+        store.put('ab1234', data)
+        assert (store.get('ab1234') == data).all()
+
+        # A second store on the same directory (e.g. another process) sees the block, too.
+        other = FeatureBlockStore(self.directory, 10*1000*1000)
+        assert (other.get('ab1234') == data).all()
+
+    def testLeastRecentlyUsedBlocksAreEvicted(self):
+        data = numpy.zeros((1000,), dtype=numpy.float64) # 8000 bytes
+        store = FeatureBlockStore(self.directory, 25000)
+        for key in ['aa', 'bb', 'cc']:
+            store.put(key, data)
+            # Make sure the mtimes differ
+            path = store._path(key)
+            t = time.time() - 100 + len(os.listdir(self.directory))
+            os.utime(path, (t, t))
+
+        # Use 'aa' again, so 'bb' is now the least recently used block.
+        assert store.get('aa') is not None
+        store.put('dd', data)
+
+        assert store.get('bb') is None
+        assert store.get('aa') is not None
+        assert store.get('dd') is not None
+
+class TestOpFeatureDiskCache(object):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.raw = vigra.taggedView( numpy.random.randint(0, 255, (50,40,1)).astype(numpy.uint8), 'xyc' )
+        self.features = vigra.taggedView( numpy.random.random((50,40,4)).astype(numpy.float32), 'xyc' )
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _makeOperator(self, graph, store, features):
+        opRaw = OpArrayPiper(graph=graph)
+        opRaw.Input.setValue( self.raw )
+        opFeatures = OpArrayPiper(graph=graph)
+        opFeatures.Input.setValue( features )
+
+        op = OpFeatureDiskCache( store, graph=graph )
+        op.RawImage.connect( opRaw.Output )
+        op.Input.connect( opFeatures.Output )
+        op.LayerKeys.setValue( [ ("Gaussian Smoothing (s=1.0)", 1.0, 1), ("Hessian Eigenvalues (s=1.0)", 1.0, 2), ("Gaussian Smoothing (s=3.0)", 3.0, 1) ] )
+        op.BlockShape.setValue( (16, 16, 1) )
+        return op
+
+    def testReadsBlocksFromStore(self):
+        graph = Graph()
+        store = FeatureBlockStore(self.directory, 100*1000*1000)
+        op = self._makeOperator( graph, store, self.features )
+        assert (op.Output[:].wait() == self.features).all()
+        assert (op.Output[5:30, 7:39, 1:3].wait() == self.features[5:30, 7:39, 1:3]).all()
+
+        # Same raw data, but the features would now be computed differently.
+        # The stored blocks are used instead.
+        op2 = self._makeOperator( graph, FeatureBlockStore(self.directory, 100*1000*1000), numpy.zeros_like(self.features) )
+        assert (op2.Output[3:45, 2:20, 1:4].wait() == self.features[3:45, 2:20, 1:4]).all()
+
+    def testRawChangeInvalidatesBlocks(self):
+        graph = Graph()
+        store = FeatureBlockStore(self.directory, 100*1000*1000)
+        op = self._makeOperator( graph, store, self.features )
+        op.Output[:].wait()
+
+        # Change the raw data at the corner.  Blocks within the halo are recomputed, blocks far away are not.
+        self.raw[0,0,0] += 1
+        op2 = self._makeOperator( graph, store, numpy.zeros_like(self.features) )
+        result = op2.Output[:].wait()
+        assert (result[:16,:16] == 0).all()
+        assert (result[32:,32:,:3] == self.features[32:,32:,:3]).all()
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -24,7 +24,8 @@ ilastik.ilastik_logging.default_config.init()
 import unittest
 import numpy as np
 import vigra
-from lazyflow.graph import Graph
+from lazyflow.graph import Graph, Operator, InputSlot, OutputSlot
+from lazyflow.roi import roiToSlice
 from ilastik.applets.objectClassification.opObjectClassification import \
     OpRelabelSegmentation, OpObjectTrain, OpObjectPredict, OpObjectClassification, \
     OpBadObjectsToWarningMessage, OpMaxLabel
@@ -85,6 +86,80 @@ class TestOpMean(object):
         #FIXME: why is it this the region ?
         np.testing.assert_allclose(np.mean(rimg.view(np.ndarray),axis=2),mean.view(np.ndarray)[...,0:1,0])
 
+
+class OpRecordingArray(Operator):
+    """
+    Provides self.data (which the test modifies in place) and records the requested rois.
+    """
+    Input = InputSlot()
+    Output = OutputSlot()
+
+    def __init__(self, data, *args, **kwargs):
+        super(OpRecordingArray, self).__init__(*args, **kwargs)
+        self.data = data
+        self.requests = []
+        self.Input.setValue(True)
+
+    def setupOutputs(self):
+        self.Output.meta.shape = self.data.shape
+        self.Output.meta.dtype = self.data.dtype
+
+    def execute(self, slot, subindex, roi, result):
+        self.requests.append( (tuple(roi.start), tuple(roi.stop)) )
+        result[:] = self.data[roiToSlice(roi.start, roi.stop)]
+        return result
+
+    def propagateDirty(self, slot, subindex, roi):
+        pass
+
+class TestOpVolumeOperator(object):
+    def setUp(self):
+        g = Graph()
+        self.opData = OpRecordingArray(np.random.rand(100, 70), graph=g)
+        self.op = OpVolumeOperator(graph=g)
+        self.op.blockShape.setValue(32)
+        self.op.Function.setValue(np.sum)
+        self.op.Input.connect(self.opData.Output)
+
+    def test(self):
+        total = self.op.Output[:].wait()[0]
+        np.testing.assert_almost_equal(total, self.opData.data.sum())
+        assert len(self.opData.requests) == 4*3
+
+        # Cached
+        self.op.Output[:].wait()
+        assert len(self.opData.requests) == 4*3
+
+        # Only the block of the dirty region is recomputed
+        del self.opData.requests[:]
+        self.opData.data[40:42, 40:42] += 1
+        self.opData.Output.setDirty(np.s_[40:42, 40:42])
+        total = self.op.Output[:].wait()[0]
+        np.testing.assert_almost_equal(total, self.opData.data.sum())
+        assert self.opData.requests == [((32, 32), (64, 64))]
+
+        # A new function recomputes everything
+        del self.opData.requests[:]
+        self.op.Function.setValue(np.max)
+        assert self.op.Output[:].wait()[0] == self.opData.data.max()
+        assert len(self.opData.requests) == 4*3
+
+    def testDirtyWhileComputing(self):
+        # The input changes while the blocks are being computed
+        changed = []
+        def sumAndChange(data):
+            # (Skip the test call of setupOutputs)
+            if not changed and data.shape != (3, 3):
+                changed.append(True)
+                self.opData.data[80:82, 50:52] += 1
+                self.opData.Output.setDirty(np.s_[80:82, 50:52])
+            return np.sum(data)
+        self.op.Function.setValue(sumAndChange)
+        self.op.Output[:].wait()
+
+        # The outdated result must not be cached
+        total = self.op.Output[:].wait()[0]
+        np.testing.assert_almost_equal(total, self.opData.data.sum())
         
 # class TestOpObjectTrain(unittest.TestCase):
 #     
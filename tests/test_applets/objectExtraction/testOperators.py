@@ -15,12 +15,15 @@
 # Copyright 2011-2014, the ilastik developers
 
 import unittest
+import collections
 import numpy as np
 import vigra
 from lazyflow.graph import Graph
-from lazyflow.operators import OpLabelImage
-from ilastik.applets.objectExtraction.opObjectExtraction import OpAdaptTimeListRoi, OpRegionFeatures
+from lazyflow.operators import OpLabelImage, OpArrayPiper
+from ilastik.applets.objectExtraction.opObjectExtraction import OpAdaptTimeListRoi, OpRegionFeatures, OpRegionFeatures3d, margin_pitch
 from ilastik.plugins import pluginManager
+from ilastik.applets.objectExtraction import config
+from ilastik.applets.objectExtraction.regionFeatureAccumulator import RegionFeatureAccumulator
 
 NAME = "Standard Object Features"
 
@@ -188,6 +191,297 @@ class testOpRegionFeaturesAgainstNumpy(object):
                     assert abs(coord-center_good)<0.01
 
 
+class TestOpRegionFeaturesChunked(object):
+    def setUp(self):
+        self.features = {
+            NAME : {
+                "Count" : {},
+                "Coord<Minimum>" : {},
+                "Coord<Maximum>" : {},
+                "Mean in neighborhood" : {"margin" : (30, 30, 1)},
+                "Sum in neighborhood" : {"margin" : (30, 30, 1)}
+            }
+        }
+        self._saved_config = (config.local_features_chunk_size, config.local_features_max_workers)
+
+    def tearDown(self):
+        config.local_features_chunk_size, config.local_features_max_workers = self._saved_config
+
+    def _compute(self, chunk_size, max_workers):
+        config.local_features_chunk_size = chunk_size
+        config.local_features_max_workers = max_workers
+
+        g = Graph()
+        labelop = OpLabelImage(graph=g)
+        op = OpRegionFeatures(graph=g)
+        op.LabelImage.connect(labelop.Output)
+        op.RawImage.setValue(rawImage())
+        op.Features.setValue(self.features)
+        labelop.Input.setValue(binaryImage())
+
+        opAdapt = OpAdaptTimeListRoi(graph=g)
+        opAdapt.Input.connect(op.Output)
+        return opAdapt.Output([0, 1]).wait()
+
+    def test_chunking_does_not_change_results(self):
+        serial = self._compute(1000, 1)
+        for chunk_size, max_workers in [(1, 0), (2, 1), (1, 2)]:
+            chunked = self._compute(chunk_size, max_workers)
+            for t in serial:
+                for key in ("Mean in neighborhood", "Sum in neighborhood"):
+                    assert np.all(serial[t][NAME][key] == chunked[t][NAME][key]), \
+                        "chunk_size={}, max_workers={}".format(chunk_size, max_workers)
+
+    def test_make_object_chunks(self):
+        assert OpRegionFeatures3d._make_object_chunks(0, 3) == []
+        assert OpRegionFeatures3d._make_object_chunks(6, 3) == [(0, 3), (3, 6)]
+        assert OpRegionFeatures3d._make_object_chunks(7, 3) == [(0, 3), (3, 6), (6, 7)]
+
+
+class TestOpRegionFeaturesTiled(object):
+    def setUp(self):
+        self.features = {
+            NAME : {
+                "Count" : {},
+                "RegionCenter" : {},
+                "Mean" : {},
+                "Variance" : {},
+                "Sum" : {},
+                "Minimum" : {},
+                "Maximum" : {},
+                "Coord<Minimum>" : {},
+                "Coord<Maximum>" : {},
+                "Sum in neighborhood" : {"margin" : (30, 30, 1)}
+            }
+        }
+        self._saved_tile_shape = config.region_features_tile_shape
+        self._saved_max_tiles = config.region_features_max_tiles
+
+    def tearDown(self):
+        config.region_features_tile_shape = self._saved_tile_shape
+        config.region_features_max_tiles = self._saved_max_tiles
+
+    def _compute(self, tile_shape):
+        config.region_features_tile_shape = tile_shape
+
+        g = Graph()
+        labelop = OpLabelImage(graph=g)
+        op = OpRegionFeatures(graph=g)
+        op.LabelImage.connect(labelop.Output)
+        op.RawImage.setValue(rawImage())
+        op.Features.setValue(self.features)
+        labelop.Input.setValue(binaryImage())
+
+        opAdapt = OpAdaptTimeListRoi(graph=g)
+        opAdapt.Input.connect(op.Output)
+        return opAdapt.Output([0, 1]).wait()
+
+    def test_tiled_matches_whole_volume(self):
+        whole = self._compute(None)
+        # tiles that cut through all objects
+        tiled = self._compute((7, 11, 13))
+        for t in whole:
+            for key in self.features[NAME]:
+                assert key in tiled[t][NAME], key
+                assert np.allclose(whole[t][NAME][key], tiled[t][NAME][key], rtol=1e-4), key
+            for key, value in whole[t]['Default features'].items():
+                assert np.allclose(value, tiled[t]['Default features'][key]), key
+
+    def test_tiles_in_waves(self):
+        whole = self._compute(None)
+        for max_tiles in (1, 3):
+            config.region_features_max_tiles = max_tiles
+            tiled = self._compute((7, 11, 13))
+            for t in whole:
+                for key in self.features[NAME]:
+                    assert np.allclose(whole[t][NAME][key], tiled[t][NAME][key], rtol=1e-4), key
+
+    def test_cropped_features_per_tile(self):
+        # These can't be merged across tiles, but computed on a crop around the objects
+        self.features = {NAME : {"Count" : {}, "Coord<Principal<Kurtosis>>" : {},
+                                 "Kurtosis" : {}, "Coord<ArgMaxWeight>" : {}}}
+        assert OpRegionFeatures3d._canComputeTiled(self.features)
+        whole = self._compute(None)
+        tiled = self._compute((7, 11, 13))
+        for t in whole:
+            for key in self.features[NAME]:
+                assert np.allclose(whole[t][NAME][key], tiled[t][NAME][key], rtol=1e-4), key
+
+    def test_unsupported_features_fall_back(self):
+        self.features = {NAME : {"Count" : {}, "Histogram" : {}}}
+        assert not OpRegionFeatures3d._canComputeTiled(self.features)
+        feats = self._compute((7, 11, 13))
+        assert "Histogram" in feats[0][NAME]
+
+
+class TestRegionFeatureAccumulator(object):
+    def test_merge(self):
+        data = np.array([1., 2., 3., 4., 10.])
+        labels = np.array([1, 1, 2, 1, 2])
+        acc = RegionFeatureAccumulator()
+        # feed one pixel at a time, as if every pixel was its own tile
+        for value, label, coord in zip(data, labels, range(len(data))):
+            count = np.zeros(label+1)
+            count[label] = 1
+            values = np.zeros((label+1, 1))
+            values[label] = value
+            coords = np.zeros((label+1, 1))
+            coords[label] = coord
+            acc.merge(count, values, np.zeros((label+1, 1)), values, values, coords, coords, coords)
+
+        feats = acc.features(['Count', 'Mean', 'Variance', 'Sum', 'Minimum', 'Maximum',
+                              'RegionCenter', 'Coord<Minimum>', 'Coord<Maximum>'])
+        for i, label in enumerate([1, 2]):
+            mask = labels == label
+            assert feats['Count'][i, 0] == mask.sum()
+            assert np.allclose(feats['Mean'][i, 0], data[mask].mean())
+            assert np.allclose(feats['Variance'][i, 0], data[mask].var())
+            assert np.allclose(feats['Sum'][i, 0], data[mask].sum())
+            assert feats['Minimum'][i, 0] == data[mask].min()
+            assert feats['Maximum'][i, 0] == data[mask].max()
+            assert np.allclose(feats['RegionCenter'][i, 0], np.arange(len(data))[mask].mean())
+            assert feats['Coord<Minimum>'][i, 0] == np.arange(len(data))[mask].min()
+            assert feats['Coord<Maximum>'][i, 0] == np.arange(len(data))[mask].max()
+
+
+class TestOpRegionFeaturesIncremental(object):
+    def setUp(self):
+        self.features = {
+            NAME : {
+                "Count" : {},
+                "Mean" : {},
+                "Coord<Minimum>" : {},
+                "Coord<Maximum>" : {},
+                "Sum in neighborhood" : {"margin" : (3, 3, 1)}
+            }
+        }
+        self._saved_incremental = config.incremental_region_features
+        config.incremental_region_features = True
+
+    def tearDown(self):
+        config.incremental_region_features = self._saved_incremental
+
+    def _makeOperators(self, raw):
+        g = Graph()
+        labelop = OpLabelImage(graph=g)
+        rawop = OpArrayPiper(graph=g)
+        rawop.Input.setValue(raw)
+        op = OpRegionFeatures(graph=g)
+        op.LabelImage.connect(labelop.Output)
+        op.RawImage.connect(rawop.Output)
+        op.Features.setValue(self.features)
+        labelop.Input.setValue(binaryImage())
+        opAdapt = OpAdaptTimeListRoi(graph=g)
+        opAdapt.Input.connect(op.Output)
+        return rawop, op, opAdapt
+
+    def test_dirty_region_matches_full_recomputation(self):
+        raw = rawImage()
+        rawop, op, opAdapt = self._makeOperators(raw)
+        before = opAdapt.Output([0]).wait()
+
+        # change the raw data near the object at (20:30, 20:30, 20:30) only
+        raw[0, 25:28, 25:28, 25:28, 0] = 7
+        rawop.Input.setDirty((slice(0, 1), slice(25, 28), slice(25, 28), slice(25, 28), slice(None)))
+        incremental = opAdapt.Output([0]).wait()
+
+        _, _, opFresh = self._makeOperators(raw.copy())
+        fresh = opFresh.Output([0]).wait()
+
+        for key in ("Sum in neighborhood", "Sum in object and neighborhood",
+                    "Mean", "Count", "Coord<Minimum>", "Coord<Maximum>"):
+            assert np.allclose(incremental[0][NAME][key], fresh[0][NAME][key]), key
+        assert np.any(before[0][NAME]["Sum in object and neighborhood"] !=
+                      incremental[0][NAME]["Sum in object and neighborhood"])
+        assert np.any(before[0][NAME]["Mean"] != incremental[0][NAME]["Mean"])
+
+    def test_unchanged_objects_are_reused(self):
+        computed = {'local' : [], 'global' : []}
+        compute_local = OpRegionFeatures3d._compute_local_features
+        compute_global = OpRegionFeatures3d._computeGlobalOnCrop
+        def record_local(op, get_bboxes, objects, *args):
+            computed['local'].append(list(objects))
+            return compute_local(op, get_bboxes, objects, *args)
+        def record_global(op, image, labels, axes, feature_names, extrafeats, objects):
+            computed['global'].append(list(objects))
+            return compute_global(op, image, labels, axes, feature_names, extrafeats, objects)
+
+        OpRegionFeatures3d._compute_local_features = record_local
+        OpRegionFeatures3d._computeGlobalOnCrop = record_global
+        try:
+            raw = rawImage()
+            rawop, op, opAdapt = self._makeOperators(raw)
+            opAdapt.Output([0]).wait()
+            assert computed['local'] == [[0, 1, 2]]
+            assert computed['global'] == []
+
+            # only the object at (20:30, 20:30, 20:30) is recomputed
+            raw[0, 25:28, 25:28, 25:28, 0] = 7
+            rawop.Input.setDirty((slice(0, 1), slice(25, 28), slice(25, 28), slice(25, 28), slice(None)))
+            opAdapt.Output([0]).wait()
+            assert computed['local'][1:] == [[1]]
+            assert computed['global'] == [[1]]
+        finally:
+            OpRegionFeatures3d._compute_local_features = compute_local
+            OpRegionFeatures3d._computeGlobalOnCrop = compute_global
+
+    def test_failure_keeps_dirty_rois(self):
+        raw = rawImage()[0]
+        op = OpRegionFeatures3d(graph=Graph())
+        op.RawVolume.setValue(raw)
+        op.LabelVolume.setValue(binaryImage()[0])
+        op.Features.setValue(self.features)
+
+        dirty = [([25, 25, 25], [28, 28, 28])]
+        op._dirtyRois = list(dirty)
+        def fail(*args):
+            raise RuntimeError("cancelled")
+        op._execute = fail
+
+        roi = collections.namedtuple('Roi', 'start stop')((), ())
+        try:
+            op.execute(op.Output, (), roi, None)
+        except RuntimeError:
+            pass
+        else:
+            assert False, "the error must be raised"
+        assert op._dirtyRois == dirty
+
+    def test_global_feature_shift(self):
+        assert OpRegionFeatures3d._globalFeatureShift("Mean") == 'none'
+        assert OpRegionFeatures3d._globalFeatureShift("Coord<Minimum>") == 'offset'
+        assert OpRegionFeatures3d._globalFeatureShift("Coord<Principal<Kurtosis>>") == 'none'
+        assert OpRegionFeatures3d._globalFeatureShift("Coord<PowerSum<1>>") is None
+        assert OpRegionFeatures3d._globalFeatureShift("Histogram") is None
+        assert not OpRegionFeatures3d._canPatchGlobal({NAME : {"Global<Maximum>" : {}}})
+        assert OpRegionFeatures3d._canPatchGlobal(self.features)
+
+    def test_reusable_objects(self):
+        extrafeats = {"Count" : np.array([[8], [8]]),
+                      "Coord<Minimum>" : np.array([[0, 0, 0], [20, 20, 20]]),
+                      "Coord<Maximum>" : np.array([[1, 1, 1], [21, 21, 21]]),
+                      "RegionCenter" : np.array([[0.5, 0.5, 0.5], [20.5, 20.5, 20.5]])}
+        keys = OpRegionFeatures3d._objectKeys(extrafeats)
+        # the objects swapped their label ids since the last computation
+        previous = {'keys' : [keys[1], keys[0]]}
+        margin = [2, 2, 2]
+
+        reused = OpRegionFeatures3d._reusableObjects(previous, keys, extrafeats, margin, [])
+        assert reused == {0: 1, 1: 0}
+
+        dirty = [([22, 22, 22], [30, 30, 30])]
+        reused = OpRegionFeatures3d._reusableObjects(previous, keys, extrafeats, margin, dirty)
+        assert reused == {0: 1}
+
+    def test_zero_margin_pitch(self):
+        # a zero margin entry must not produce an infinite pitch
+        pitch = margin_pitch((10, 10, 0))
+        assert np.all(np.isfinite(pitch))
+        assert pitch == margin_pitch((10, 10, 1))
+        assert margin_pitch((0, 0, 0)) == (1.0, 1.0, 1.0)
+        self.assertRaises(ValueError, margin_pitch, (10, -1, 1))
+
+
 if __name__ == '__main__':
     import sys
     import nose
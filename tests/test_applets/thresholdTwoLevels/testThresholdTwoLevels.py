@@ -14,6 +14,8 @@
 #
 # Copyright 2011-2014, the ilastik developers
 
+import threading
+
 import numpy
 import vigra
 np = numpy
@@ -21,7 +23,7 @@ np = numpy
 from lazyflow.graph import Graph
 from lazyflow.operators import Op5ifyer
 from ilastik.applets.thresholdTwoLevels.opThresholdTwoLevels \
-    import OpThresholdTwoLevels, OpSelectLabels
+    import OpThresholdTwoLevels, OpSelectLabels, OpAnisotropicGaussianSmoothing
 
 from ilastik.applets.thresholdTwoLevels.opThresholdTwoLevels\
     import _OpThresholdOneLevel as OpThresholdOneLevel
@@ -207,6 +209,28 @@ class TestThresholdOneLevel(Generator1):
         out5d = oper5d.Output[:].wait()
         numpy.testing.assert_array_equal(out5d.shape, self.data5d.shape)
 
+    def testBlockwise(self):
+        # blockwise labeling must select the same objects as whole-volume labeling
+        results = []
+        for blockShape in (None, {'x': 16, 'y': 16, 'z': 16}):
+            oper5d = OpThresholdTwoLevels(graph=Graph())
+            oper5d.InputImage.setValue(self.data5d)
+            oper5d.MinSize.setValue(5)
+            oper5d.MaxSize.setValue(self.maxSize)
+            oper5d.SingleThreshold.setValue(0.5)
+            oper5d.SmootherSigma.setValue(self.sigma)
+            oper5d.Channel.setValue(0)
+            oper5d.CurOperator.setValue(0)
+            if blockShape is not None:
+                oper5d.BlockShape.setValue(blockShape)
+            results.append(oper5d.Output[:].wait() > 0)
+        numpy.testing.assert_array_equal(results[0], results[1])
+
+        # size filtering doesn't need a new labeling pass
+        oper5d.MinSize.setValue(1)
+        out5d = oper5d.Output[:].wait()
+        assert (out5d > 0).sum() > results[1].sum()
+
     def testWrongChannel(self):
         oper5d = OpThresholdTwoLevels(graph=Graph())
         oper5d.InputImage.setValue(self.data5d)
@@ -270,6 +294,40 @@ class TestThresholdOneLevel(Generator1):
             numpy.testing.assert_array_equal(out5d.squeeze(), desiredResult[..., i, :])
 
 
+class TestAnisotropicGaussianSmoothing(unittest.TestCase):
+    def setUp(self):
+        numpy.random.seed(0)
+        data = numpy.random.random((40, 30, 20, 1)).astype(numpy.float32)
+        self.data = vigra.taggedView(data, axistags='xyzc')
+        self.sigmas = {'x': 1.5, 'y': 1.0, 'z': 2.0}
+
+    def smooth(self, tileSlices, intermediateDtype=numpy.float32, roi=numpy.s_[:]):
+        op = OpAnisotropicGaussianSmoothing(graph=Graph())
+        op.Input.setValue(self.data)
+        op.Input.meta.drange = (0, 1)
+        op.Sigmas.setValue(self.sigmas)
+        op.TileSlices.setValue(tileSlices)
+        op.IntermediateDtype.setValue(intermediateDtype)
+        return op.Output[roi].wait()
+
+    def testTiled(self):
+        expected = self.smooth(0)
+        tiled = self.smooth(7)
+        numpy.testing.assert_allclose(tiled, expected, rtol=1e-4, atol=1e-5)
+
+        # A subregion (the halo comes from the image, not from the mirrored roi)
+        roi = numpy.s_[5:35, 3:20, 2:19, :]
+        tiled = self.smooth(4, roi=roi)
+        numpy.testing.assert_allclose(tiled, expected[roi], rtol=1e-4, atol=1e-5)
+
+    def testIntermediateDtype(self):
+        expected = self.smooth(0)
+        for dtype, tolerance in ((numpy.float16, 2e-3), (numpy.uint8, 1e-2)):
+            tiled = self.smooth(7, dtype)
+            assert numpy.abs(tiled - expected).max() < tolerance, \
+                "{} intermediate is too inaccurate".format(numpy.dtype(dtype).name)
+
+
 class Generator2(Generator1):
     def setUp(self):
 
@@ -351,6 +409,74 @@ class TestThresholdTwoLevels(Generator2):
         out = op.Output[...].wait()
         numpy.testing.assert_array_equal(out, big*0)
 
+    def testOpSelectLabelsBlockwise(self):
+        # Big labels that span several blocks, selected by small labels in a single block
+        big = numpy.zeros((1, 20, 20, 1, 1), dtype=numpy.uint32)
+        big[0, 2:18, 2:4, 0, 0] = 7
+        big[0, 2:4, 6:18, 0, 0] = 3
+        big[0, 10:18, 10:18, 0, 0] = 5
+        small = numpy.zeros_like(big)
+        small[0, 15, 3, 0, 0] = 1
+        small[0, 12, 12, 0, 0] = 2
+
+        op = OpSelectLabels(graph=Graph())
+        op.BigLabels.setValue(vigra.taggedView(big, axistags='txyzc'))
+        op.SmallLabels.setValue(vigra.taggedView(small, axistags='txyzc'))
+        expected = op.Output[:].wait()
+
+        op.BlockShape.setValue({'x': 4, 'y': 4, 'z': 1})
+        out = op.Output[:].wait()
+        numpy.testing.assert_array_equal(out, expected)
+        assert set(numpy.unique(out)) == set([0, 1, 2])
+
+        # A subregion that doesn't contain any small labels
+        out = op.Output[:, 0:8, 0:8, :, :].wait()
+        numpy.testing.assert_array_equal(out, expected[:, 0:8, 0:8, :, :])
+
+    def testOpSelectLabelsBlockwiseDirtyWhileComputing(self):
+        big = numpy.zeros((2, 8, 8, 1, 1), dtype=numpy.uint32)
+        big[:, 2:6, 2:6, 0, 0] = 1
+        small = numpy.zeros_like(big)
+        small[:, 3, 3, 0, 0] = 1
+
+        op = OpSelectLabels(graph=Graph())
+        op.BigLabels.setValue(vigra.taggedView(big, axistags='txyzc'))
+        op.SmallLabels.setValue(vigra.taggedView(small, axistags='txyzc'))
+        op.BlockShape.setValue({'x': 4, 'y': 4, 'z': 1})
+
+        # The first pass of slice t=0 blocks until we release it
+        started = threading.Event()
+        release = threading.Event()
+        collect = op._collectPassedLabels
+        def blockingCollect(slice_key):
+            if slice_key == (0, 0):
+                started.set()
+                release.wait()
+            return collect(slice_key)
+        op._collectPassedLabels = blockingCollect
+
+        results = []
+        thread = threading.Thread(target=lambda: results.append(op.Output[0:1].wait()))
+        thread.start()
+        assert started.wait(10)
+
+        # Other slices are not held up by it
+        out = op.Output[1:2].wait()
+        numpy.testing.assert_array_equal(out, big[1:2] != 0)
+
+        # Neither is propagateDirty
+        dirtyThread = threading.Thread(target=op.SmallLabels.setDirty, args=(slice(None),))
+        dirtyThread.start()
+        dirtyThread.join(10)
+        assert not dirtyThread.is_alive()
+
+        release.set()
+        thread.join(10)
+        numpy.testing.assert_array_equal(results[0], big[0:1] != 0)
+        # The selection became dirty while it was computed, so it is not kept
+        assert (0, 0) not in op._passedLabels
+        assert (1, 0) not in op._passedLabels
+
     def testSimpleUsage(self):
         oper5d = OpThresholdTwoLevels(graph=Graph())
         oper5d.InputImage.setValue(self.data5d)
@@ -365,6 +491,25 @@ class TestThresholdTwoLevels(Generator2):
         out5d = oper5d.Output[:].wait()
         numpy.testing.assert_array_equal(out5d.shape, self.data5d.shape)
 
+    def testBlockwise(self):
+        # blockwise labeling must select the same objects as whole-volume labeling
+        results = []
+        for blockShape in (None, {'x': 16, 'y': 16, 'z': 16}):
+            oper5d = OpThresholdTwoLevels(graph=Graph())
+            oper5d.InputImage.setValue(self.data5d)
+            oper5d.MinSize.setValue(self.minSize)
+            oper5d.MaxSize.setValue(self.maxSize)
+            oper5d.HighThreshold.setValue(self.highThreshold)
+            oper5d.LowThreshold.setValue(self.lowThreshold)
+            oper5d.SmootherSigma.setValue(self.sigma)
+            oper5d.Channel.setValue(0)
+            oper5d.CurOperator.setValue(1)
+            if blockShape is not None:
+                oper5d.BlockShape.setValue(blockShape)
+            results.append(oper5d.Output[:].wait() > 0)
+        numpy.testing.assert_array_equal(results[0], results[1])
+        assert results[1].any()
+
     def testNoOp(self):
         oper5d = OpThresholdTwoLevels(graph=Graph())
         oper5d.InputImage.setValue(self.data5d)
@@ -0,0 +1,124 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+import os
+import shutil
+import tempfile
+import numpy
+
+from ilastik.applets.tracking.base.lineageStore import LineageStoreWriter, LineageStore, exportLineage
+
+class TestLineageStore(object):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "lineage.h5")
+
+        # Object 1 moves, then divides into objects 1 and 2 at t=2
+        self.labels = numpy.zeros( (3, 20, 30), dtype=numpy.uint32 )
+        self.labels[0, 2:5, 2:5] = 1
+        self.labels[1, 3:6, 3:6] = 1
+        self.labels[2, 3:6, 3:6] = 1
+        self.labels[2, 10:12, 10:12] = 2
+        self.events = { 1 : { "mov" : numpy.array( [[1, 1, 0.5]] ) },
+                        2 : { "div" : numpy.array( [[1, 1, 2, 0.25]] ),
+                              "app" : numpy.array( [[3, 1.0]] ) } }
+        self.trackIds = { 0 : {1 : 7}, 1 : {1 : 7}, 2 : {1 : 7, 2 : 7} }
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _write(self):
+        with LineageStoreWriter( self.path, self.labels.shape[1:], self.labels.shape[0], maxQueued=1 ) as writer:
+            for t in range(3):
+                writer.write( t, self.events.get(t, {}), self.labels[t], self.trackIds[t] )
+
+    def testRoundTrip(self):
+        self._write()
+        with LineageStore( self.path ) as store:
+            assert list( store.writtenTimesteps() ) == [0, 1, 2]
+            for t in range(3):
+                assert ( store.labels(t) == self.labels[t] ).all()
+            assert store.events(0) == {}
+
+            events = store.events(2)
+            assert sorted( events.keys() ) == ["app", "div"]
+            numpy.testing.assert_array_equal( events["div"], self.events[2]["div"] )
+            numpy.testing.assert_array_equal( events["app"], self.events[2]["app"] )
+            numpy.testing.assert_array_equal( store.events(1)["mov"], self.events[1]["mov"] )
+
+    def testTrack(self):
+        self._write()
+        with LineageStore( self.path ) as store:
+            numpy.testing.assert_array_equal( store.track(7), [[0, 1], [1, 1], [2, 1], [2, 2]] )
+            assert sorted( store.trackAt(7, 2) ) == [1, 2]
+            assert len( store.track(8) ) == 0
+
+    def testExistingFile(self):
+        self._write()
+        try:
+            LineageStoreWriter( self.path, self.labels.shape[1:], self.labels.shape[0] )
+        except IOError:
+            pass
+        else:
+            assert False, "Overwriting an existing file should fail"
+
+    def testWriterError(self):
+        writer = LineageStoreWriter( self.path, self.labels.shape[1:], self.labels.shape[0] )
+        # Wrong label image shape: fails in the writer thread, raised on close()
+        writer.write( 0, {}, numpy.zeros( (3,3), dtype=numpy.uint32 ) )
+        try:
+            writer.close()
+        except Exception:
+            pass
+        else:
+            assert False, "The error of the writer thread should be raised"
+
+    def testExportPairsEventsWithFrames(self):
+        # The tracking covers timesteps 2..4 of a movie with 5 timesteps.
+        # events["k"] leads into timestep 2+k.
+        events = { "2" : { "div" : numpy.array( [[1, 1, 2, 0.25]] ) },
+                   "1" : { "mov" : numpy.array( [[1, 1, 0.5]] ) } }
+        labels = numpy.zeros( (5, 20, 30), dtype=numpy.uint32 )
+        labels[2:] = self.labels
+        trackIds = [ {}, {} ] + [ self.trackIds[t] for t in range(3) ]
+
+        requested = []
+        def getLabelImage(t):
+            requested.append(t)
+            return labels[t]
+        progress = []
+        exportLineage( self.path, events, [2, 4], getLabelImage, 5, trackIds, progress.append )
+        assert requested == [2, 3, 4]
+        assert progress[-1] == 100
+
+        with LineageStore( self.path ) as store:
+            assert list( store.writtenTimesteps() ) == [2, 3, 4]
+            for t in range(5):
+                assert ( store.labels(t) == labels[t] ).all()
+            assert store.events(2) == {}
+            numpy.testing.assert_array_equal( store.events(3)["mov"], events["1"]["mov"] )
+            numpy.testing.assert_array_equal( store.events(4)["div"], events["2"]["div"] )
+            # The objects of each event are in the label image of its timestep
+            assert ( store.labels(4) == 2 ).any()
+            numpy.testing.assert_array_equal( store.track(7), [[2, 1], [3, 1], [4, 1], [4, 2]] )
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,129 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+import numpy
+
+from lazyflow.graph import Graph
+
+from ilastik.applets.tracking.base.trackingUtilities import relabel, relabel_lut, relabelMergers, get_track_ids
+from ilastik.applets.tracking.base.opTrackingBase import OpTrackingBase
+
+# The implementations before the lookup tables were vectorized
+def loopRelabel(volume, replace):
+    mp = numpy.arange(0, numpy.amax(volume) + 1, dtype=volume.dtype)
+    mp[1:] = 1
+    for label in numpy.unique(volume):
+        if label > 0:
+            try:
+                mp[label] = replace[label]
+            except:
+                pass
+    return mp[volume]
+
+def loopRelabelMergers(volume, merger):
+    mp = numpy.zeros( (numpy.amax(volume) + 1,), dtype=volume.dtype )
+    for label in numpy.unique(volume):
+        if label > 0:
+            if label in merger:
+                mp[label] = merger[label]
+            else:
+                mp[label] = 1
+    return mp[volume]
+
+class TestRelabel(object):
+
+    def setUp(self):
+        numpy.random.seed(0)
+        self.volume = numpy.random.randint( 0, 20, (10, 12, 3) ).astype( numpy.uint32 )
+        self.volume[0, 0, 0] = 0 # make sure the background occurs
+        # Some labels are missing from the dict, some entries are not in the volume
+        self.replace = dict( (l, 100 + l) for l in range(0, 30, 2) )
+
+    def testSameAsLoop(self):
+        numpy.testing.assert_array_equal( relabel( self.volume, self.replace ),
+                                          loopRelabel( self.volume, self.replace ) )
+        mergers = { 3 : 2, 5 : 4, 25 : 3 }
+        numpy.testing.assert_array_equal( relabelMergers( self.volume, mergers ),
+                                          loopRelabelMergers( self.volume, mergers ) )
+
+    def testBackgroundStaysZero(self):
+        # Even if the dict has an entry for the background
+        result = relabel( self.volume, { 0 : 5, 1 : 7 } )
+        assert ( result[self.volume == 0] == 0 ).all()
+        assert ( result[self.volume == 1] == 7 ).all()
+        assert ( relabelMergers( self.volume, { 0 : 5 } )[self.volume == 0] == 0 ).all()
+
+    def testEmptyDict(self):
+        numpy.testing.assert_array_equal( relabel( self.volume, {} ), loopRelabel( self.volume, {} ) )
+        numpy.testing.assert_array_equal( relabelMergers( self.volume, {} ), loopRelabelMergers( self.volume, {} ) )
+
+    def testLookupTable(self):
+        # A table for fewer labels than the volume has
+        lut = relabel_lut( self.replace, 10 )
+        assert len( lut ) == 11
+        assert lut[0] == 0 and lut[2] == 102 and lut[3] == 1
+        numpy.testing.assert_array_equal( relabel( self.volume, lut ),
+                                          loopRelabel( self.volume, dict( (l, v) for l, v in self.replace.items() if l <= 10 ) ) )
+
+        # Labels above max_label are ignored
+        assert relabel_lut( { 5 : 3, 50 : 4 }, 10 )[5] == 3
+
+        # Extending the table uses the default for the new labels, and keeps the old entries
+        extended = relabel_lut( lut, 15, default=9 )
+        numpy.testing.assert_array_equal( extended[:11], lut )
+        assert ( extended[11:] == 9 ).all()
+
+        # A table that is long enough is used as it is
+        assert relabel_lut( extended, 12 ) is extended
+
+class TestTrackIds(object):
+
+    def testTrackIds(self):
+        # Timesteps 1..4: object 1 moves and divides, object 5 appears at t=3 and moves
+        events = { "1" : { "mov" : numpy.array( [[1, 2, 0.1]] ) },
+                   "2" : { "div" : numpy.array( [[2, 3, 4, 0.2]] ),
+                           "app" : numpy.array( [[5, 0.3]] ) },
+                   "3" : { "mov" : numpy.array( [[3, 1, 0.1], [5, 2, 0.1]] ),
+                           "dis" : numpy.array( [[4, 0.4]] ) } }
+        track_ids = get_track_ids( events, [1, 4] )
+        assert track_ids == [ {}, { 1 : 1 }, { 2 : 1 }, { 3 : 1, 4 : 1, 5 : 2 }, { 1 : 1, 2 : 2 } ]
+
+class TestLabel2ColorLut(object):
+
+    def setUp(self):
+        self.op = OpTrackingBase( graph=Graph() )
+        self.volume = numpy.array( [[0, 1, 2], [3, 4, 5]], dtype=numpy.uint32 )
+
+    def testSameAsDict(self):
+        self.op.label2color = [ { 1 : 10, 2 : 0, 3 : 30 }, {} ]
+        for t in range(2):
+            numpy.testing.assert_array_equal( relabel( self.volume, self.op._getLabel2ColorLut(t) ),
+                                              loopRelabel( self.volume, self.op.label2color[t] ) )
+
+    def testRecomputingDropsCachedLuts(self):
+        self.op.label2color = [ { 1 : 10 } ]
+        lut = self.op._getLabel2ColorLut(0)
+        assert self.op._getLabel2ColorLut(0) is lut
+
+        self.op.label2color = [ { 1 : 20 } ]
+        assert relabel( self.volume, self.op._getLabel2ColorLut(0) )[0, 1] == 20
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
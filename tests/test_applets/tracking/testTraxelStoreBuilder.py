@@ -0,0 +1,72 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+import numpy
+
+from ilastik.applets.objectExtraction.opObjectExtraction import default_features_key
+from ilastik.applets.tracking.base.traxelStoreBuilder import build_traxelstore, filter_objects
+
+class MockTraxelBackend(object):
+    """
+    Records the traxels instead of creating pgmlink objects.
+    """
+    def createStore(self):
+        return []
+
+    def addTraxels(self, store, traxels, scales):
+        for i, traxel_id in enumerate(traxels.ids):
+            store.append( (traxels.t, int(traxel_id), tuple(traxels.coms[i]), traxels.sizes[i]) )
+
+class TestTraxelStoreBuilder(object):
+
+    def setUp(self):
+        # Row 0 is the background
+        self.feats = {}
+        for t in range(3):
+            centers = numpy.array( [[0,0], [5,5], [50,5], [5,50], [20,20]], dtype=numpy.float32 ) + t
+            counts = numpy.array( [[1000], [10], [10], [10], [500]], dtype=numpy.float32 )
+            self.feats[t] = { default_features_key : { 'RegionCenter' : centers, 'Count' : counts } }
+
+    def testFilterObjects(self):
+        rc = numpy.array( [[1,2,3], [10,2,3], [1,2,30]] )
+        ct = numpy.array( [[5], [5], [50]] )
+        passed, coms, sizes = filter_objects( rc, ct, (0,10), (0,10), (0,10), (0,100) )
+        assert list(passed) == [True, False, False]
+        assert coms.shape == (3,3)
+
+        # 2d centers get z=0
+        passed, coms, sizes = filter_objects( rc[:,:2], ct, (0,100), (0,100), (0,1), (0,10) )
+        assert list(passed) == [True, True, False]
+        assert (coms[:,2] == 0).all()
+
+    def testBuild(self):
+        store, traxels = build_traxelstore( self.feats, (0,40), (0,40), (0,1), (0,100), (1.0,1.0,1.0), MockTraxelBackend() )
+
+        assert [ traxels_at.t for traxels_at in traxels ] == [0,1,2]
+        for traxels_at in traxels:
+            assert list(traxels_at.ids) == [1]
+            assert traxels_at.filteredIds == [2,3,4]
+
+        # Added in time order
+        assert [ entry[0] for entry in store ] == [0,1,2]
+        assert store[1] == (1, 1, (6.0, 6.0, 0.0), 10.0)
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,166 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+from ilastik.clusterWorkQueue import BlockWorkQueue, WorkerHeartbeat
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class TestBlockWorkQueue(object):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.queuePath = os.path.join( self.tmpDir, "queue.sqlite" )
+        self.blockRois = [ ((0,0), (10,10)), ((0,10), (10,20)), ((10,0), (20,10)), ((10,10), (20,20)) ]
+
+    def tearDown(self):
+        shutil.rmtree( self.tmpDir )
+
+    def testAllBlocksAreClaimedOnce(self):
+        queue = BlockWorkQueue( self.queuePath )
+        queue.initialize( self.blockRois )
+
+        claimed = []
+        lock = threading.Lock()
+        def worker( name ):
+            workerQueue = BlockWorkQueue( self.queuePath )
+            while True:
+                blockRoi = workerQueue.claim( name )
+                if blockRoi is None:
+                    break
+                with lock:
+                    claimed.append( blockRoi )
+                assert workerQueue.markDone( blockRoi[0], name )
+            workerQueue.close()
+
+        threads = [ threading.Thread( target=worker, args=("W{}".format(i),) ) for i in range(3) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert sorted( claimed ) == sorted( self.blockRois )
+        assert queue.counts()[BlockWorkQueue.DONE] == len( self.blockRois )
+        assert queue.isWorkerFinished( "W0" )
+        queue.close()
+
+    def testStaleClaimsAreReclaimed(self):
+        clock = FakeClock()
+        queue = BlockWorkQueue( self.queuePath, staleClaimSecs=100, maxAttempts=2, clock=clock )
+        queue.initialize( self.blockRois[:1] )
+
+        assert queue.claim( "W0" ) == self.blockRois[0]
+        assert not queue.isWorkerFinished( "W0" )
+
+        # Not stale yet
+        clock.now = 50
+        assert queue.claim( "W1" ) is None
+
+        # W0 has died.
+        clock.now = 200
+        assert queue.claim( "W1" ) == self.blockRois[0]
+        assert queue.isWorkerFinished( "W0" )
+
+        # W1 has died, too.  The block has been attempted too often.
+        clock.now = 400
+        assert queue.claim( "W2" ) is None
+        assert queue.counts()[BlockWorkQueue.FAILED] == 1
+        queue.close()
+
+    def testRelaunchedWorkerResumesItsBlock(self):
+        queue = BlockWorkQueue( self.queuePath )
+        queue.initialize( self.blockRois )
+        first = queue.claim( "W0" )
+        assert queue.claim( "W0" ) == first
+        queue.close()
+
+    def testFailedBlocksAreRetried(self):
+        queue = BlockWorkQueue( self.queuePath, maxAttempts=3 )
+        queue.initialize( self.blockRois[:1] )
+        start = self.blockRois[0][0]
+        for attempt in range(2):
+            assert queue.claim( "W{}".format(attempt) ) == self.blockRois[0]
+            assert queue.release( start, "W{}".format(attempt) )
+            assert queue.counts()[BlockWorkQueue.PENDING] == 1
+
+        # The last attempt fails, too
+        assert queue.claim( "W2" ) == self.blockRois[0]
+        assert not queue.release( start, "W2" )
+        assert queue.counts()[BlockWorkQueue.FAILED] == 1
+        assert queue.claim( "W3" ) is None
+        queue.close()
+
+    def testHeartbeatRenewsClaims(self):
+        clock = FakeClock()
+        queue = BlockWorkQueue( self.queuePath, staleClaimSecs=100, clock=clock )
+        queue.initialize( self.blockRois[:1] )
+        assert not queue.isWorkerStarted( "W0" )
+        queue.heartbeat( "W0" )
+        assert queue.isWorkerStarted( "W0" )
+        start = queue.claim( "W0" )[0]
+
+        # W0 is slow, but alive
+        for now in (80, 160, 240):
+            clock.now = now
+            queue.heartbeat( "W0" )
+            assert queue.claim( "W1" ) is None
+        assert queue.isWorkerAlive( "W0" )
+
+        # W0 hangs: its block is handed to W1, and W0 can't mark it done anymore
+        clock.now = 400
+        assert not queue.isWorkerAlive( "W0" )
+        assert queue.claim( "W1" ) == self.blockRois[0]
+        assert not queue.markDone( start, "W0" )
+        assert queue.release( start, "W0" )
+        assert queue.counts()[BlockWorkQueue.RUNNING] == 1
+        assert queue.markDone( start, "W1" )
+        assert queue.counts()[BlockWorkQueue.DONE] == 1
+        queue.close()
+
+    def testWorkerHeartbeat(self):
+        queue = BlockWorkQueue( self.queuePath, staleClaimSecs=0.4 )
+        queue.initialize( self.blockRois[:1] )
+        heartbeat = WorkerHeartbeat( self.queuePath, "W0", staleClaimSecs=0.4 )
+        heartbeat.start()
+        try:
+            # Registered before anything is claimed
+            assert queue.isWorkerStarted( "W0" )
+            queue.claim( "W0" )
+            time.sleep( 1.0 )
+            assert queue.isWorkerAlive( "W0" )
+            assert queue.claim( "W1" ) is None
+        finally:
+            heartbeat.stop()
+        time.sleep( 0.5 )
+        assert not queue.isWorkerAlive( "W0" )
+        assert queue.claim( "W1" ) == self.blockRois[0]
+        queue.close()
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,123 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+import threading
+import numpy
+from lazyflow.request import Request
+from ilastik.clusterOps import BlockWriterQueue
+
+class TestBlockWriterQueue(object):
+
+    def testWritesEverything(self):
+        written = []
+        writer = BlockWriterQueue( lambda fileset, roi, data: written.append( (fileset, roi, data) ), 2 )
+        for i in range(10):
+            writer.put( 'primary', i, numpy.array([i]) )
+            writer.putRequest( 'secondary', i, Request( lambda i=i: numpy.array([2*i]) ) )
+        writer.close()
+
+        # The primaries are written in order, the secondaries as soon as they are computed.
+        assert [ r for f, r, d in written if f == 'primary' ] == range(10)
+        assert sorted( r for f, r, d in written if f == 'secondary' ) == range(10)
+        for fileset, roi, data in written:
+            expected = roi if fileset == 'primary' else 2*roi
+            assert data[0] == expected
+
+    def testSingleWorkerThread(self):
+        """
+        Producing results in the only worker thread must not deadlock,
+        even if the writer is behind secondary results that need the worker thread, too.
+        """
+        numWorkers = Request.global_thread_pool.num_workers
+        Request.reset_thread_pool( num_workers=1 )
+        deadlocked = False
+        try:
+            written = []
+            writer = BlockWriterQueue( lambda fileset, roi, data: written.append( (fileset, roi) ), 1 )
+            def producePrimaries():
+                # Like the streamer's result callback: runs in the worker thread
+                for i in range(5):
+                    writer.putRequest( 'secondary', i, Request( lambda i=i: numpy.array([i]) ) )
+                    writer.put( 'primary', i, numpy.array([i]) )
+
+            def run():
+                Request( producePrimaries ).wait()
+                writer.close()
+            t = threading.Thread( target=run )
+            t.daemon = True
+            t.start()
+            t.join( 10.0 )
+            deadlocked = t.is_alive()
+            assert not deadlocked, "The writer queue deadlocked"
+            assert sorted( written ) == sorted( (f, i) for i in range(5) for f in ('primary', 'secondary') )
+        finally:
+            # (Stopping a deadlocked pool would hang.)
+            if not deadlocked:
+                Request.reset_thread_pool( num_workers=numWorkers )
+
+    def testBackPressure(self):
+        release = threading.Event()
+        def slowWrite( fileset, roi, data ):
+            release.wait()
+        writer = BlockWriterQueue( slowWrite, 2 )
+        # One item is taken by the writer thread, two more fit in the queue.
+        for i in range(3):
+            writer.put( None, i, None )
+
+        blocked = threading.Event()
+        done = threading.Event()
+        def producer():
+            blocked.set()
+            writer.put( None, 3, None )
+            done.set()
+        t = threading.Thread( target=producer )
+        t.start()
+        blocked.wait()
+        assert not done.wait( 0.2 ), "put() should block while the queue is full"
+        release.set()
+        t.join()
+        writer.close()
+
+    def testErrorIsReraised(self):
+        def failingWrite( fileset, roi, data ):
+            raise IOError("disk full")
+        writer = BlockWriterQueue( failingWrite, 2 )
+        writer.put( None, 0, None )
+        try:
+            writer.close()
+        except IOError:
+            pass
+        else:
+            assert False, "Expected the write error to be raised by close()"
+
+    def testRequestErrorIsReraised(self):
+        def failingRequest():
+            raise ValueError("computation failed")
+        writer = BlockWriterQueue( lambda fileset, roi, data: None, 2 )
+        writer.putRequest( None, 0, Request( failingRequest ) )
+        try:
+            writer.close()
+        except ValueError:
+            pass
+        else:
+            assert False, "Expected the request error to be raised by close()"
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,186 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+from ilastik.clusterScheduler import ClusterTaskScheduler
+
+class FakeTask(object):
+    def __init__(self, taskName, duration, failures=0):
+        self.taskName = taskName
+        self.numBytes = 1000*1000
+        self.duration = duration
+        self.failures = failures
+
+class FakeProcess(object):
+    def __init__(self, task, clock, fails):
+        self.task = task
+        self.startTime = clock.now
+        self.clock = clock
+        self.fails = fails
+        self.killed = False
+
+    def poll(self):
+        if self.killed or self.clock.now - self.startTime >= self.task.duration:
+            return 1 if (self.fails or self.killed) else 0
+        return None
+
+    def kill(self):
+        self.killed = True
+
+class FakeSubmission(object):
+    """
+    A job in a batch queue: no poll() or kill(), it waits queueSecs before it starts.
+    """
+    def __init__(self, task, clock, queueSecs):
+        self.task = task
+        self.submitTime = clock.now
+        self.clock = clock
+        self.queueSecs = queueSecs
+
+    def started(self):
+        return self.clock.now - self.submitTime >= self.queueSecs
+
+    def finished(self):
+        return self.clock.now - self.submitTime >= self.queueSecs + self.task.duration
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+    def __call__(self):
+        return self.now
+    def sleep(self, secs):
+        self.now += secs
+
+class TestClusterTaskScheduler(object):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.finishedTasks = set()
+        self.processes = []
+        self.maxRunning = 0
+
+    def _launch(self, task):
+        fails = task.failures > 0
+        task.failures -= 1
+        process = FakeProcess( task, self.clock, fails )
+        self.processes.append( process )
+        running = len( [p for p in self.processes if p.poll() is None] )
+        self.maxRunning = max( self.maxRunning, running )
+        return process
+
+    def _isFinished(self, task):
+        for p in self.processes:
+            if p.task is task and p.poll() == 0:
+                return True
+        return False
+
+    def _scheduler(self, **kwargs):
+        return ClusterTaskScheduler( self._launch, self._isFinished,
+                                     pollIntervalSecs=1, clock=self.clock, sleep=self.clock.sleep,
+                                     **kwargs )
+
+    def testConcurrencyLimit(self):
+        tasks = [FakeTask( "J{:02}".format(i), 3 ) for i in range(10)]
+        finished, failed = self._scheduler( maxConcurrent=3 ).run( tasks )
+        assert len(finished) == 10
+        assert len(failed) == 0
+        assert self.maxRunning <= 3
+
+    def testRetry(self):
+        tasks = [FakeTask( "J00", 2, failures=1 ), FakeTask( "J01", 2, failures=5 )]
+        finished, failed = self._scheduler( maxRetries=2 ).run( tasks )
+        assert [t.taskName for t in finished] == ["J00"]
+        assert [t.taskName for t in failed] == ["J01"]
+        assert len( [p for p in self.processes if p.task.taskName == "J01"] ) == 3
+
+    def testFailedResultCheck(self):
+        # Checking the result (e.g. importing the block) fails once: the task is retried
+        checks = []
+        def isFinished(task):
+            if self._isFinished(task) and not checks:
+                checks.append( task )
+                raise IOError("Failed on purpose")
+            return self._isFinished(task)
+        scheduler = ClusterTaskScheduler( self._launch, isFinished, maxRetries=1,
+                                          pollIntervalSecs=1, clock=self.clock, sleep=self.clock.sleep )
+        finished, failed = scheduler.run( [FakeTask( "J00", 2 )] )
+        assert [t.taskName for t in finished] == ["J00"]
+        assert len(self.processes) == 2
+
+    def testTimeout(self):
+        tasks = [FakeTask( "J00", 100 )]
+        finished, failed = self._scheduler( timeoutSecs=10 ).run( tasks )
+        assert len(failed) == 1
+        assert self.processes[0].killed
+
+    def _runSubmitted(self, tasks, queueSecs, **kwargs):
+        submissions = []
+        def submit(task):
+            submissions.append( FakeSubmission( task, self.clock, queueSecs ) )
+            return submissions[-1]
+        def isStarted(task):
+            # Like a block lock: held while the job works on the block
+            return any( s.task is task and s.started() and not s.finished() for s in submissions )
+        def isFinished(task):
+            return any( s.task is task and s.finished() for s in submissions )
+        scheduler = ClusterTaskScheduler( submit, isFinished, isTaskStarted=isStarted,
+                                          pollIntervalSecs=1, clock=self.clock, sleep=self.clock.sleep,
+                                          **kwargs )
+        finished, failed = scheduler.run( tasks )
+        return finished, failed, submissions
+
+    def testTimeoutStartsWhenLocked(self):
+        # 30 seconds in the queue and 15 seconds of work: within a 20 second timeout
+        finished, failed, submissions = self._runSubmitted( [FakeTask( "J00", 15 )], queueSecs=30,
+                                                            timeoutSecs=20, maxQueueWaitSecs=60, maxRetries=1 )
+        assert len(finished) == 1
+        assert len(submissions) == 1
+
+    def testDeadTaskTimesOut(self):
+        # The task started, but stopped sending heartbeats long before the (compute) timeout
+        finished, failed, submissions = self._runSubmitted( [FakeTask( "J00", 1000 )], queueSecs=0,
+                                                            timeoutSecs=None, maxQueueWaitSecs=60, maxRetries=2,
+                                                            isTaskAlive=lambda task: self.clock.now < 30 )
+        assert [t.taskName for t in failed] == ["J00"]
+        assert len(submissions) == 1
+        assert self.clock.now < 35
+
+    def testQueueWaitLimit(self):
+        # A job that never leaves the queue (or dies before it locks its block) times out, too.
+        # It may still be queued, so it is not submitted again.
+        finished, failed, submissions = self._runSubmitted( [FakeTask( "J00", 15 )], queueSecs=10**6,
+                                                            timeoutSecs=20, maxQueueWaitSecs=60, maxRetries=2 )
+        assert [t.taskName for t in failed] == ["J00"]
+        assert len(submissions) == 1
+        assert 60 < self.clock.now < 70
+
+        # Without a separate limit, the queue wait is limited by the timeout
+        self.clock = FakeClock()
+        finished, failed, submissions = self._runSubmitted( [FakeTask( "J00", 15 )], queueSecs=10**6,
+                                                            timeoutSecs=20 )
+        assert len(failed) == 1
+        assert self.clock.now < 30
+
+    def testLockedTaskNotRelaunched(self):
+        finished, failed, submissions = self._runSubmitted( [FakeTask( "J00", 1000 )], queueSecs=0,
+                                                            timeoutSecs=10, maxRetries=2 )
+        assert [t.taskName for t in failed] == ["J00"]
+        assert len(submissions) == 1
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,150 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+import os
+import glob
+import shutil
+import tempfile
+
+import numpy
+import h5py
+
+from ilastik.clusterOps import NodeScratchFile, importScratchFile, importNodeTransfer, getNodeTransferPath
+
+class ArrayFileset(object):
+    """
+    Stands in for a BlockwiseFileset: keeps the whole volume in memory
+    and records the roi of every writeData() call.
+    """
+    def __init__(self, shape, dtype, failOnWrite=None):
+        self.data = numpy.zeros( shape, dtype=dtype )
+        self.writtenRois = []
+        self.failOnWrite = failOnWrite
+
+    def writeData(self, roi, data):
+        if len(self.writtenRois) == self.failOnWrite:
+            raise IOError("Failed on purpose")
+        start, stop = map( tuple, roi )
+        self.writtenRois.append( (start, stop) )
+        self.data[ tuple( slice(a, b) for a, b in zip(start, stop) ) ] = data
+
+class TestNodeScratch(object):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.blockRoi = ( (10, 0, 5), (20, 4, 8) )
+        self.blockData = numpy.random.randint( 0, 255, (10, 4, 3) ).astype( numpy.uint8 )
+
+        # The master's scratch directories are created in here
+        self.masterTemp = os.path.join( self.directory, "master-tmp" )
+        os.mkdir( self.masterTemp )
+        self._oldTempDir = tempfile.tempdir
+        tempfile.tempdir = self.masterTemp
+
+    def tearDown(self):
+        tempfile.tempdir = self._oldTempDir
+        shutil.rmtree( self.directory )
+
+    def _writeScratchFile(self, path):
+        scratch = NodeScratchFile( path, self.blockRoi, numpy.uint8 )
+        # Write the block in sub-blocks, as the streamer does
+        for first in range(0, 10, 4):
+            last = min(first + 4, 10)
+            roi = ( (10 + first, 0, 5), (10 + last, 4, 8) )
+            scratch.writeData( roi, self.blockData[first:last] )
+        scratch.close()
+
+    def testTransferPaths(self):
+        # Outputs described in the same directory don't share their transfer files
+        primary = getNodeTransferPath( os.path.join( self.directory, "primary.json" ), (0, 10) )
+        secondary = getNodeTransferPath( os.path.join( self.directory, "secondary.json" ), (0, 10) )
+        assert primary != secondary
+        assert os.path.split( primary )[0] == os.path.split( secondary )[0]
+        assert primary != getNodeTransferPath( os.path.join( self.directory, "primary.json" ), (0, 20) )
+
+    def testScratchWrite(self):
+        path = os.path.join( self.directory, "scratch.h5" )
+        self._writeScratchFile( path )
+        with h5py.File( path, 'r' ) as f:
+            assert ( f[NodeScratchFile.DATASET_NAME][:] == self.blockData ).all()
+
+    def testImportInSlabs(self):
+        path = os.path.join( self.directory, "scratch.h5" )
+        self._writeScratchFile( path )
+
+        # One row of the block is 12 bytes: 30 bytes allow slabs of 2 rows
+        fileset = ArrayFileset( (30, 4, 8), numpy.uint8 )
+        importScratchFile( path, fileset, self.blockRoi, maxSlabBytes=30 )
+        assert fileset.writtenRois == [ ( (10 + i, 0, 5), (12 + i, 4, 8) ) for i in range(0, 10, 2) ]
+        assert ( fileset.data[10:20, :, 5:8] == self.blockData ).all()
+        assert not fileset.data[:10].any() and not fileset.data[20:].any()
+
+        # By default, the whole block is a single slab
+        fileset = ArrayFileset( (30, 4, 8), numpy.uint8 )
+        importScratchFile( path, fileset, self.blockRoi )
+        assert fileset.writtenRois == [ ( (10, 0, 5), (20, 4, 8) ) ]
+
+    def _transfer(self, name):
+        transferBase = os.path.join( self.directory, name + ".h5" )
+        self._writeScratchFile( transferBase )
+        open( transferBase + ".ready", 'w' ).close()
+        return transferBase
+
+    def testImportNodeTransfer(self):
+        transfers = [ ( self._transfer( name ), ArrayFileset( (30, 4, 8), numpy.uint8 ), self.blockRoi )
+                      for name in ("primary", "secondary") ]
+        importNodeTransfer( "cp {compressed_file} {uncompressed_file}", transfers )
+        for transferBase, fileset, _ in transfers:
+            assert ( fileset.data[10:20, :, 5:8] == self.blockData ).all()
+            assert glob.glob( transferBase + '*' ) == []
+        assert os.listdir( self.masterTemp ) == []
+
+    def testCleanupAfterFailedImport(self):
+        # The second fileset fails in the middle of its import
+        transfers = [ ( self._transfer( "primary" ), ArrayFileset( (30, 4, 8), numpy.uint8 ), self.blockRoi ),
+                      ( self._transfer( "secondary" ), ArrayFileset( (30, 4, 8), numpy.uint8, failOnWrite=0 ), self.blockRoi ) ]
+        try:
+            importNodeTransfer( "cp {compressed_file} {uncompressed_file}", transfers )
+        except IOError:
+            pass
+        else:
+            assert False, "The import should have failed"
+
+        # The master's scratch directory is gone...
+        assert os.listdir( self.masterTemp ) == []
+        # ...but all transferred files are kept, so the block can be imported again.
+        for transferBase, _, _ in transfers:
+            assert os.path.exists( transferBase )
+            assert os.path.exists( transferBase + ".ready" )
+
+    def testCleanupAfterFailedDecompression(self):
+        transfers = [ ( self._transfer( "primary" ), ArrayFileset( (30, 4, 8), numpy.uint8 ), self.blockRoi ) ]
+        try:
+            importNodeTransfer( "false {compressed_file} {uncompressed_file}", transfers )
+        except RuntimeError:
+            pass
+        else:
+            assert False, "The import should have failed"
+        assert os.listdir( self.masterTemp ) == []
+        assert transfers[0][1].writtenRois == []
+        assert os.path.exists( transfers[0][0] )
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,133 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+
+from ilastik.utility.batchScheduler import BatchJob, BatchManifest, BatchScheduler
+
+class RecordingJobs(object):
+    """
+    Creates jobs that write their output file and record how many jobs (and bytes) were running at the same time.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.running = []
+        self.maxRunning = 0
+        self.maxMemory = 0
+        self.runs = []
+
+    def create(self, name, memoryEstimate=0, fail=False):
+        inputPath = os.path.join( self.directory, name + ".in" )
+        outputPath = os.path.join( self.directory, name + ".out" )
+        if not os.path.exists(inputPath):
+            open(inputPath, 'w').close()
+
+        def run():
+            with self.lock:
+                self.running.append( memoryEstimate )
+                self.runs.append( name )
+                self.maxRunning = max( self.maxRunning, len(self.running) )
+                self.maxMemory = max( self.maxMemory, sum(self.running) )
+            time.sleep(0.05)
+            with self.lock:
+                self.running.remove( memoryEstimate )
+            if fail:
+                raise Exception("Failed on purpose")
+            open(outputPath, 'w').close()
+
+        return BatchJob( name, run, inputPath, outputPath, memoryEstimate )
+
+class TestBatchScheduler(object):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.jobs = RecordingJobs( self.directory )
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testParallel(self):
+        jobs = [ self.jobs.create( "job{}".format(i) ) for i in range(8) ]
+        assert BatchScheduler( maxParallelJobs=3 ).run( jobs )
+        assert sorted( self.jobs.runs ) == sorted( job.name for job in jobs )
+        assert 1 < self.jobs.maxRunning <= 3
+        for job in jobs:
+            assert job.status == 'done'
+            assert job.seconds > 0
+
+    def testMemoryLimit(self):
+        jobs = [ self.jobs.create( "job{}".format(i), memoryEstimate=40 ) for i in range(6) ]
+        # Larger than the limit: must run alone
+        jobs.append( self.jobs.create( "big", memoryEstimate=150 ) )
+        assert BatchScheduler( maxParallelJobs=4, memoryLimit=100 ).run( jobs )
+        assert len( self.jobs.runs ) == 7
+        assert self.jobs.maxRunning == 2
+        assert self.jobs.maxMemory == 150
+
+    def testFailure(self):
+        jobs = [ self.jobs.create( "ok1" ), self.jobs.create( "bad", fail=True ), self.jobs.create( "ok2" ) ]
+        assert not BatchScheduler( maxParallelJobs=2 ).run( jobs )
+        assert [ job.status for job in jobs ] == ['done', 'failed', 'done']
+
+    def testManifest(self):
+        manifestPath = os.path.join( self.directory, "manifest.json" )
+        jobs = [ self.jobs.create( "ok" ), self.jobs.create( "bad", fail=True ) ]
+        BatchScheduler( 2, manifest=BatchManifest( manifestPath ) ).run( jobs )
+        assert os.path.exists( manifestPath )
+
+        # Resume: only the failed job runs again
+        self.jobs.runs = []
+        jobs = [ self.jobs.create( "ok" ), self.jobs.create( "bad" ) ]
+        assert BatchScheduler( 2, manifest=BatchManifest( manifestPath ) ).run( jobs )
+        assert self.jobs.runs == ["bad"]
+        assert jobs[0].status == 'skipped'
+
+        # Modified input and deleted output are computed again
+        self.jobs.runs = []
+        inputPath = jobs[0].inputPath
+        os.utime( inputPath, (time.time() + 10, time.time() + 10) )
+        os.remove( jobs[1].outputPath )
+        jobs = [ self.jobs.create( "ok" ), self.jobs.create( "bad" ) ]
+        assert BatchScheduler( 2, manifest=BatchManifest( manifestPath ) ).run( jobs )
+        assert sorted( self.jobs.runs ) == ["bad", "ok"]
+
+    def testManifestChecksum(self):
+        manifestPath = os.path.join( self.directory, "manifest.json" )
+        jobs = [ self.jobs.create( "ok" ) ]
+        assert BatchScheduler( manifest=BatchManifest( manifestPath, "project1" ) ).run( jobs )
+
+        # Same checksum: skipped
+        self.jobs.runs = []
+        assert BatchScheduler( manifest=BatchManifest( manifestPath, "project1" ) ).run( [ self.jobs.create( "ok" ) ] )
+        assert self.jobs.runs == []
+
+        # Another project (or classifier) produced the output: computed again
+        assert BatchScheduler( manifest=BatchManifest( manifestPath, "project2" ) ).run( [ self.jobs.create( "ok" ) ] )
+        assert self.jobs.runs == ["ok"]
+        assert BatchScheduler( manifest=BatchManifest( manifestPath ) ).run( [ self.jobs.create( "ok" ) ] )
+        assert self.jobs.runs == ["ok", "ok"]
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
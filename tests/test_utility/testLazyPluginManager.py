@@ -0,0 +1,145 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+import os
+import copy
+import time
+import shutil
+import tempfile
+
+from ilastik.plugins import LazyPluginManager, ObjectFeaturesPlugin
+
+PLUGIN_INFO = """[Core]
+Name = {name}
+Module = {module}
+
+[Documentation]
+Description = "Plugin for testing the LazyPluginManager"
+"""
+
+PLUGIN_MODULE = """from ilastik.plugins import ObjectFeaturesPlugin
+
+class {name}(ObjectFeaturesPlugin):
+    name = "{name}"
+"""
+
+class TestLazyPluginManager(object):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.pluginPath = os.path.join(self.directory, "plugins")
+        self.manifestPath = os.path.join(self.directory, "manifest.json")
+        self.place = os.path.join(self.pluginPath, "first")
+        self._addPlugin(self.place, "FirstFeatures")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _addPlugin(self, directory, name):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        module = name.lower()
+        with open(os.path.join(directory, module + ".yapsy-plugin"), 'w') as f:
+            f.write(PLUGIN_INFO.format(name=name, module=module))
+        with open(os.path.join(directory, module + ".py"), 'w') as f:
+            f.write(PLUGIN_MODULE.format(name=name))
+
+    def _manager(self):
+        return LazyPluginManager([self.pluginPath],
+                                 {"ObjectFeatures" : ObjectFeaturesPlugin},
+                                 self.manifestPath)
+
+    def _names(self, manager):
+        return sorted(info.name for info in manager.getAllPlugins())
+
+    def _makeOlder(self, path):
+        # Modification times may have a coarse resolution
+        past = time.time() - 100
+        os.utime(path, (past, past))
+
+    def testLazy(self):
+        manager = self._manager()
+        assert not manager.loaded
+        assert not os.path.exists(self.manifestPath)
+        assert self._names(manager) == ["FirstFeatures"]
+        assert manager.loaded
+        assert manager.getPluginByName("FirstFeatures", "ObjectFeatures") is not None
+
+    def testManifestHit(self):
+        self._names(self._manager())
+        assert os.path.exists(self.manifestPath)
+
+        manager = self._manager()
+        places, fromManifest = manager._pluginPlaces()
+        assert fromManifest
+        assert places == [os.path.abspath(self.place)]
+        assert self._names(manager) == ["FirstFeatures"]
+
+    def testManifestMiss(self):
+        places, fromManifest = self._manager()._pluginPlaces()
+        assert not fromManifest
+        assert places == [self.pluginPath]
+
+        # A manifest for other plugin paths is ignored
+        self._names(self._manager())
+        other = LazyPluginManager([self.place], {"ObjectFeatures" : ObjectFeaturesPlugin}, self.manifestPath)
+        assert not other._pluginPlaces()[1]
+
+    def testManifestStale(self):
+        self._makeOlder(self.pluginPath)
+        self._makeOlder(self.place)
+        self._names(self._manager())
+
+        # A new plugin directory below the plugin path
+        self._addPlugin(os.path.join(self.pluginPath, "second"), "SecondFeatures")
+        manager = self._manager()
+        assert not manager._pluginPlaces()[1]
+        assert self._names(manager) == ["FirstFeatures", "SecondFeatures"]
+
+        # A new plugin directory further below the plugin path
+        self._addPlugin(os.path.join(self.pluginPath, "more", "third"), "ThirdFeatures")
+        manager = self._manager()
+        assert not manager._pluginPlaces()[1]
+        assert self._names(manager) == ["FirstFeatures", "SecondFeatures", "ThirdFeatures"]
+        assert self._manager()._pluginPlaces()[1]
+
+        # A new plugin in an existing directory without plugins
+        self._makeOlder(os.path.join(self.pluginPath, "more"))
+        self._names(self._manager())
+        self._addPlugin(os.path.join(self.pluginPath, "more"), "FourthFeatures")
+        manager = self._manager()
+        assert not manager._pluginPlaces()[1]
+        assert "FourthFeatures" in self._names(manager)
+
+        # A changed plugin info file in a known directory
+        manager = self._manager()
+        assert manager._pluginPlaces()[1]
+        self._makeOlder(os.path.join(self.place, "firstfeatures.yapsy-plugin"))
+        assert not self._manager()._pluginPlaces()[1]
+
+    def testCopy(self):
+        manager = self._manager()
+        # Must neither recurse in __getattr__ nor load the plugins
+        copied = copy.copy(manager)
+        assert not manager.loaded
+        assert not copied.loaded
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
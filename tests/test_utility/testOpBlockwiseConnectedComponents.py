@@ -0,0 +1,132 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# Copyright 2011-2014, the ilastik developers
+
+import numpy
+import vigra
+
+from lazyflow.graph import Graph
+
+from ilastik.utility.opBlockwiseConnectedComponents import OpBlockwiseConnectedComponents, UnionFind
+
+class TestOpBlockwiseConnectedComponents(object):
+
+    def setUp(self):
+        # A few random blobs, with some spanning several blocks
+        numpy.random.seed(0)
+        noise = numpy.random.random( (60,50,40) ).astype( numpy.float32 )
+        smooth = vigra.filters.gaussianSmoothing( noise, 2.0 )
+        binary = ( smooth > numpy.percentile( smooth, 70 ) ).astype( numpy.uint8 )
+        self.binary = vigra.taggedView( binary[None,...,None], 'txyzc' )
+
+        self.op = OpBlockwiseConnectedComponents( graph=Graph() )
+        self.op.Input.setValue( self.binary )
+        self.op.BlockShape.setValue( {'x' : 16, 'y' : 16, 'z' : 16} )
+
+    def testSameAsGlobalLabeling(self):
+        labels = self.op.Output[:].wait()
+        expected = vigra.analysis.labelVolumeWithBackground( self.binary[0,...,0] )
+        labels = labels[0,...,0]
+
+        assert ( (labels > 0) == (expected > 0) ).all()
+        assert self.op.getLabelCount() == expected.max()
+
+        # The labels must be the same up to a renumbering
+        pairs = set( zip( labels[labels > 0], expected[expected > 0] ) )
+        assert len( pairs ) == expected.max(), "Objects were split or merged"
+
+    def testSubregionRequest(self):
+        labels = self.op.Output[:].wait()
+        subregion = self.op.Output[:, 10:37, 5:45, 20:40, :].wait()
+        assert ( subregion == labels[:, 10:37, 5:45, 20:40, :] ).all()
+
+    def testLabelSizes(self):
+        labels = self.op.Output[:].wait()
+        sizes = self.op.getLabelSizes()
+        assert sizes[0] == 0
+        numpy.testing.assert_array_equal( sizes[1:], numpy.bincount( labels.reshape(-1) )[1:] )
+
+    def testFilteredOutput(self):
+        labels = self.op.Output[:].wait()
+        sizes = self.op.getLabelSizes()
+        min_size, max_size = numpy.percentile( sizes[1:], 25 ), numpy.percentile( sizes[1:], 75 )
+        self.op.MinLabelSize.setValue( int(min_size) )
+        self.op.MaxLabelSize.setValue( int(max_size) )
+        filtered = self.op.FilteredOutput[:].wait()
+
+        keep = ( sizes[labels] >= int(min_size) ) & ( sizes[labels] <= int(max_size) ) & ( labels > 0 )
+        numpy.testing.assert_array_equal( filtered, numpy.where( keep, labels, 0 ) )
+
+    def testDirty(self):
+        self.op.Output[:].wait()
+        binary = self.binary.copy()
+        binary[:] = 0
+        binary[0, 0:40, 10:12, 10:12, 0] = 1
+        self.op.Input.setValue( binary )
+        labels = self.op.Output[:].wait()
+        assert self.op.getLabelCount() == 1
+        assert ( labels[0, 0:40, 10:12, 10:12, 0] == 1 ).all()
+
+    def _countLabeledBlocks(self):
+        labelBlock = self.op._labelBlock
+        labeledBlocks = []
+        def countingLabelBlock( block_roi ):
+            labeledBlocks.append( tuple( block_roi[0] ) )
+            return labelBlock( block_roi )
+        self.op._labelBlock = countingLabelBlock
+        return labeledBlocks
+
+    def testBlockLabelsAreCached(self):
+        # 4*4*3 blocks
+        self.op.MaxCachedBlocks.setValue( 48 )
+        labeledBlocks = self._countLabeledBlocks()
+        labels = self.op.Output[:].wait()
+        assert len( labeledBlocks ) == 48, "Each block should have been labeled once"
+
+        # Small requests (e.g. the bounding boxes of objects) reuse the labeled blocks
+        for x in range( 0, 60, 5 ):
+            subregion = self.op.FilteredOutput[:, x:x+3, 10:20, 10:20, :].wait()
+            assert ( subregion == labels[:, x:x+3, 10:20, 10:20, :] ).all()
+        assert len( labeledBlocks ) == 48
+
+    def testLeastRecentlyUsedBlocksAreDiscarded(self):
+        self.op.MaxCachedBlocks.setValue( 2 )
+        labeledBlocks = self._countLabeledBlocks()
+        expected = self.op.Output[:, 0:16, 0:16, 0:16, :].wait()
+
+        self.op.Output[:, 0:16, 0:16, 0:16, :].wait()
+        count = len( labeledBlocks )
+        assert ( self.op.Output[:, 0:16, 0:16, 0:16, :].wait() == expected ).all()
+        assert len( labeledBlocks ) == count
+
+        # Two other blocks push the first one out of the cache
+        self.op.Output[:, 16:48, 0:16, 0:16, :].wait()
+        count = len( labeledBlocks )
+        assert ( self.op.Output[:, 0:16, 0:16, 0:16, :].wait() == expected ).all()
+        assert labeledBlocks[count:] == [ (0, 0, 0, 0, 0) ]
+
+    def testUnionFind(self):
+        union_find = UnionFind(6)
+        union_find.union(5, 3)
+        union_find.union(3, 4)
+        union_find.union(1, 2)
+        assert list( union_find.roots() ) == [0, 1, 1, 3, 3, 3]
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)